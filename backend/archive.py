@@ -0,0 +1,499 @@
+# Export and import of a user's whole library as one zip archive.
+# archive.py
+#
+# Layout:
+#   <table>.ndjson            one JSON object per row, db.EXPORT_QUERIES tables
+#   blobs/files/<id>.pdf      each PDF, named by the exporting file id
+#   blobs/regions/<id><ext>   region images, named by annotation id
+#   manifest.json             format, version and counts (written last)
+# The export is streamed: rows are read in batches from one read snapshot
+# and written straight into the zip, and blobs are pulled from S3 a few at a
+# time through spooled temp files, so memory stays flat however large the
+# library is. An import uploads the blobs first, then inserts every row with
+# new ids in a single transaction the caller commits.
+import io
+import json
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from db import (
+    EXPORT_QUERIES,
+    IMPORT_COLUMNS,
+    read_snapshot,
+    iter_export_rows,
+    insert_rows,
+    set_imported_links,
+    index_annotation_boxes,
+)
+from geometry import pack_geometry, unpack_geometry
+from s3 import download_blob, upload_blob, delete_s3_objects
+
+logger = logging.getLogger("engrave.archive")
+
+ARCHIVE_FORMAT = "engrave-library"
+ARCHIVE_VERSION = 1
+
+# S3 transfers in flight at once during an export / import
+EXPORT_S3_CONCURRENCY = int(os.getenv("EXPORT_S3_CONCURRENCY", "8"))
+IMPORT_S3_CONCURRENCY = int(os.getenv("IMPORT_S3_CONCURRENCY", "8"))
+# A downloaded blob waiting for its turn stays in memory up to this size,
+# on disk beyond it
+BLOB_SPOOL_BYTES = 8 * 1024 * 1024
+# Size of the chunks the response is sent in, and how many can be waiting
+STREAM_CHUNK_BYTES = 1024 * 1024
+STREAM_QUEUE_CHUNKS = 8
+IMPORT_BATCH_ROWS = 1000
+
+REGION_CONTENT_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp"}
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+# ======================================================
+# Export
+# ======================================================
+
+class _ChunkWriter:
+    """
+    Write-only file object for zipfile that hands the bytes to the response
+    in STREAM_CHUNK_BYTES pieces. The queue is bounded, so a slow client
+    slows the export down instead of filling memory.
+    """
+
+    def __init__(self, chunks: queue.Queue, cancelled: threading.Event):
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.buffer = bytearray()
+        self.written = 0
+
+    def write(self, data) -> int:
+        self.buffer += data
+        self.written += len(data)
+        if len(self.buffer) >= STREAM_CHUNK_BYTES:
+            self._put(bytes(self.buffer))
+            self.buffer.clear()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close_stream(self):
+        if self.buffer:
+            self._put(bytes(self.buffer))
+            self.buffer.clear()
+
+    def _put(self, item):
+        while True:
+            if self.cancelled.is_set():
+                raise ExportCancelled()
+            try:
+                self.chunks.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+
+def _blob_name(table: str, row) -> tuple:
+    """
+    (archive name, S3 key) of a row's blob, or (None, None)
+    """
+    if table == "files" and row["s3_key"]:
+        return f"blobs/files/{row['id']}.pdf", row["s3_key"]
+    if table == "annotations" and row["region_s3_key"]:
+        ext = os.path.splitext(row["region_s3_key"])[1] or ".png"
+        return f"blobs/regions/{row['id']}{ext}", row["region_s3_key"]
+    return None, None
+
+
+def _write_tables(zf: zipfile.ZipFile, user_id: int, counts, blobs):
+    # S3 keys aren't portable; rows name their blob in the archive instead
+    with read_snapshot():
+        for table in EXPORT_QUERIES:
+            n = 0
+            with zf.open(f"{table}.ndjson", "w", force_zip64=True) as out:
+                for batch in iter_export_rows(table, user_id):
+                    lines = []
+                    for row in batch:
+                        name, key = _blob_name(table, row)
+                        if table == "files":
+                            del row["s3_key"]
+                            row["blob"] = name
+                        elif table == "annotations":
+                            del row["region_s3_key"]
+                            row["blob"] = name
+                        if name:
+                            blobs.append((name, key))
+                        lines.append(json.dumps(row, ensure_ascii=False, separators=(",", ":")))
+                    out.write(("\n".join(lines) + "\n").encode("utf-8"))
+                    n += len(batch)
+            counts[table] = n
+
+
+def _fetch_blob(key: str):
+    spool = tempfile.SpooledTemporaryFile(max_size=BLOB_SPOOL_BYTES)
+    try:
+        download_blob(key, spool)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+def _write_blobs(zf: zipfile.ZipFile, blobs, cancelled: threading.Event):
+    """
+    Pull blobs from S3, EXPORT_S3_CONCURRENCY at a time, and store them in
+    archive order. Returns (bytes written, names of blobs that are missing)
+    """
+    total = 0
+    missing = []
+    pending = deque()
+    items = iter(blobs)
+
+    with ThreadPoolExecutor(max_workers=EXPORT_S3_CONCURRENCY, thread_name_prefix="export-s3") as pool:
+        try:
+            while True:
+                # Keep the pool busy, but at most one window of blobs ahead
+                while len(pending) < EXPORT_S3_CONCURRENCY * 2:
+                    item = next(items, None)
+                    if item is None:
+                        break
+                    pending.append((item[0], pool.submit(_fetch_blob, item[1])))
+                if not pending:
+                    break
+                if cancelled.is_set():
+                    raise ExportCancelled()
+
+                name, future = pending.popleft()
+                try:
+                    spool = future.result()
+                except Exception as e:
+                    logger.warning("Blob %s missing from the export: %s", name, e)
+                    missing.append(name)
+                    continue
+
+                with spool:
+                    # Already compressed (PDF, PNG); stored as is
+                    info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+                    info.compress_type = zipfile.ZIP_STORED
+                    with zf.open(info, "w", force_zip64=True) as out:
+                        shutil.copyfileobj(spool, out, STREAM_CHUNK_BYTES)
+                    total += spool.tell()
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    return total, missing
+
+
+def _write_export(user_id: int, chunks: queue.Queue, cancelled: threading.Event):
+    writer = _ChunkWriter(chunks, cancelled)
+    started = time.perf_counter()
+    try:
+        counts = {}
+        blobs = []
+        with zipfile.ZipFile(writer, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+            _write_tables(zf, user_id, counts, blobs)
+            blob_bytes, missing = _write_blobs(zf, blobs, cancelled)
+            zf.writestr("manifest.json", json.dumps({
+                "format": ARCHIVE_FORMAT,
+                "version": ARCHIVE_VERSION,
+                "exported_at": int(time.time()),
+                "counts": counts,
+                "blobs": len(blobs) - len(missing),
+                "blob_bytes": blob_bytes,
+                "missing_blobs": missing,
+            }, indent=2))
+        writer.close_stream()
+        chunks.put(None)
+        logger.info(
+            "Exported %d blobs and %s in %.1fs (%d bytes)",
+            len(blobs) - len(missing), counts, time.perf_counter() - started, writer.written,
+        )
+    except ExportCancelled:
+        logger.info("Export cancelled after %d bytes", writer.written)
+    except Exception as e:
+        logger.exception("Export for user %d failed", user_id)
+        if not cancelled.is_set():
+            chunks.put(e)
+
+
+def stream_export(user_id: int):
+    """
+    Generator of the archive's bytes, for a StreamingResponse. The archive
+    is written on its own thread (one database connection for the whole
+    export); stopping the generator (client gone) stops it.
+    """
+    chunks = queue.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+    cancelled = threading.Event()
+    thread = threading.Thread(
+        target=_write_export,
+        args=(user_id, chunks, cancelled),
+        name="export",
+        daemon=True,
+    )
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                # Headers are out already; a cut-off stream is all that's left
+                raise chunk
+            yield chunk
+    finally:
+        cancelled.set()
+
+
+# ======================================================
+# Import
+# ======================================================
+
+def read_manifest(zf: zipfile.ZipFile):
+    """
+    The archive's manifest; ValueError if this isn't an archive this
+    version can read
+    """
+    try:
+        manifest = json.loads(zf.read("manifest.json"))
+    except KeyError:
+        raise ValueError("Not a library archive: no manifest.json")
+
+    if manifest.get("format") != ARCHIVE_FORMAT:
+        raise ValueError("Not a library archive")
+    if manifest.get("version", 0) > ARCHIVE_VERSION:
+        raise ValueError(f"Archive version {manifest.get('version')} is newer than this server reads")
+    return manifest
+
+
+def upload_blobs(zf: zipfile.ZipFile, user_id: int):
+    """
+    Upload every blob in the archive to S3 under a new import prefix,
+    IMPORT_S3_CONCURRENCY at a time, streaming from the zip. Returns
+    {archive name: S3 key}; on failure the uploaded ones are deleted.
+    """
+    prefix = f"users/user_{user_id}/imports/{uuid.uuid4().hex}"
+    names = [n for n in zf.namelist() if n.startswith("blobs/") and not n.endswith("/")]
+
+    def upload(name):
+        ext = os.path.splitext(name)[1].lower()
+        content_type = "application/pdf" if ext == ".pdf" else REGION_CONTENT_TYPES.get(ext, "application/octet-stream")
+        with zf.open(name) as src:
+            return upload_blob(src, f"{prefix}/{name[len('blobs/'):]}", content_type)
+
+    keys = {}
+    with ThreadPoolExecutor(max_workers=IMPORT_S3_CONCURRENCY, thread_name_prefix="import-s3") as pool:
+        futures = [(name, pool.submit(upload, name)) for name in names]
+        errors = []
+        for name, future in futures:
+            try:
+                keys[name] = future.result()
+            except Exception as e:
+                errors.append(e)
+
+    if errors:
+        delete_s3_objects(list(keys.values()))
+        raise errors[0]
+    return keys
+
+
+def _rows(zf: zipfile.ZipFile, table: str):
+    """
+    Batches of a table's rows from the archive
+    """
+    try:
+        member = zf.open(f"{table}.ndjson")
+    except KeyError:
+        return
+
+    with member, io.TextIOWrapper(member, encoding="utf-8") as lines:
+        batch = []
+        for line in lines:
+            if line.strip():
+                batch.append(json.loads(line))
+            if len(batch) == IMPORT_BATCH_ROWS:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def _folder_forest(parent_of, folders):
+    """
+    The archive's folder parent links that are safe to import: parents that
+    are in the archive, with one link of every cycle cut (that folder stays
+    at the top level). Folder queries walk parent_id and must terminate.
+    """
+    parent_of = {c: p for c, p in parent_of.items() if p in folders}
+    done = set()
+    for start in list(parent_of):
+        path = []
+        node = start
+        while node in parent_of and node not in done:
+            if node in path:
+                del parent_of[node]
+                break
+            path.append(node)
+            node = parent_of[node]
+        done.update(path)
+    return parent_of
+
+
+def import_rows(zf: zipfile.ZipFile, user_id: int, keys, folder_id: int = None):
+    """
+    Insert every row of the archive for user_id with new ids, references
+    between rows remapped. Top-level folders and files go into folder_id.
+    Rows whose parent isn't in the archive are skipped. Doesn't commit.
+
+    keys: upload_blobs() result
+    Returns the number of rows inserted per table.
+    """
+    counts = {}
+    folders, files, documents, file_of_document = {}, {}, {}, {}
+    annotations, threads, messages = {}, {}, {}
+
+    # Folders, then their parents once every folder has an id
+    parent_of = {}
+    for batch in _rows(zf, "folders"):
+        ids = insert_rows("folders", [(r["name"], folder_id, user_id, r["created_at"]) for r in batch])
+        for r, new_id in zip(batch, ids):
+            folders[r["id"]] = new_id
+            if r["parent_id"] is not None:
+                parent_of[r["id"]] = r["parent_id"]
+    parent_of = _folder_forest(parent_of, folders)
+    set_imported_links("folders", "parent_id", [(folders[p], folders[c]) for c, p in parent_of.items()])
+    counts["folders"] = len(folders)
+
+    # Files get new document ids; a PDF whose blob is missing comes back
+    # without one
+    parents = []
+    for batch in _rows(zf, "files"):
+        rows = []
+        for r in batch:
+            if r["blob"]:
+                documents[r["document_id"]] = str(uuid.uuid4())
+            else:
+                documents[r["document_id"]] = f"chat_{os.urandom(6).hex()}"
+            rows.append((
+                folders.get(r["folder_id"], folder_id),
+                documents[r["document_id"]],
+                r["title"],
+                keys.get(r["blob"]),
+                user_id,
+                r["content_hash"],
+                r["created_at"],
+            ))
+        for r, new_id in zip(batch, insert_rows("files", rows)):
+            files[r["id"]] = new_id
+            file_of_document[documents[r["document_id"]]] = new_id
+            if r["parent_file_id"] is not None:
+                parents.append((r["parent_file_id"], new_id))
+    set_imported_links("files", "parent_file_id", [(files[p], i) for p, i in parents if p in files])
+    counts["files"] = len(files)
+
+    for table in ("pages", "document_summaries"):
+        counts[table] = 0
+        for batch in _rows(zf, table):
+            rows = [
+                (documents[r["document_id"]],) + tuple(r[c] for c in IMPORT_COLUMNS[table][1:])
+                for r in batch
+                if r["document_id"] in documents
+            ]
+            insert_rows(table, rows)
+            counts[table] += len(rows)
+
+    for batch in _rows(zf, "annotations"):
+        batch = [r for r in batch if r["document_id"] in documents]
+        rows = []
+        for r in batch:
+            blob_key = keys.get(r["blob"])
+            rows.append((
+                documents[r["document_id"]],
+                r["page_number"],
+                r["type"],
+                pack_geometry(r["geometry"]),
+                r["text"],
+                str(uuid.uuid4()) if blob_key else None,
+                blob_key,
+                r["created_at"],
+            ))
+        ids = insert_rows("annotations", rows)
+        boxes = []
+        for r, row, new_id in zip(batch, rows, ids):
+            annotations[r["id"]] = new_id
+            if row[3] is not None:
+                boxes.append((new_id, file_of_document[row[0]], r["page_number"], unpack_geometry(row[3])))
+        index_annotation_boxes(boxes)
+    counts["annotations"] = len(annotations)
+
+    # Threads first without their fork links, which point at messages
+    forks = []
+    for batch in _rows(zf, "chat_threads"):
+        batch = [r for r in batch if r["file_id"] in files]
+        ids = insert_rows("chat_threads", [
+            (files[r["file_id"]], annotations.get(r["source_annotation_id"]), r["title"], r["created_at"])
+            for r in batch
+        ])
+        for r, new_id in zip(batch, ids):
+            threads[r["id"]] = new_id
+            if r["parent_thread_id"] is not None:
+                forks.append((new_id, r["parent_thread_id"], r["fork_message_id"]))
+    counts["chat_threads"] = len(threads)
+
+    # Message ids of fork parents, to place a fork point whose message is gone
+    fork_parents = {p: [] for _, p, _ in forks}
+    for batch in _rows(zf, "messages"):
+        batch = [r for r in batch if r["chat_thread_id"] in threads]
+        ids = insert_rows("messages", [
+            (
+                threads[r["chat_thread_id"]],
+                documents.get(r["document_id"], r["document_id"]),
+                r["role"],
+                r["content"],
+                annotations.get(r["annotation_id"]),
+                r["reference"],
+                r["created_at"],
+            )
+            for r in batch
+        ])
+        for r, new_id in zip(batch, ids):
+            messages[r["id"]] = new_id
+            if r["chat_thread_id"] in fork_parents:
+                fork_parents[r["chat_thread_id"]].append(r["id"])
+    counts["messages"] = len(messages)
+
+    links, points = [], []
+    for new_id, parent, fork_message_id in forks:
+        if parent not in threads:
+            continue
+        # The parent's last exported message at or before the fork point
+        # (ids are exported in order)
+        kept = [m for m in fork_parents[parent] if m <= (fork_message_id or 0)]
+        links.append((threads[parent], new_id))
+        points.append((messages[kept[-1]] if kept else 0, new_id))
+    set_imported_links("chat_threads", "parent_thread_id", links)
+    set_imported_links("chat_threads", "fork_message_id", points)
+
+    counts["chat_highlights"] = 0
+    for batch in _rows(zf, "chat_highlights"):
+        rows = [
+            (annotations[r["annotation_id"]], messages[r["message_id"]], r["start"], r["end"], r["created_at"])
+            for r in batch
+            if r["annotation_id"] in annotations and r["message_id"] in messages
+        ]
+        insert_rows("chat_highlights", rows)
+        counts["chat_highlights"] += len(rows)
+
+    return counts
@@ -0,0 +1,156 @@
+# Benchmark packed annotation geometry against the JSON text it replaced.
+# bench/bench_annotation_geometry.py
+#
+# Fills a database the old way (geometry as json.dumps text), times
+# get_annotations_by_document, runs the packing migration, and times it
+# again with and without geometry. Also checks every geometry survives the
+# round trip (same shape, values within float32 precision).
+#
+# Usage: python bench/bench_annotation_geometry.py --annotations 50000
+import argparse
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def random_geometry(rng):
+    # Shapes the viewer sends: multi-line text selections, single region boxes
+    kind = rng.random()
+    if kind < 0.6:
+        x, y = rng.random() * 0.5, rng.random() * 0.9
+        return [
+            {"x": x, "y": y + i * 0.02, "width": rng.random() * 0.4, "height": 0.015}
+            for i in range(rng.randint(1, 8))
+        ]
+    if kind < 0.95:
+        return {"x": rng.random(), "y": rng.random(), "width": rng.random() * 0.3, "height": rng.random() * 0.3}
+    return {"rects": [{"x": rng.random(), "y": rng.random(), "width": 0.1, "height": 0.02}]}
+
+
+def populate_legacy(db, n_annotations: int, n_pages: int):
+    rng = random.Random(42)
+    db.create_file(None, "doc-main", "main", 1)
+
+    geometries = [random_geometry(rng) for _ in range(n_annotations)]
+    cur = db.get_cursor()
+    cur.executemany(
+        """
+        INSERT INTO annotations (document_id, page_number, type, geometry, text)
+        VALUES ('doc-main', ?, 'text', ?, ?)
+        """,
+        [
+            (rng.randint(1, n_pages), json.dumps(g), f"annotation {i}")
+            for i, g in enumerate(geometries)
+        ],
+    )
+    db.commit()
+    return geometries
+
+
+def same_geometry(a, b) -> bool:
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, list):
+        return len(a) == len(b) and all(same_geometry(x, y) for x, y in zip(a, b))
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(same_geometry(a[k], b[k]) for k in a)
+    return math.isclose(a, b, rel_tol=1e-6, abs_tol=1e-7)
+
+
+def geometry_bytes(db) -> int:
+    cur = db.get_cursor()
+    cur.execute("SELECT SUM(length(CAST(geometry AS BLOB))) FROM annotations")
+    return cur.fetchone()[0]
+
+
+def timed(fn, repeat: int):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--annotations", type=int, default=50_000)
+    parser.add_argument("--pages", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_geometry_")
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+    import db
+    db.init_db()
+
+    geometries = populate_legacy(db, args.annotations, args.pages)
+    rects = sum(len(g) if isinstance(g, list) else len(g.get("rects", [g])) for g in geometries)
+    print(f"{args.annotations} annotations, {rects} rects ({workdir})")
+
+    def load(**kwargs):
+        return db.get_annotations_by_document("doc-main", **kwargs)
+
+    def load_and_encode(**kwargs):
+        # What the endpoint pays: read, decode, then serialize the response
+        return json.dumps(load(**kwargs))
+
+    results = {}
+    json_size = geometry_bytes(db)
+    results["json"] = timed(load, args.repeat)[0], timed(load_and_encode, args.repeat)[0]
+
+    start = time.perf_counter()
+    db.migrate_pack_annotation_geometry()
+    db.commit()
+    migrate_ms = (time.perf_counter() - start) * 1000
+    packed_size = geometry_bytes(db)
+
+    results["packed"] = timed(load, args.repeat)[0], timed(load_and_encode, args.repeat)[0]
+    results["no geometry"] = (
+        timed(lambda: load(include_geometry=False), args.repeat)[0],
+        timed(lambda: load_and_encode(include_geometry=False), args.repeat)[0],
+    )
+
+    print(f"geometry storage: JSON {json_size / 1024:.0f} KiB, packed {packed_size / 1024:.0f} KiB")
+    print(f"migration: {migrate_ms:.0f} ms")
+    print(f"{'':<14}{'load':>10}{'load+json':>12}")
+    for name, (load_ms, encode_ms) in results.items():
+        print(f"{name:<14}{load_ms:>8.1f}ms{encode_ms:>10.1f}ms")
+
+    loaded = {a["id"]: a["geometry"] for a in load()}
+    mismatched = [
+        annotation_id
+        for annotation_id, expected in zip(sorted(loaded), geometries)
+        if not same_geometry(loaded[annotation_id], expected)
+    ]
+
+    cur = db.get_cursor()
+    cur.execute("SELECT COUNT(*) FROM annotations WHERE typeof(geometry) != 'blob'")
+    unpacked = cur.fetchone()[0]
+
+    failures = []
+    if mismatched:
+        failures.append(f"{len(mismatched)} geometries changed, e.g. annotation {mismatched[0]}")
+    if unpacked:
+        failures.append(f"{unpacked} annotations still stored as JSON")
+
+    if failures:
+        print("FAILED:")
+        for f in failures:
+            print(f"  {f}")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+# Benchmark viewport annotation queries (R-tree) against loading every
+# annotation of a heavily annotated document.
+# bench/bench_annotation_viewport.py
+#
+# Also checks the R-tree answers against a brute-force filter, and that
+# rebuilding the index from existing annotations gives the same boxes.
+#
+# Usage: python bench/bench_annotation_viewport.py --annotations 20000 --pages 300
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def random_geometry(rng):
+    # Text selections are a few line rects; regions are one box
+    if rng.random() < 0.7:
+        x, y = rng.uniform(0.05, 0.5), rng.uniform(0.05, 0.9)
+        return [
+            {"x": x, "y": y + i * 0.02, "width": rng.uniform(0.1, 0.4), "height": 0.015}
+            for i in range(rng.randint(1, 4))
+        ]
+    x, y = rng.uniform(0.0, 0.8), rng.uniform(0.0, 0.8)
+    return {"x": x, "y": y, "width": rng.uniform(0.05, 0.2), "height": rng.uniform(0.05, 0.2)}
+
+
+def populate(db, n_annotations: int, n_pages: int, n_other_docs: int):
+    rng = random.Random(42)
+
+    file_id = db.create_file(None, "doc-main", "main", 1)
+    other_docs = [f"doc-{i}" for i in range(n_other_docs)]
+    for document_id in other_docs:
+        db.create_file(None, document_id, document_id, 1)
+
+    for i in range(n_annotations):
+        db.create_annotation("doc-main", rng.randint(1, n_pages), "text", random_geometry(rng), text=f"a{i}")
+        # Same pages in other documents, so the index has to separate files
+        if other_docs:
+            db.create_annotation(rng.choice(other_docs), rng.randint(1, n_pages), "text", random_geometry(rng))
+
+    db.commit()
+    return file_id
+
+
+def brute_force(annotations, rects):
+    from geometry import geometry_rects
+
+    hits = []
+    for a in annotations:
+        for page_number, x0, y0, x1, y1 in rects:
+            if a["page_number"] != page_number:
+                continue
+            if any(
+                r["x"] <= x1 and r["x"] + r["width"] >= x0
+                and r["y"] <= y1 and r["y"] + r["height"] >= y0
+                for r in geometry_rects(a["geometry"])
+            ):
+                hits.append(a["id"])
+                break
+    return hits
+
+
+def timed(fn, repeat: int):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--annotations", type=int, default=20_000)
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--other-docs", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_viewport_")
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+    import db
+    db.init_db()
+
+    start = time.perf_counter()
+    file_id = populate(db, args.annotations, args.pages, args.other_docs)
+    print(f"populated {args.annotations} annotations on {args.pages} pages in {time.perf_counter() - start:.1f}s ({workdir})")
+
+    failures = []
+
+    ms, everything = timed(lambda: db.get_annotations_by_document("doc-main"), max(1, args.repeat // 4))
+    print(f"whole document:           {ms:8.2f} ms  ({len(everything)} annotations)")
+
+    # Two pages on screen, then the lower half of one page
+    page = args.pages // 2
+    viewports = {
+        "two pages": [(page, 0.0, 0.0, 1.0, 1.0), (page + 1, 0.0, 0.0, 1.0, 1.0)],
+        "half page": [(page, 0.0, 0.5, 1.0, 1.0)],
+    }
+    for name, rects in viewports.items():
+        ms, visible = timed(lambda: db.get_annotations_in_viewport(file_id, "doc-main", rects), args.repeat)
+        print(f"viewport ({name}):     {ms:8.2f} ms  ({len(visible)} annotations)")
+
+        expected = sorted(brute_force(everything, rects))
+        got = sorted(a["id"] for a in visible)
+        if got != expected:
+            failures.append(f"{name}: R-tree returned {len(got)} annotations, brute force {len(expected)}")
+
+    # Rebuild from scratch, as on first startup with existing annotations
+    cur = db.get_cursor()
+    cur.execute("SELECT * FROM annotation_boxes ORDER BY id")
+    before = cur.fetchall()
+    cur.execute("DROP TABLE annotation_boxes")
+    start = time.perf_counter()
+    db.init_annotation_index()
+    db.commit()
+    print(f"index rebuild:            {(time.perf_counter() - start) * 1000:8.1f} ms")
+    cur.execute("SELECT * FROM annotation_boxes ORDER BY id")
+    if cur.fetchall() != before:
+        failures.append("rebuilt index differs from the trigger-maintained one")
+
+    if failures:
+        print("FAILED:")
+        for f in failures:
+            print(f"  {f}")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,326 @@
+# Benchmark library export and import: a synthetic library of --gb of PDFs
+# (plus pages, annotations, region images, threads with forks and messages)
+# is exported through GET /export to a file and imported into an empty
+# server through POST /import.
+# bench/bench_archive.py
+#
+# Reports throughput and each server's peak RSS, which should stay flat
+# however big the library is, and checks the import matches the original:
+# row counts, blob bytes and a forked thread's history. First compares
+# pulling blobs from S3 one at a time with EXPORT_S3_CONCURRENCY on a small
+# library with S3 latency.
+#
+# The fake S3 keeps objects on disk (--store-dir); blobs are random bytes,
+# which export and import treat as opaque. A 10 GB run needs about 30 GB of
+# free disk: the objects, the archive and the imported copies.
+#
+#   python bench/bench_archive.py --gb 10
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+import httpx
+
+from fakes import FakeOpenAI, FakeS3, Latency
+from run_bench import BACKEND_DIR, check, free_port, make_pdf, start_server
+
+WORDS = "gradient loss layer weight bias entropy softmax kernel tensor batch epoch".split()
+
+
+def words(rng, n: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+def populate(db, s3, args, files: int, pdf_bytes: int):
+    """
+    Write a library straight into the database and the fake S3
+    """
+    rng = random.Random(42)
+    header = make_pdf(1)
+    blob_bytes = 0
+
+    folders = db.insert_rows("folders", [(f"Course {i}", None, 1, None) for i in range(max(1, files // 50))])
+    db.set_imported_links("folders", "parent_id", [(folders[0], f) for f in folders[1::3]])
+
+    for start in range(0, files, 50):
+        n = min(50, files - start)
+        rows = []
+        for i in range(start, start + n):
+            key = f"users/user_1/files/{i}.pdf"
+            data = header + os.urandom(max(0, pdf_bytes - len(header)))
+            s3.objects[("bench", key)] = data
+            blob_bytes += len(data)
+            rows.append((rng.choice(folders), f"doc-{i}", f"Lecture {i}", key, 1, None, None))
+        file_ids = db.insert_rows("files", rows)
+
+        for file_id, (_, document_id, *_rest) in zip(file_ids, rows):
+            db.insert_rows("pages", [
+                (document_id, p, words(rng, 400), None, words(rng, 40))
+                for p in range(1, args.pages + 1)
+            ])
+            annotation_rows = []
+            for a in range(args.annotations):
+                region = a < args.regions
+                key = f"users/user_1/regions/{document_id}-{a}.png" if region else None
+                if region:
+                    data = os.urandom(args.region_kb * 1024)
+                    s3.objects[("bench", key)] = data
+                    blob_bytes += len(data)
+                x, y = rng.random() * 0.8, rng.random() * 0.8
+                annotation_rows.append((
+                    document_id,
+                    rng.randint(1, args.pages),
+                    "region" if region else "text",
+                    db.pack_geometry([{"x": x, "y": y, "width": 0.1, "height": 0.05}]),
+                    words(rng, 8),
+                    f"region-{document_id}-{a}" if region else None,
+                    key,
+                    None,
+                ))
+            annotations = db.insert_rows("annotations", annotation_rows)
+            db.index_annotation_boxes([
+                (annotation_id, file_id, row[1], db.unpack_geometry(row[3]))
+                for annotation_id, row in zip(annotations, annotation_rows)
+            ])
+
+            # A document thread, a thread on an annotation and a fork of the first
+            parent = db.create_chat_thread(file_id=file_id, title="Document chat")
+            messages = add_messages(db, parent, document_id, rng, args.messages)
+            db.create_chat_thread(file_id=file_id, source_annotation_id=annotations[0], title="Highlight")
+            fork = db.create_chat_thread(
+                file_id=file_id, title="Fork",
+                parent_thread_id=parent, fork_message_id=messages[len(messages) // 2],
+            )
+            add_messages(db, fork, document_id, rng, args.messages // 2)
+        db.commit()
+        print(f"\r  populated {start + n}/{files} files", end="", flush=True)
+    print()
+    return blob_bytes
+
+
+def add_messages(db, thread_id, document_id, rng, count):
+    return db.save_messages_to_thread(thread_id, document_id, [
+        {"role": "user" if m % 2 == 0 else "assistant", "content": words(rng, 80)}
+        for m in range(count)
+    ])
+
+
+class PeakRSS:
+    """
+    Sample a process's resident memory while a block runs
+    """
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.peak_mb = 0.0
+        self._stop = threading.Event()
+
+    def _rss_mb(self) -> float:
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+        return 0.0
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_mb = max(self.peak_mb, self._rss_mb())
+            time.sleep(0.05)
+
+    def __enter__(self):
+        self.before_mb = self._rss_mb()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def export_to(client, path: str):
+    """
+    (seconds to first byte, total seconds, bytes)
+    """
+    start = time.perf_counter()
+    first = None
+    size = 0
+    with client.stream("GET", "/export") as response, open(path, "wb") as out:
+        if response.status_code != 200:
+            raise RuntimeError(f"/export returned {response.status_code}")
+        for chunk in response.iter_bytes(1024 * 1024):
+            if first is None:
+                first = time.perf_counter() - start
+            out.write(chunk)
+            size += len(chunk)
+    return first, time.perf_counter() - start, size
+
+
+def table_counts(workdir: str):
+    import sqlite3
+    conn = sqlite3.connect(os.path.join(workdir, "data.db"))
+    counts = {
+        table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        for table in ("folders", "files", "pages", "annotations", "chat_threads", "messages", "annotation_boxes")
+    }
+    conn.close()
+    return counts
+
+
+def fork_history(client, file_id: int):
+    threads = check(client.get("/chat/threads", params={"file_id": file_id}))["threads"]
+    fork = next(t for t in threads if t["title"] == "Fork")
+    messages = check(client.get(f"/chat/thread/{fork['id']}", params={"inherited": True}))["messages"]
+    return [m["content"] for m in messages]
+
+
+def run_server(workdir, openai, s3, env=None):
+    saved = dict(os.environ)
+    os.environ.update(env or {})
+    try:
+        port = free_port()
+        server = start_server(workdir, openai.base_url, s3.url, port, 1)
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+    return server, httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=3600)
+
+
+def stop(server, client):
+    client.close()
+    server.terminate()
+    server.wait(timeout=60)
+
+
+def build_library(workdir, s3, args, files, pdf_bytes):
+    # db.py opens data.db in the working directory; populate it in process
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+    import db
+    db.init_db()
+    blob_bytes = populate(db, s3, args, files, pdf_bytes)
+    db.get_connection().close()
+    db._local.conn = None
+    return blob_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--gb", type=float, default=10, help="library size in PDF bytes")
+    parser.add_argument("--pdf-mb", type=float, default=5)
+    parser.add_argument("--pages", type=int, default=40, help="pages per PDF")
+    parser.add_argument("--annotations", type=int, default=20, help="annotations per PDF")
+    parser.add_argument("--regions", type=int, default=2, help="region images per PDF")
+    parser.add_argument("--region-kb", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=20, help="messages per thread")
+    parser.add_argument("--s3-latency-ms", type=float, default=20, help="for the concurrency comparison")
+    parser.add_argument("--small-files", type=int, default=100, help="files in the concurrency comparison")
+    parser.add_argument("--store-dir", default=None, help="where the fake S3 keeps objects")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="bench_archive_", dir=args.store_dir)
+    failures = []
+    openai = FakeOpenAI().start()
+
+    try:
+        # 1. Sequential vs concurrent S3 pulls, on a small library with latency
+        s3 = FakeS3(latency=Latency(args.s3_latency_ms), store_dir=os.path.join(root, "s3-small")).start()
+        workdir = os.path.join(root, "small")
+        os.makedirs(workdir)
+        build_library(workdir, s3, args, args.small_files, 1024 * 1024)
+        for concurrency in (1, 8):
+            server, client = run_server(workdir, openai, s3, {"EXPORT_S3_CONCURRENCY": str(concurrency)})
+            try:
+                _, seconds, size = export_to(client, os.path.join(root, "small.zip"))
+            finally:
+                stop(server, client)
+            print(f"{args.small_files} files, S3 latency {args.s3_latency_ms:.0f} ms, "
+                  f"EXPORT_S3_CONCURRENCY={concurrency}: {seconds:.1f}s ({size / seconds / 1e6:.0f} MB/s)")
+        s3.stop()
+        shutil.rmtree(os.path.join(root, "s3-small"))
+
+        # 2. The full library
+        s3 = FakeS3(store_dir=os.path.join(root, "s3")).start()
+        files = max(1, round(args.gb * 1024 / args.pdf_mb))
+        source = os.path.join(root, "source")
+        os.makedirs(source)
+        start = time.perf_counter()
+        blob_bytes = build_library(source, s3, args, files, int(args.pdf_mb * 1024 * 1024))
+        print(f"library: {files} PDFs, {blob_bytes / 1e9:.1f} GB of blobs, built in {time.perf_counter() - start:.0f}s")
+        expected = table_counts(source)
+
+        archive = os.path.join(root, "library.zip")
+        server, client = run_server(source, openai, s3)
+        try:
+            with PeakRSS(server.pid) as rss:
+                first, seconds, size = export_to(client, archive)
+            print(f"export: {size / 1e9:.2f} GB in {seconds:.0f}s ({size / seconds / 1e6:.0f} MB/s), "
+                  f"first byte after {first * 1000:.0f} ms, server RSS {rss.before_mb:.0f} -> peak {rss.peak_mb:.0f} MB")
+            original_fork = fork_history(client, 1)
+        finally:
+            stop(server, client)
+
+        with zipfile.ZipFile(archive) as zf:
+            manifest = json.loads(zf.read("manifest.json"))
+            blobs = [n for n in zf.namelist() if n.startswith("blobs/")]
+            sample = zf.read(blobs[len(blobs) // 2])
+        print(f"archive: {len(blobs)} blobs, {manifest['counts']}")
+        if manifest["missing_blobs"]:
+            failures.append(f"{len(manifest['missing_blobs'])} blobs missing from the export")
+
+        target = os.path.join(root, "target")
+        os.makedirs(target)
+        server, client = run_server(target, openai, s3)
+        try:
+            with PeakRSS(server.pid) as rss, open(archive, "rb") as f:
+                start = time.perf_counter()
+                result = check(client.post("/import", files={"file": ("library.zip", f, "application/zip")}))
+                seconds = time.perf_counter() - start
+            print(f"import: {size / 1e9:.2f} GB in {seconds:.0f}s ({size / seconds / 1e6:.0f} MB/s), "
+                  f"server RSS {rss.before_mb:.0f} -> peak {rss.peak_mb:.0f} MB")
+            print(f"  imported {result['imported']}")
+
+            imported_fork = fork_history(client, 1)
+            if imported_fork != original_fork or not original_fork:
+                failures.append(f"forked thread history differs after import ({len(imported_fork)} vs {len(original_fork)} messages)")
+            else:
+                print(f"  forked thread history intact ({len(imported_fork)} messages)")
+        finally:
+            stop(server, client)
+
+        got = table_counts(target)
+        if got != expected:
+            failures.append(f"row counts differ: {got} vs {expected}")
+
+        # The sampled blob came back byte for byte under its new key
+        digest = hashlib.sha256(sample).hexdigest()
+        if not any(
+            key[1].endswith(blobs[len(blobs) // 2][len("blobs/"):]) and "/imports/" in key[1]
+            and hashlib.sha256(s3.objects.get(key)).hexdigest() == digest
+            for key in list(s3.objects.keys())
+        ):
+            failures.append("sampled blob not found after import")
+        s3.stop()
+    finally:
+        openai.stop()
+        shutil.rmtree(root, ignore_errors=True)
+
+    if failures:
+        print("FAILED:")
+        for f in failures:
+            print(f"  {f}")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+# Benchmark list_files against the pre-denormalization query at library scale.
+# bench/bench_list_files.py
+#
+# Usage: python bench/bench_list_files.py --files 100000
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The query list_files used before parent_file_id was stored on files
+LEGACY_LIST_FILES_SQL = """
+SELECT
+    f.id,
+    f.folder_id,
+    f.title,
+    f.s3_key,
+    f.created_at,
+    pf.id AS parent_file_id
+FROM files f
+LEFT JOIN chat_threads ct
+    ON ct.file_id = f.id
+    AND ct.source_annotation_id IS NOT NULL
+    AND f.s3_key IS NULL
+LEFT JOIN annotations a ON a.id = ct.source_annotation_id
+LEFT JOIN files pf ON pf.document_id = a.document_id
+WHERE f.user_id = ?
+ORDER BY f.created_at DESC
+"""
+
+
+def populate(db, n_files: int, chat_ratio: float, n_folders: int):
+    cur = db.get_cursor()
+    rng = random.Random(42)
+
+    folder_ids = [db.create_folder(f"folder {i}", 1) for i in range(n_folders)]
+
+    pdf_ids = []
+    for i in range(n_files):
+        folder_id = rng.choice(folder_ids)
+        created_at = f"2025-{1 + i * 12 // n_files:02d}-01 00:00:{i % 60:02d}"
+
+        if pdf_ids and rng.random() < chat_ratio:
+            # Child chat spawned from a highlight in an existing PDF
+            parent_id, parent_doc = rng.choice(pdf_ids)
+            annotation_id = db.create_annotation(parent_doc, 1, "text", None, text="x")
+            chat = db.create_standalone_chat(
+                user_id=1,
+                folder_id=folder_id,
+                title=f"chat {i}",
+                source_annotation_id=annotation_id,
+            )
+            cur.execute("UPDATE files SET created_at = ? WHERE id = ?", (created_at, chat["file_id"]))
+        else:
+            document_id = f"doc-{i}"
+            file_id = db.create_file(folder_id, document_id, f"file {i}", 1)
+            cur.execute(
+                "UPDATE files SET s3_key = ?, created_at = ? WHERE id = ?",
+                (f"users/user_1/files/{file_id}.pdf", created_at, file_id),
+            )
+            db.create_chat_thread(file_id=file_id, title=f"file {i}")
+            pdf_ids.append((file_id, document_id))
+
+    db.commit()
+    return folder_ids
+
+
+def timed(fn, repeat: int):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=100_000)
+    parser.add_argument("--chat-ratio", type=float, default=0.3)
+    parser.add_argument("--folders", type=int, default=200)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_list_files_")
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+    import db
+    db.init_db()
+
+    start = time.perf_counter()
+    folder_ids = populate(db, args.files, args.chat_ratio, args.folders)
+    print(f"populated {args.files} files in {time.perf_counter() - start:.1f}s ({workdir})")
+
+    cur = db.get_cursor()
+
+    def legacy():
+        cur.execute(LEGACY_LIST_FILES_SQL, (1,))
+        return cur.fetchall()
+
+    ms, rows = timed(legacy, args.repeat)
+    print(f"legacy full listing:      {ms:8.1f} ms  ({len(rows)} rows)")
+
+    ms, (files, _) = timed(lambda: db.list_files(user_id=1), args.repeat)
+    print(f"list_files full listing:  {ms:8.1f} ms  ({len(files)} rows)")
+
+    legacy_parents = {r[0]: r[5] for r in rows}
+    assert legacy_parents == {f["id"]: f["parent_file_id"] for f in files}, "parent_file_id mismatch"
+
+    ms, (files, next_cursor) = timed(
+        lambda: db.list_files(user_id=1, limit=args.page_size), args.repeat
+    )
+    print(f"first page ({args.page_size}):         {ms:8.1f} ms")
+
+    # Walk to the middle of the library and time a deep page
+    cursor = next_cursor
+    for _ in range(args.files // args.page_size // 2):
+        _, cursor = db.list_files(user_id=1, limit=args.page_size, cursor=cursor)
+    ms, _ = timed(
+        lambda: db.list_files(user_id=1, limit=args.page_size, cursor=cursor), args.repeat
+    )
+    print(f"middle page ({args.page_size}):        {ms:8.1f} ms")
+
+    ms, (files, _) = timed(
+        lambda: db.list_files(user_id=1, folder_id=folder_ids[0], limit=args.page_size),
+        args.repeat,
+    )
+    print(f"folder page ({args.page_size}):        {ms:8.1f} ms  ({len(files)} rows)")
+
+
+if __name__ == "__main__":
+    main()
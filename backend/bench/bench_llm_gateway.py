@@ -0,0 +1,176 @@
+# Exercises the LLM gateway in llm.py against FakeOpenAI with injected 429s,
+# latency and outages.
+# bench/bench_llm_gateway.py
+#
+# Checks that, with the gateway in front of a flaky API:
+#   burst     every call succeeds despite 429s, and no more than
+#             LLM_MAX_CONCURRENCY calls are ever upstream at once
+#   bucket    a drained token bucket admits at its configured rate
+#   outage    the breaker opens, then fails fast, then closes on recovery
+#   deadline  a slow upstream is cut off at the caller's deadline
+#
+#   python bench/bench_llm_gateway.py --calls 200 --error-rate 0.3
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fakes import FakeOpenAI, Latency
+from run_bench import BACKEND_DIR, percentile
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--error-rate", type=float, default=0.3, help="share of calls answered with 429")
+    parser.add_argument("--latency-ms", type=float, default=100)
+    parser.add_argument("--jitter-ms", type=float, default=50)
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(
+        latency=Latency(args.latency_ms, args.jitter_ms),
+        error_rate=args.error_rate,
+        retry_after_ms=50,
+    ).start()
+
+    # llm.py reads its limits at import
+    os.environ.update({
+        "OPENAI_BASE_URL": fake.base_url,
+        "OPENAI_API_KEY": "bench",
+        "LLM_MAX_CONCURRENCY": str(args.max_concurrency),
+        "LLM_MAX_RETRIES": "6",
+        "LLM_BREAKER_FAILURES": "5",
+        "LLM_BREAKER_RESET_S": "1",
+        "LLM_COALESCE": "0",
+        # High enough not to throttle the burst; the bucket is checked directly
+        "LLM_RPM": "10000",
+        "LLM_TPM": "10000000",
+    })
+    sys.path.insert(0, BACKEND_DIR)
+    import llm
+    from metrics import registry
+
+    failures = []
+
+    def ask(i, **kwargs):
+        return llm.create_response(
+            model="gpt-4.1-mini",
+            input=[{"role": "user", "content": f"question {i}"}],
+            **kwargs,
+        )
+
+    # --------------------------------------------------
+    # burst: 429s absorbed by retries, concurrency bounded
+    # --------------------------------------------------
+    latencies = []
+    errors = []
+
+    def timed(i):
+        start = time.perf_counter()
+        try:
+            ask(i)
+            latencies.append((time.perf_counter() - start) * 1000)
+        except Exception as e:
+            errors.append(repr(e))
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        list(pool.map(timed, range(args.calls)))
+    wall = time.perf_counter() - wall_start
+
+    retries = sum(
+        v for (name, _), v in registry.counters.items() if name == "llm_retries_total"
+    )
+    print(
+        f"burst     {len(latencies)}/{args.calls} ok, {int(retries)} retries, "
+        f"{fake.errors} injected errors, max {fake.max_in_flight} upstream at once, "
+        f"p50={percentile(latencies, 50):.0f}ms p95={percentile(latencies, 95):.0f}ms, "
+        f"{len(latencies) / wall:.1f} calls/s"
+    )
+    if errors:
+        failures.append(f"burst: {len(errors)} calls failed, e.g. {errors[0]}")
+    if fake.max_in_flight > args.max_concurrency:
+        failures.append(f"burst: {fake.max_in_flight} concurrent upstream calls > {args.max_concurrency}")
+
+    # --------------------------------------------------
+    # bucket: a drained 600/min bucket admits ~10/s
+    # --------------------------------------------------
+    bucket = llm.TokenBucket(600)
+    bucket.acquire(600, time.monotonic() + 1)
+    start = time.monotonic()
+    for _ in range(10):
+        bucket.acquire(1, time.monotonic() + 5)
+    elapsed = time.monotonic() - start
+    print(f"bucket    10 acquisitions at 600/min took {elapsed:.2f}s (expect ~1.0s)")
+    if not 0.8 <= elapsed <= 1.5:
+        failures.append(f"bucket: 10 acquisitions took {elapsed:.2f}s")
+
+    # --------------------------------------------------
+    # outage: breaker opens, fails fast, recovers
+    # --------------------------------------------------
+    fake.error_rate = 0.0
+    fake.outage = True
+    calls_before = fake.calls
+
+    outcome = None
+    try:
+        ask("outage")
+    except llm.LLMUnavailable as e:
+        outcome = str(e)
+    print(f"outage    first call: {outcome!r} after {fake.calls - calls_before} upstream attempts, breaker {llm.breaker.state()}")
+    if llm.breaker.state() != "open":
+        failures.append(f"outage: breaker is {llm.breaker.state()}, expected open")
+
+    calls_before = fake.calls
+    start = time.perf_counter()
+    try:
+        ask("while open")
+        failures.append("outage: call succeeded while breaker open")
+    except llm.LLMUnavailable:
+        pass
+    fast_ms = (time.perf_counter() - start) * 1000
+    print(f"outage    while open: rejected in {fast_ms:.1f}ms with {fake.calls - calls_before} upstream calls")
+    if fake.calls != calls_before or fast_ms > 50:
+        failures.append("outage: open breaker did not fail fast")
+
+    fake.outage = False
+    time.sleep(1.1)
+    try:
+        ask("recovered")
+    except Exception as e:
+        failures.append(f"outage: trial call after recovery failed: {e!r}")
+    print(f"outage    after recovery: breaker {llm.breaker.state()}")
+    if llm.breaker.state() != "closed":
+        failures.append(f"outage: breaker is {llm.breaker.state()} after recovery")
+
+    # --------------------------------------------------
+    # deadline: slow upstream cut off at the caller's deadline
+    # --------------------------------------------------
+    fake.latency = Latency(3000)
+    start = time.perf_counter()
+    try:
+        ask("slow", deadline_s=0.5)
+        failures.append("deadline: slow call returned")
+    except llm.LLMUnavailable:
+        pass
+    elapsed = time.perf_counter() - start
+    print(f"deadline  0.5s deadline against a 3s upstream gave up after {elapsed:.2f}s")
+    if elapsed > 1.0:
+        failures.append(f"deadline: took {elapsed:.2f}s")
+
+    fake.stop()
+
+    if failures:
+        print("FAILED:")
+        for f in failures:
+            print(f"  {f}")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
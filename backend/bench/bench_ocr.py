@@ -0,0 +1,115 @@
+# OCR ingestion benchmark: scanned (image-only) PDF pages through ocr.py's
+# process pool at 1..N workers, reporting throughput per core.
+# bench/bench_ocr.py
+#
+# Builds a scan by rendering the synthetic lecture PDF to images, then checks
+# that every page is detected as text-less, that content hashes separate
+# pages (and match for identical ones), that OCR recovers the words of the
+# original text layer, and that a second run is served from the cache.
+# Needs Tesseract with English language data; without it only the detection
+# checks run.
+#
+#   python bench/bench_ocr.py --pages 16 --workers 1,2,4
+import argparse
+import os
+import sys
+import time
+
+from run_bench import BACKEND_DIR, make_pdf
+
+
+def make_scan(pages: int, dpi: int, seed: int = 0):
+    """
+    Image-only PDF of the synthetic PDF's pages rendered to pixmaps, with
+    the first page repeated at the end as duplicated scans do. Returns
+    (PDF bytes, original page texts).
+    """
+    import fitz
+
+    source = fitz.open(stream=make_pdf(pages, seed=seed), filetype="pdf")
+    scan = fitz.open()
+    for number in list(range(source.page_count)) + [0]:
+        page = source[number]
+        pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+        out = scan.new_page(width=page.rect.width, height=page.rect.height)
+        out.insert_image(out.rect, stream=pix.tobytes("png"))
+    return scan.tobytes(garbage=3, deflate=True), [p.get_text() for p in source]
+
+
+def word_recall(expected: str, got: str) -> float:
+    words = expected.lower().split()
+    found = set(got.lower().split())
+    return sum(w in found for w in words) / len(words) if words else 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=16)
+    parser.add_argument("--workers", default="1,2,4", help="worker counts to try")
+    parser.add_argument("--scan-dpi", type=int, default=200)
+    parser.add_argument("--min-recall", type=float, default=0.9)
+    args = parser.parse_args()
+
+    sys.path.insert(0, BACKEND_DIR)
+    import fitz
+    import ocr
+
+    scan_bytes, originals = make_scan(args.pages, args.scan_dpi)
+    failures = []
+
+    doc = fitz.open(stream=scan_bytes, filetype="pdf")
+    start = time.perf_counter()
+    candidates = {}
+    for page in doc:
+        if ocr.needs_ocr(page, page.get_text()):
+            candidates[page.number + 1] = ocr.page_content_hash(page)
+    detect_ms = (time.perf_counter() - start) * 1000
+    print(f"scan: {doc.page_count} pages, {len(scan_bytes) / 1024:.0f} KiB; detection + hashing {detect_ms:.1f} ms")
+
+    if len(candidates) != doc.page_count:
+        failures.append(f"{doc.page_count - len(candidates)} scanned pages not detected")
+    if candidates.get(1) != candidates.get(doc.page_count):
+        failures.append("identical pages hashed differently")
+    if len(set(candidates.values())) != doc.page_count - 1:
+        failures.append("different pages share a content hash")
+
+    try:
+        fitz.get_tessdata()
+        have_tesseract = True
+    except RuntimeError as e:
+        have_tesseract = False
+        print(f"SKIPPED OCR runs: {e}")
+
+    if have_tesseract:
+        cpus = os.cpu_count() or 1
+        for workers in [int(w) for w in args.workers.split(",")]:
+            ocr.shutdown_pool()
+            ocr.OCR_WORKERS = workers
+            # Start the workers outside the timed run
+            ocr.get_pool().submit(len, b"").result()
+
+            texts, new_entries, stats = ocr.run_ocr(scan_bytes, candidates, {})
+            note = f" (only {cpus} CPUs)" if workers > cpus else ""
+            print(f"workers={workers}: {ocr.throughput(stats)}{note}")
+
+            recall = min(word_recall(originals[n - 1], texts[n]) for n in range(1, args.pages + 1))
+            if recall < args.min_recall:
+                failures.append(f"workers={workers}: worst page word recall {recall:.0%}")
+
+        _, again, stats = ocr.run_ocr(scan_bytes, candidates, new_entries)
+        print(f"second run: {ocr.throughput(stats)}")
+        if again or stats["cached"] != len(candidates):
+            failures.append("second run was not served from the cache")
+        ocr.shutdown_pool()
+
+    if failures:
+        print("FAILED:")
+        for f in failures:
+            print(f"  {f}")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+# Benchmark POST /files/{id}/replace: a long PDF revised in a few pages
+# against uploading the changed pages alone and the whole PDF again.
+# bench/bench_replace_file.py
+#
+# Also checks what a revision keeps: annotations stay on their page and
+# follow it when a slide is inserted before it (edited pages too), changed
+# pages get their new text, and pages that are gone lose their annotations.
+#
+#   python bench/bench_replace_file.py --pages 300 --changed 3
+import argparse
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+import fitz
+import httpx
+
+from fakes import FakeOpenAI, FakeS3, Latency
+from run_bench import check, free_port, make_pdf, start_server
+
+
+def revise(pdf_bytes: bytes, changed_pages, insert_at=None, delete_page=None) -> bytes:
+    """
+    Copy of the PDF with a note added to changed_pages (1-based, before any
+    insert/delete), optionally a new slide inserted at insert_at and a page
+    deleted
+    """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    for number in changed_pages:
+        doc[number - 1].insert_text((72, 800), f"Revised: page {number}", fontsize=9)
+    if delete_page:
+        doc.delete_page(delete_page - 1)
+    if insert_at:
+        page = doc.new_page(pno=insert_at - 1)
+        page.insert_text((72, 60), "New slide", fontsize=16)
+    data = doc.tobytes(garbage=3, deflate=True)
+    doc.close()
+    return data
+
+
+def timed_post(client, path, files, repeat):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = check(client.post(path, files=files()))
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--changed", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--s3-latency-ms", type=float, default=20)
+    args = parser.parse_args()
+
+    openai = FakeOpenAI(latency=Latency(50)).start()
+    s3 = FakeS3(latency=Latency(args.s3_latency_ms)).start()
+    workdir = tempfile.mkdtemp(prefix="bench_replace_")
+    port = free_port()
+    server = start_server(workdir, openai.base_url, s3.url, port, 1)
+    client = httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=300)
+
+    failures = []
+    try:
+        original = make_pdf(args.pages, seed=1)
+        step = max(1, args.pages // (args.changed + 1))
+        changed = [step * (i + 1) for i in range(args.changed)]
+        small = make_pdf(args.changed, seed=2)
+
+        def pdf_file(data, name="lecture.pdf"):
+            return lambda: {"file": (name, data, "application/pdf")}
+
+        upload_small_ms, _ = timed_post(client, "/upload", pdf_file(small), args.repeat)
+        upload_full_ms, uploaded = timed_post(client, "/upload", pdf_file(original), args.repeat)
+        file_id = uploaded["file_id"]
+
+        # Alternate between two revisions so every replace has work to do
+        revisions = [revise(original, changed), original]
+        replace_samples = []
+        for i in range(args.repeat * 2):
+            start = time.perf_counter()
+            result = check(client.post(f"/files/{file_id}/replace", files=pdf_file(revisions[i % 2])()))
+            replace_samples.append((time.perf_counter() - start) * 1000)
+            if result["extracted"] != len(changed):
+                failures.append(f"replace extracted {result['extracted']} pages, expected {len(changed)}")
+        replace_ms = statistics.median(replace_samples)
+
+        print(f"{args.pages}-page PDF, {len(changed)} changed pages (S3 latency {args.s3_latency_ms:.0f} ms)")
+        print(f"upload {args.changed} pages:       {upload_small_ms:8.1f} ms")
+        print(f"upload {args.pages} pages:     {upload_full_ms:8.1f} ms")
+        print(f"replace, {len(changed)} changed:     {replace_ms:8.1f} ms")
+
+        # --------------------------------------------------
+        # What survives a revision
+        # --------------------------------------------------
+        def annotate(page_number):
+            return check(client.post("/annotations", json={
+                "file_id": file_id,
+                "page_number": page_number,
+                "type": "text",
+                "geometry": {"x": 0.1, "y": 0.1, "width": 0.3, "height": 0.02},
+                "text": f"note on page {page_number}",
+            }))["annotation_id"]
+
+        unchanged_page, changed_page, deleted_page = 5, changed[0], args.pages - 1
+        kept = annotate(unchanged_page)
+        on_changed = annotate(changed_page)
+        on_deleted = annotate(deleted_page)
+
+        # Insert a slide at 2 and delete one near the end: pages in between shift by one
+        revision = revise(original, [changed_page], insert_at=2, delete_page=deleted_page)
+        result = check(client.post(f"/files/{file_id}/replace", files=pdf_file(revision)()))
+        print(f"insert + delete + 1 change: {result}")
+
+        annotations = {
+            a["id"]: a["page_number"]
+            for a in check(client.get(f"/annotations/file/{file_id}"))["annotations"]
+        }
+        if annotations.get(kept) != unchanged_page + 1:
+            failures.append(f"annotation on unchanged page {unchanged_page} is on {annotations.get(kept)}")
+        if annotations.get(on_changed) != changed_page + 1:
+            failures.append(f"annotation on edited page {changed_page} is on {annotations.get(on_changed)}")
+        if on_deleted in annotations:
+            failures.append("annotation on a deleted page was kept")
+
+        db = sqlite3.connect(os.path.join(workdir, "data.db"))
+        document_id, = db.execute("SELECT document_id FROM files WHERE id = ?", (file_id,)).fetchone()
+        texts = dict(db.execute("SELECT page_number, text FROM pages WHERE document_id = ?", (document_id,)))
+        expected = fitz.open(stream=revision, filetype="pdf")
+        wrong = [
+            n for n in range(1, expected.page_count + 1)
+            if texts.get(n) != expected[n - 1].get_text()
+        ]
+        if len(texts) != expected.page_count or wrong:
+            failures.append(f"{len(texts)} stored pages for {expected.page_count}; wrong text on {wrong[:5]}")
+        boxes = db.execute(
+            "SELECT page_min FROM annotation_boxes WHERE id = ?", (kept,)
+        ).fetchone()
+        if not boxes or boxes[0] != unchanged_page + 1:
+            failures.append(f"spatial index still has the moved annotation on {boxes}")
+        db.close()
+    finally:
+        client.close()
+        server.terminate()
+        server.wait(timeout=30)
+        openai.stop()
+        s3.stop()
+
+    if failures:
+        print("FAILED:")
+        for f in failures:
+            print(f"  {f}")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
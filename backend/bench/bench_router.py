@@ -0,0 +1,174 @@
+# Benchmark the /ask query router: classification of a labelled question set,
+# then per-route latency, prompt tokens and estimated cost against sending
+# every question the full text on the default model (the old behaviour).
+# bench/bench_router.py
+#
+# Reads the per-route numbers back from /metrics, as they would be read to
+# tune the routes.
+#
+#   python bench/bench_router.py --pages 100 --questions 10
+import argparse
+import re
+import sys
+import tempfile
+import time
+
+import httpx
+
+from fakes import FakeOpenAI, FakeS3, Latency
+from run_bench import BACKEND_DIR, check, free_port, make_pdf, start_server
+
+# (question, has history, expected route)
+LABELLED = [
+    ("What is gradient descent?", False, "definition"),
+    ("define entropy", False, "definition"),
+    ("What does SGD stand for?", False, "definition"),
+    ("What's a softmax?", True, "definition"),
+    ("meaning of variance", False, "definition"),
+    ("Explain the derivation on page 12", False, "page"),
+    ("What's on slides 3-5?", False, "page"),
+    ("Can you walk me through p. 7?", True, "page"),
+    ("Summarize this lecture", False, "overview"),
+    ("What are the main ideas?", True, "overview"),
+    ("What is this document about?", False, "overview"),
+    ("Give me a quick overview", False, "overview"),
+    ("why?", True, "followup"),
+    ("Can you give an example?", True, "followup"),
+    ("What is it?", True, "followup"),
+    ("and for the second case?", True, "followup"),
+    ("I still don't get it", True, "followup"),
+    ("How does backpropagation compute gradients through the layers?", True, "document"),
+    ("What is the difference between bias and variance and why does it matter here?", False, "document"),
+    ("Which loss function is used for classification?", False, "document"),
+    ("What is it?", False, "document"),
+    ("why?", False, "document"),
+]
+
+ASKED = {
+    "definition": "What is backpropagation?",
+    "page": "Explain page 12",
+    "overview": "Summarize this lecture",
+    "followup": "Can you give an example?",
+    "document": "How do the loss function and the learning rate interact?",
+}
+
+_METRIC = re.compile(r'^(\w+)\{([^}]*)\} ([0-9.e+-]+)$')
+
+
+def read_metrics(text: str):
+    """
+    {(name, frozenset(labels)): value} for the ask_route_* series
+    """
+    values = {}
+    for line in text.splitlines():
+        match = _METRIC.match(line)
+        if match and match.group(1).startswith("ask_route_"):
+            labels = frozenset(re.findall(r'(\w+)="([^"]*)"', match.group(2)))
+            values[(match.group(1), labels)] = float(match.group(3))
+    return values
+
+
+def per_route(values):
+    routes = {}
+    for (name, labels), value in values.items():
+        labels = dict(labels)
+        r = routes.setdefault(labels["route"], {"count": 0, "seconds": 0.0, "input": 0, "cost": 0.0, "contexts": set(), "models": set()})
+        if name == "ask_route_total":
+            r["count"] += value
+            r["contexts"].add(labels["context"])
+            r["models"].add(labels["model"])
+        elif name == "ask_route_seconds_sum":
+            r["seconds"] += value
+        elif name == "ask_route_tokens_total" and labels["direction"] == "input":
+            r["input"] += value
+        elif name == "ask_route_cost_usd_total":
+            r["cost"] += value
+    return routes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--questions", type=int, default=10, help="questions asked per route")
+    parser.add_argument("--llm-latency-ms", type=float, default=50)
+    args = parser.parse_args()
+
+    sys.path.insert(0, BACKEND_DIR)
+    import router
+
+    failures = []
+    start = time.perf_counter()
+    for question, has_history, expected in LABELLED:
+        got = router.classify(question, has_history)["route"]
+        if got != expected:
+            failures.append(f"{question!r} (history={has_history}) routed to {got}, expected {expected}")
+    classify_us = (time.perf_counter() - start) / len(LABELLED) * 1e6
+    print(f"classification: {len(LABELLED) - len(failures)}/{len(LABELLED)} as labelled, {classify_us:.0f} us per question")
+
+    openai = FakeOpenAI(latency=Latency(args.llm_latency_ms)).start()
+    s3 = FakeS3().start()
+    workdir = tempfile.mkdtemp(prefix="bench_router_")
+    port = free_port()
+    server = start_server(workdir, openai.base_url, s3.url, port, 1)
+    client = httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=300)
+
+    try:
+        file_id = check(client.post(
+            "/upload", files={"file": ("lecture.pdf", make_pdf(args.pages, seed=1), "application/pdf")}
+        ))["file_id"]
+        deadline = time.time() + 300
+        while not check(client.get(f"/files/{file_id}/summary"))["ready"]:
+            if time.time() > deadline:
+                raise RuntimeError("summaries were not built in time")
+            time.sleep(0.1)
+
+        thread_id = check(client.get(f"/files/{file_id}/state"))["active_thread_id"]
+        # Give follow-ups some history
+        check(client.post("/ask", json={"file_id": file_id, "chat_thread_id": thread_id, "question": ASKED["document"]}))
+
+        before = read_metrics(client.get("/metrics").text)
+        for route, question in ASKED.items():
+            for _ in range(args.questions):
+                check(client.post("/ask", json={
+                    "file_id": file_id, "chat_thread_id": thread_id, "question": question,
+                }))
+        after = read_metrics(client.get("/metrics").text)
+    finally:
+        client.close()
+        server.terminate()
+        server.wait(timeout=30)
+        openai.stop()
+        s3.stop()
+
+    delta = {key: value - before.get(key, 0.0) for key, value in after.items()}
+    routes = per_route(delta)
+
+    baseline = routes.get("document")
+    print(f"{args.pages}-page PDF, {args.questions} questions per route, fake LLM latency {args.llm_latency_ms:.0f} ms")
+    print(f"{'route':<12}{'context':<12}{'model':<15}{'latency':>10}{'input tok':>12}{'cost/q':>12}{'vs document':>13}")
+    for route in ASKED:
+        r = routes.get(route)
+        if not r or not r["count"]:
+            failures.append(f"no {route} questions recorded")
+            continue
+        cost = r["cost"] / r["count"]
+        ratio = f"{baseline['cost'] / baseline['count'] / cost:.0f}x less" if baseline and cost and route != "document" else ""
+        print(
+            f"{route:<12}{','.join(sorted(r['contexts'])):<12}{','.join(sorted(r['models'])):<15}"
+            f"{r['seconds'] / r['count'] * 1000:>8.0f}ms{r['input'] / r['count']:>12,.0f}"
+            f"{cost:>12.6f}{ratio:>13}"
+        )
+        if route != "document" and "full_text" in r["contexts"]:
+            failures.append(f"{route} questions fell back to the full text")
+
+    if failures:
+        print("FAILED:")
+        for f in failures:
+            print(f"  {f}")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+# Benchmark the summary tree: how long building it takes at a few levels of
+# concurrency, and how much smaller an overview question's prompt gets.
+# bench/bench_summaries.py
+#
+# Uploads a synthetic PDF against the fake OpenAI server, waits for its
+# summaries, then asks an overview question and a detail question and
+# compares the prompt sizes the fake received. Also checks that a revision
+# with a few edited pages only summarizes those pages, their sections and
+# the document again.
+#
+#   python bench/bench_summaries.py --pages 100 --concurrency 1,4,8
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+import fitz
+import httpx
+
+from fakes import FakeOpenAI, FakeS3, Latency
+from run_bench import check, free_port, make_pdf, start_server
+
+
+def wait_for_summary(client, file_id, previous=None, timeout=600):
+    """
+    Seconds until /files/{id}/summary is ready (and differs from previous)
+    """
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        summary = check(client.get(f"/files/{file_id}/summary"))
+        if summary["ready"] and summary != previous:
+            return time.perf_counter() - start, summary
+        time.sleep(0.05)
+    raise RuntimeError("summary was not built in time")
+
+
+def fake_summary(payload) -> str:
+    # Depends on the input, so edited pages change their section's summary
+    digest = hashlib.sha256(json.dumps(payload.get("input")).encode("utf-8")).hexdigest()
+    return f"Fake summary {digest[:12]}: the page introduces a few terms and an example."
+
+
+def revise(pdf_bytes: bytes, changed_pages) -> bytes:
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    for number in changed_pages:
+        doc[number - 1].insert_text((72, 800), f"Revised: page {number}", fontsize=9)
+    data = doc.tobytes(garbage=3, deflate=True)
+    doc.close()
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--concurrency", default="1,4,8", help="SUMMARY_CONCURRENCY values to try")
+    parser.add_argument("--llm-latency-ms", type=float, default=100)
+    parser.add_argument("--section-pages", type=int, default=10)
+    args = parser.parse_args()
+
+    pdf = make_pdf(args.pages, seed=1)
+    sections = -(-args.pages // args.section_pages)
+    failures = []
+
+    for i, concurrency in enumerate(int(c) for c in args.concurrency.split(",")):
+        openai = FakeOpenAI(latency=Latency(args.llm_latency_ms), answer_text=fake_summary).start()
+        s3 = FakeS3().start()
+        os.environ["SUMMARY_CONCURRENCY"] = str(concurrency)
+        os.environ["SUMMARY_SECTION_PAGES"] = str(args.section_pages)
+        workdir = tempfile.mkdtemp(prefix="bench_summaries_")
+        port = free_port()
+        server = start_server(workdir, openai.base_url, s3.url, port, 1)
+        client = httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=300)
+
+        try:
+            file_id = check(client.post(
+                "/upload", files={"file": ("lecture.pdf", pdf, "application/pdf")}
+            ))["file_id"]
+            seconds, summary = wait_for_summary(client, file_id)
+            calls = openai.calls
+            print(
+                f"concurrency={concurrency}: {args.pages} pages summarized in {seconds:.1f}s, "
+                f"{calls} LLM calls, at most {openai.max_in_flight} in flight"
+            )
+            if openai.max_in_flight > concurrency:
+                failures.append(f"concurrency={concurrency}: {openai.max_in_flight} calls in flight")
+            if len(summary["sections"]) != sections:
+                failures.append(f"{len(summary['sections'])} sections, expected {sections}")
+
+            if i > 0:
+                continue
+
+            # Prompt sizes: overview question (summary tree) vs a detail question (full text)
+            thread_id = check(client.get(f"/files/{file_id}/state"))["active_thread_id"]
+            sizes = {}
+            for name, question in [
+                ("overview", "Can you summarize this lecture?"),
+                ("detail", "What does page 12 say about gradients?"),
+            ]:
+                before = len(openai.prompt_chars)
+                start = time.perf_counter()
+                check(client.post("/ask", json={
+                    "file_id": file_id, "chat_thread_id": thread_id, "question": question,
+                }))
+                sizes[name] = openai.prompt_chars[before]
+                print(f"  {name:<9} prompt {sizes[name]:>9,} chars, /ask {(time.perf_counter() - start) * 1000:.0f} ms")
+            print(f"  overview prompt is {sizes['detail'] / sizes['overview']:.0f}x smaller")
+            if sizes["overview"] * 10 > sizes["detail"]:
+                failures.append("overview question was not answered from the summary tree")
+
+            # A revision with 3 edited pages in 2 sections
+            changed = [2, 3, args.pages // 2]
+            calls = openai.calls
+            check(client.post(
+                f"/files/{file_id}/replace",
+                files={"file": ("lecture.pdf", revise(pdf, changed), "application/pdf")},
+            ))
+            seconds, summary = wait_for_summary(client, file_id, previous=summary)
+            redone = openai.calls - calls
+            print(f"  revision with {len(changed)} edited pages: {redone} LLM calls, {seconds:.1f}s")
+            if redone != len(changed) + 2 + 1:
+                failures.append(f"revision made {redone} summary calls, expected {len(changed) + 3}")
+        finally:
+            client.close()
+            server.terminate()
+            server.wait(timeout=30)
+            openai.stop()
+            s3.stop()
+
+    if failures:
+        print("FAILED:")
+        for f in failures:
+            print(f"  {f}")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+# Benchmark forked chat threads: history reads through a chain of forks
+# against the old full-thread read, and the storage a fork saves over
+# copying its parent's messages.
+# bench/bench_thread_fork.py
+#
+# Builds a messages table with many threads, then a chain of forks off one
+# long thread, and checks each fork sees exactly its parents' messages up
+# to the fork points followed by its own.
+#
+#   python bench/bench_thread_fork.py --threads 20000 --messages 50 --depth 8
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# build_thread_history before forks: every message of the thread, sliced in
+# Python; messages had no index on chat_thread_id
+LEGACY_HISTORY_SQL = """
+SELECT id, role, content, annotation_id, reference
+FROM messages NOT INDEXED
+WHERE chat_thread_id = ?
+ORDER BY created_at ASC
+"""
+
+
+def timed(fn, repeat: int):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), result
+
+
+def add_messages(db, thread_id: int, count: int, rng, label: str):
+    return db.save_messages_to_thread(thread_id, "doc-bench", [
+        {
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": f"{label} message {i}: " + " ".join(rng.choice(WORDS) for _ in range(60)),
+        }
+        for i in range(count)
+    ])
+
+
+WORDS = "gradient loss layer weight bias entropy softmax kernel tensor batch epoch".split()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=20_000, help="other threads in the table")
+    parser.add_argument("--messages", type=int, default=50, help="messages per thread")
+    parser.add_argument("--depth", type=int, default=8, help="forks in the chain")
+    parser.add_argument("--history", type=int, default=20, help="messages sent with a question")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_thread_fork_")
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+    import db
+    db.init_db()
+    cur = db.get_cursor()
+    rng = random.Random(42)
+    failures = []
+
+    file_id = db.create_file(None, "doc-bench", "bench", 1)
+    start = time.perf_counter()
+    for _ in range(args.threads):
+        add_messages(db, db.create_chat_thread(file_id=file_id), args.messages, rng, "other")
+    db.commit()
+    print(f"{args.threads * args.messages:,} messages in {args.threads:,} threads "
+          f"in {time.perf_counter() - start:.1f}s ({workdir})")
+
+    # A chain of forks, each at a random message of its parent's history,
+    # with its own messages after that
+    chain = [db.create_chat_thread(file_id=file_id)]
+    expected = {chain[0]: add_messages(db, chain[0], args.messages, rng, "root")}
+    for level in range(args.depth):
+        parent = chain[-1]
+        fork_at = rng.choice(expected[parent])
+        owner, fork_message_id = db.get_fork_point(parent, fork_at)
+        thread_id = db.create_chat_thread(
+            file_id=file_id, parent_thread_id=owner, fork_message_id=fork_message_id,
+        )
+        inherited = expected[parent][:expected[parent].index(fork_at) + 1]
+        expected[thread_id] = inherited + add_messages(db, thread_id, args.messages, rng, f"fork {level}")
+        chain.append(thread_id)
+    db.commit()
+
+    for thread_id in chain:
+        got = [m["id"] for m in db.get_thread_history(thread_id)]
+        if got != expected[thread_id]:
+            failures.append(f"thread {thread_id}: history differs ({len(got)} vs {len(expected[thread_id])} messages)")
+        got = [m["id"] for m in db.get_thread_history(thread_id, limit=args.history, exclude_message_id=expected[thread_id][-1])]
+        if got != expected[thread_id][-args.history - 1:-1]:
+            failures.append(f"thread {thread_id}: last {args.history} messages differ")
+
+    leaf = chain[-1]
+    inherited = len(expected[leaf]) - args.messages
+    print(f"fork chain of depth {args.depth}: the last fork sees {len(expected[leaf])} messages, "
+          f"{inherited} inherited")
+
+    # Storage: what copying each fork's inherited messages would have taken
+    copied = 0
+    for thread_id in chain[1:]:
+        n = len(expected[thread_id]) - args.messages
+        cur.execute(
+            "SELECT SUM(LENGTH(content)) + COUNT(*) * 40 FROM messages WHERE id IN (%s)"
+            % ",".join(str(i) for i in expected[thread_id][:n])
+        )
+        copied += cur.fetchone()[0] or 0
+    print(f"copying inherited messages into the {args.depth} forks: ~{copied / 1024:,.0f} KiB; "
+          f"forking: 0 message rows")
+
+    def legacy(thread_id):
+        cur.execute(LEGACY_HISTORY_SQL, (thread_id,))
+        return cur.fetchall()[-args.history:]
+
+    print(f"{'':<28}{'legacy (own only)':>20}{'forked history':>18}")
+    for name, thread_id in [("root thread", chain[0]), (f"fork at depth {args.depth}", leaf)]:
+        legacy_ms, _ = timed(lambda: legacy(thread_id), args.repeat)
+        ms, history = timed(lambda: db.get_thread_history(thread_id, limit=args.history), args.repeat)
+        print(f"{name:<28}{legacy_ms:>18.2f}ms{ms:>16.3f}ms  ({len(history)} messages)")
+        if len(history) != min(args.history, len(expected[thread_id])):
+            failures.append(f"{name}: {len(history)} history messages")
+
+    ms, history = timed(lambda: db.get_thread_history(leaf), args.repeat)
+    print(f"{'whole fork history':<28}{'':>20}{ms:>16.3f}ms  ({len(history)} messages)")
+
+    if failures:
+        print("FAILED:")
+        for f in failures:
+            print(f"  {f}")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+# Benchmark token accounting: storage per usage row, the budget check every
+# question pays before its upstream call, and the /usage rollups, on a table
+# with a few months of rows. Then checks end to end against the fake OpenAI
+# server that answers are recorded per message and that budgets downgrade or
+# refuse questions without an upstream call.
+# bench/bench_usage.py
+#
+#   python bench/bench_usage.py --rows 1000000
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import httpx
+
+from fakes import FakeOpenAI, FakeS3, Latency
+from run_bench import BACKEND_DIR, check, free_port, make_pdf, start_server
+
+ROUTES = ["document", "page", "overview", "definition", "followup", "selection", "region", "summary"]
+MODELS = ["gpt-4.1-mini", "gpt-4.1-nano", "gpt-4.1"]
+
+
+def populate(db, n_rows: int, users: int, files: int, days: int):
+    rng = random.Random(42)
+    now = int(time.time())
+    batch = []
+    for i in range(n_rows):
+        file_id = rng.randrange(files)
+        batch.append((
+            1 + file_id % users,
+            file_id,
+            file_id * 4 + rng.randrange(4),
+            i,
+            rng.choice(ROUTES),
+            rng.choice(MODELS),
+            rng.randrange(200, 40_000),
+            rng.randrange(0, 20_000),
+            rng.randrange(50, 600),
+            rng.randrange(100, 20_000),
+            rng.randrange(300, 8_000),
+            now - rng.randrange(days * 86_400),
+        ))
+        if len(batch) == 50_000 or i == n_rows - 1:
+            db.get_cursor().executemany(
+                """
+                INSERT INTO llm_usage (
+                    user_id, file_id, chat_thread_id, message_id, route, model,
+                    input_tokens, cached_tokens, output_tokens, cost_microusd,
+                    latency_ms, created_at
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                batch,
+            )
+            db.commit()
+            batch = []
+
+
+def timed(fn, repeat: int):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), result
+
+
+def bench_queries(args):
+    workdir = tempfile.mkdtemp(prefix="bench_usage_")
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+    import db
+    from usage import period_start
+
+    db.init_db()
+    cur = db.get_cursor()
+
+    def used_pages():
+        cur.execute("PRAGMA page_count")
+        pages = cur.fetchone()[0]
+        cur.execute("PRAGMA freelist_count")
+        return pages - cur.fetchone()[0]
+
+    cur.execute("PRAGMA page_size")
+    page_size = cur.fetchone()[0]
+    before = used_pages()
+    start = time.perf_counter()
+    populate(db, args.rows, args.users, args.files, args.days)
+    seconds = time.perf_counter() - start
+    per_row = (used_pages() - before) * page_size / args.rows
+    print(
+        f"{args.rows:,} rows ({args.users} users, {args.files} files, {args.days} days) "
+        f"in {seconds:.1f}s: {per_row:.0f} bytes per row with indexes"
+    )
+
+    month = period_start("month")
+    ms, spent = timed(lambda: db.get_spend_usd(1, month), args.repeat)
+    print(f"budget check (spend this month): {ms:8.2f} ms  (${spent:,.2f})")
+
+    for group_by in ("thread", "file", "model", "route", "day"):
+        ms, rows = timed(lambda: db.get_usage_rollups(1, group_by, since=month), args.repeat)
+        print(f"rollup by {group_by:<7} this month:  {ms:8.2f} ms  ({len(rows)} groups)")
+
+    ms, rows = timed(lambda: db.get_usage_rollups(1, "route", file_id=args.users), args.repeat)
+    print(f"rollup by route for one file:    {ms:8.2f} ms  ({len(rows)} groups)")
+
+
+def bench_server(args, failures):
+    openai = FakeOpenAI(latency=Latency(args.llm_latency_ms)).start()
+    s3 = FakeS3().start()
+    workdir = tempfile.mkdtemp(prefix="bench_usage_server_")
+    port = free_port()
+    server = start_server(workdir, openai.base_url, s3.url, port, 1)
+    client = httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=300)
+
+    try:
+        file_id = check(client.post(
+            "/upload", files={"file": ("lecture.pdf", make_pdf(args.pages, seed=1), "application/pdf")}
+        ))["file_id"]
+        deadline = time.time() + 300
+        while not check(client.get(f"/files/{file_id}/summary"))["ready"]:
+            if time.time() > deadline:
+                raise RuntimeError("summaries were not built in time")
+            time.sleep(0.1)
+        thread_id = check(client.get(f"/files/{file_id}/state"))["active_thread_id"]
+
+        def ask(question):
+            return client.post("/ask", json={
+                "file_id": file_id, "chat_thread_id": thread_id, "question": question,
+            })
+
+        for question in ["How do the loss and the learning rate interact?", "Explain page 3"]:
+            check(ask(question))
+        check(client.post("/ask/batch", json={
+            "file_id": file_id, "chat_thread_id": thread_id,
+            "questions": ["What is backpropagation?", "Summarize this lecture"],
+        }))
+
+        threads = check(client.get("/usage", params={"group_by": "thread"}))["usage"]
+        thread = next((t for t in threads if t["thread"] == thread_id), None)
+        if not thread or thread["messages"] != 4 or not thread["input_tokens"]:
+            failures.append(f"expected 4 answered messages with tokens on the thread, got {thread}")
+        else:
+            print(
+                f"thread {thread_id}: {thread['messages']} answers, {thread['input_tokens']:,} input tokens, "
+                f"${thread['cost_usd']:.6f}, {thread['avg_latency_ms']} ms on average"
+            )
+        routes = {r["route"]: r for r in check(client.get("/usage", params={"group_by": "route"}))["usage"]}
+        if "summary" not in routes or not routes["summary"]["input_tokens"]:
+            failures.append("summary calls were not recorded")
+        else:
+            print(f"summaries: {routes['summary']['records']} record(s), ${routes['summary']['cost_usd']:.6f}")
+
+        spent = check(client.get("/budget"))["spent_usd"]
+
+        # Past the downgrade threshold: answered on the small model
+        check(client.put("/budget", json={"period": "day", "downgrade_usd": spent / 2}))
+        # created_at has one-second resolution
+        time.sleep(1.1)
+        since = int(time.time())
+        check(ask("How do the loss and the learning rate interact?"))
+        models = {m["model"] for m in check(client.get("/usage", params={
+            "group_by": "model", "since": since,
+        }))["usage"]}
+        if models != {"gpt-4.1-nano"}:
+            failures.append(f"downgraded question used {models}")
+        else:
+            print(f"downgrade at ${spent / 2:.6f}: answered on {', '.join(models)}")
+
+        # Past the limit: refused before any upstream call or message
+        state = check(client.put("/budget", json={"period": "day", "limit_usd": spent / 2}))
+        calls = openai.calls
+        messages = len(check(client.get(f"/chat/thread/{thread_id}"))["messages"])
+        start = time.perf_counter()
+        refused = ask("How do the loss and the learning rate interact?")
+        refused_ms = (time.perf_counter() - start) * 1000
+        refused_batch = client.post("/ask/batch", json={
+            "file_id": file_id, "chat_thread_id": thread_id, "questions": ["why?"],
+        })
+        if refused.status_code != 402 or refused_batch.status_code != 402:
+            failures.append(f"over budget: /ask {refused.status_code}, /ask/batch {refused_batch.status_code}")
+        if openai.calls != calls:
+            failures.append(f"{openai.calls - calls} upstream calls made over budget")
+        if len(check(client.get(f"/chat/thread/{thread_id}"))["messages"]) != messages:
+            failures.append("refused question saved a message")
+        print(f"limit at ${spent / 2:.6f} (state {state['state']}): /ask {refused.status_code} in {refused_ms:.1f} ms, "
+              f"{openai.calls - calls} upstream calls")
+    finally:
+        client.close()
+        server.terminate()
+        server.wait(timeout=30)
+        openai.stop()
+        s3.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--files", type=int, default=2_000)
+    parser.add_argument("--days", type=int, default=120)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--llm-latency-ms", type=float, default=20)
+    args = parser.parse_args()
+
+    failures = []
+    bench_server(args, failures)
+    bench_queries(args)
+
+    if failures:
+        print("FAILED:")
+        for f in failures:
+            print(f"  {f}")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
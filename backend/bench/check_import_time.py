@@ -0,0 +1,100 @@
+# Startup budget check: profiles `import main` with -X importtime.
+# bench/check_import_time.py
+#
+# Fails if importing the app takes longer than --budget-ms (best of --runs),
+# or if a library that should load lazily (PyMuPDF, openai, boto3) is
+# imported at startup.
+#
+#   python bench/check_import_time.py
+#   python bench/check_import_time.py --budget-ms 600 --top 15
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loaded on first use (render/extract, /ask, S3 calls), never at import
+LAZY_MODULES = ("fitz", "pymupdf", "openai", "boto3", "botocore")
+
+
+def profile_import(module: str):
+    """
+    Import module in a fresh interpreter and return {name: (self_us, cumulative_us, depth)}
+    """
+    workdir = tempfile.mkdtemp(prefix="importtime_")
+    env = {
+        **os.environ,
+        "PYTHONPATH": BACKEND_DIR,
+        "PYTHONDONTWRITEBYTECODE": "1",
+        # s3.py refuses to import without these
+        "AWS_REGION": os.environ.get("AWS_REGION", "us-east-1"),
+        "AWS_S3_BUCKET": os.environ.get("AWS_S3_BUCKET", "importtime"),
+    }
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=workdir,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        sys.stderr.write(proc.stderr)
+        raise SystemExit(f"import {module} failed")
+
+    modules = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        # "import time:  self_us | cumulative_us | <2 spaces per level>name"
+        head, cumulative_us, name = line.split("|", 2)
+        self_us = int(head.split(":", 1)[1])
+        name = name.rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules[name.strip()] = (self_us, int(cumulative_us), depth)
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("IMPORT_BUDGET_MS", "600")))
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [profile_import(args.module) for _ in range(args.runs)]
+    best = min(runs, key=lambda m: m[args.module][1])
+    total_ms = best[args.module][1] / 1000
+
+    direct = [
+        (cumulative, name)
+        for name, (_, cumulative, depth) in best.items()
+        if depth == 1
+    ]
+    print(f"import {args.module}: {total_ms:.1f} ms (best of {args.runs}, budget {args.budget_ms:.0f} ms)")
+    for cumulative, name in sorted(direct, reverse=True)[:args.top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    failures = []
+    if total_ms > args.budget_ms:
+        failures.append(f"startup import took {total_ms:.1f} ms, budget is {args.budget_ms:.0f} ms")
+
+    eager = sorted({
+        name for name in best
+        if name.split(".")[0] in LAZY_MODULES
+    })
+    if eager:
+        roots = sorted({name.split(".")[0] for name in eager})
+        failures.append(f"imported at startup but should load lazily: {', '.join(roots)}")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if failures:
+        raise SystemExit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
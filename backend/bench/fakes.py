@@ -0,0 +1,426 @@
+# Local stand-ins for OpenAI and S3 with configurable latency, for benchmarks.
+# bench/fakes.py
+#
+# FakeOpenAI answers POST /v1/responses; point the backend at it with
+# OPENAI_BASE_URL=http://127.0.0.1:<port>/v1.
+# FakeS3 implements the object calls s3.py makes (put/get/head/delete,
+# batch delete, multipart upload, ranged GET); point the backend at it with
+# AWS_ENDPOINT_URL_S3=http://127.0.0.1:<port>.
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.sax.saxutils import escape
+
+
+class Latency:
+    """
+    Sleep for mean_ms +/- jitter_ms (uniform) per call
+    """
+
+    def __init__(self, mean_ms: float = 0.0, jitter_ms: float = 0.0):
+        self.mean_ms = mean_ms
+        self.jitter_ms = jitter_ms
+
+    def sleep(self):
+        ms = self.mean_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if ms > 0:
+            time.sleep(ms / 1000)
+
+
+class _FakeServer:
+    handler_class = None
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.httpd = ThreadingHTTPServer((host, port), self.handler_class)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        # The app server was stopped with calls in flight (e.g. background
+        # summaries); nothing to report
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def _body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, status: int, body: bytes = b"", content_type: str = "application/xml", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if body and self.command != "HEAD":
+            self.wfile.write(body)
+
+
+# ======================================================
+# OpenAI
+# ======================================================
+
+class _OpenAIHandler(_QuietHandler):
+    def do_POST(self):
+        fake = self.fake
+        payload = json.loads(self._body() or b"{}")
+
+        with fake.lock:
+            fake.calls += 1
+            call_number = fake.calls
+            fail = fake.outage or (fake.error_rate and random.random() < fake.error_rate)
+            fake.in_flight += 1
+            fake.max_in_flight = max(fake.max_in_flight, fake.in_flight)
+
+        try:
+            fake.latency.sleep()
+        finally:
+            with fake.lock:
+                fake.in_flight -= 1
+
+        if fake.outage:
+            with fake.lock:
+                fake.errors += 1
+            self._send(503, b'{"error": {"message": "Service unavailable (fake)"}}', "application/json")
+            return
+
+        if fail:
+            body = json.dumps({
+                "error": {"message": "Rate limit reached (fake)", "type": "rate_limit_exceeded", "code": "rate_limit_exceeded"}
+            }).encode("utf-8")
+            with fake.lock:
+                fake.errors += 1
+            self._send(
+                fake.error_status,
+                body,
+                "application/json",
+                {"retry-after-ms": str(fake.retry_after_ms)},
+            )
+            return
+
+        prompt_chars = len(json.dumps(payload.get("input", "")))
+        with fake.lock:
+            fake.prompt_chars.append(prompt_chars)
+        text = fake.answer_text(payload) if callable(fake.answer_text) else fake.answer_text
+        input_tokens = max(1, prompt_chars // 4)
+        output_tokens = max(1, len(text) // 4)
+
+        body = json.dumps({
+            "id": f"resp_{uuid.uuid4().hex}",
+            "object": "response",
+            "created_at": int(time.time()),
+            "status": "completed",
+            "model": payload.get("model", "fake-model"),
+            "output": [
+                {
+                    "type": "message",
+                    "id": f"msg_{call_number}",
+                    "status": "completed",
+                    "role": "assistant",
+                    "content": [
+                        {"type": "output_text", "text": text, "annotations": []}
+                    ],
+                }
+            ],
+            "parallel_tool_calls": True,
+            "tool_choice": "auto",
+            "tools": [],
+            "usage": {
+                "input_tokens": input_tokens,
+                "input_tokens_details": {"cached_tokens": 0},
+                "output_tokens": output_tokens,
+                "output_tokens_details": {"reasoning_tokens": 0},
+                "total_tokens": input_tokens + output_tokens,
+            },
+        }).encode("utf-8")
+        self._send(200, body, "application/json")
+
+
+class FakeOpenAI(_FakeServer):
+    handler_class = _OpenAIHandler
+
+    def __init__(
+        self,
+        latency: Latency = None,
+        # A string, or a function of the request payload returning one
+        answer_text="### Idea\n\nA short fake explanation.\n\n$$\na = b\n$$",
+        error_rate: float = 0.0,
+        error_status: int = 429,
+        retry_after_ms: int = 50,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.latency = latency or Latency()
+        self.answer_text = answer_text
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after_ms = retry_after_ms
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        # Set to answer every call with 503
+        self.outage = False
+        self.in_flight = 0
+        self.max_in_flight = 0
+        # Size of every successful call's input, in JSON characters
+        self.prompt_chars = []
+
+    @property
+    def base_url(self) -> str:
+        return f"{self.url}/v1"
+
+
+# ======================================================
+# S3
+# ======================================================
+
+def _decode_aws_chunked(body: bytes) -> bytes:
+    # Body framing used when botocore streams a payload with trailing checksums
+    out = bytearray()
+    pos = 0
+    while True:
+        line_end = body.index(b"\r\n", pos)
+        size = int(body[pos:line_end].split(b";")[0], 16)
+        pos = line_end + 2
+        if size == 0:
+            return bytes(out)
+        out += body[pos:pos + size]
+        pos += size + 2
+
+
+class _S3Handler(_QuietHandler):
+    def _target(self):
+        parsed = urlparse(self.path)
+        parts = parsed.path.lstrip("/").split("/", 1)
+        bucket = unquote(parts[0])
+        key = unquote(parts[1]) if len(parts) > 1 else ""
+        return bucket, key, parse_qs(parsed.query, keep_blank_values=True)
+
+    def _payload(self) -> bytes:
+        body = self._body()
+        encoding = self.headers.get("Content-Encoding", "")
+        sha = self.headers.get("x-amz-content-sha256", "")
+        if "aws-chunked" in encoding or sha.startswith("STREAMING-"):
+            return _decode_aws_chunked(body)
+        return body
+
+    def _error(self, status: int, code: str):
+        body = f"<Error><Code>{code}</Code><Message>{code}</Message></Error>".encode("utf-8")
+        self._send(status, body)
+
+    def do_PUT(self):
+        fake = self.fake
+        fake.latency.sleep()
+        bucket, key, query = self._target()
+        data = self._payload()
+
+        if "uploadId" in query:
+            upload_id = query["uploadId"][0]
+            part = int(query["partNumber"][0])
+            with fake.lock:
+                fake.uploads[upload_id][part] = data
+            self._send(200, headers={"ETag": f'"{uuid.uuid4().hex}"'})
+            return
+
+        with fake.lock:
+            fake.objects[(bucket, key)] = data
+            fake.bytes_in += len(data)
+        self._send(200, headers={"ETag": f'"{uuid.uuid4().hex}"'})
+
+    def do_POST(self):
+        fake = self.fake
+        fake.latency.sleep()
+        bucket, key, query = self._target()
+        body = self._body()
+
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            with fake.lock:
+                fake.uploads[upload_id] = {}
+            xml = (
+                "<InitiateMultipartUploadResult>"
+                f"<Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>"
+                f"<UploadId>{upload_id}</UploadId>"
+                "</InitiateMultipartUploadResult>"
+            )
+            self._send(200, xml.encode("utf-8"))
+            return
+
+        if "uploadId" in query:
+            upload_id = query["uploadId"][0]
+            with fake.lock:
+                parts = fake.uploads.pop(upload_id)
+                data = b"".join(parts[n] for n in sorted(parts))
+                fake.objects[(bucket, key)] = data
+                fake.bytes_in += len(data)
+            xml = (
+                "<CompleteMultipartUploadResult>"
+                f"<Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>"
+                f'<ETag>"{uuid.uuid4().hex}"</ETag>'
+                "</CompleteMultipartUploadResult>"
+            )
+            self._send(200, xml.encode("utf-8"))
+            return
+
+        if "delete" in query:
+            text = body.decode("utf-8")
+            keys = [
+                chunk.split("</Key>", 1)[0]
+                for chunk in text.split("<Key>")[1:]
+            ]
+            with fake.lock:
+                for k in keys:
+                    fake.objects.pop((bucket, unescape_xml(k)), None)
+            self._send(200, b"<DeleteResult></DeleteResult>")
+            return
+
+        self._error(400, "InvalidRequest")
+
+    def _get(self, head: bool):
+        fake = self.fake
+        fake.latency.sleep()
+        bucket, key, _ = self._target()
+
+        with fake.lock:
+            data = fake.objects.get((bucket, key))
+        if data is None:
+            self._error(404, "NoSuchKey")
+            return
+
+        status = 200
+        headers = {"ETag": '"fake"', "Accept-Ranges": "bytes"}
+        byte_range = self.headers.get("Range")
+        if byte_range and byte_range.startswith("bytes="):
+            start, _, end = byte_range[6:].partition("-")
+            start = int(start)
+            end = int(end) if end else len(data) - 1
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+            data = data[start:end + 1]
+            status = 206
+
+        if not head:
+            with fake.lock:
+                fake.bytes_out += len(data)
+
+        if head:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            return
+
+        self._send(status, data, "application/octet-stream", headers)
+
+    def do_GET(self):
+        self._get(head=False)
+
+    def do_HEAD(self):
+        self._get(head=True)
+
+    def do_DELETE(self):
+        fake = self.fake
+        fake.latency.sleep()
+        bucket, key, _ = self._target()
+        with fake.lock:
+            fake.objects.pop((bucket, key), None)
+        self._send(204)
+
+
+def unescape_xml(text: str) -> str:
+    return (
+        text.replace("&lt;", "<")
+        .replace("&gt;", ">")
+        .replace("&quot;", '"')
+        .replace("&apos;", "'")
+        .replace("&amp;", "&")
+    )
+
+
+class DiskObjects:
+    """
+    The dict of objects FakeS3 keeps, on disk instead of in memory, for
+    benchmarks with more data than RAM
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.sizes = {}
+
+    def _path(self, key) -> str:
+        return os.path.join(self.directory, hashlib.sha1("/".join(key).encode("utf-8")).hexdigest())
+
+    def __setitem__(self, key, data: bytes):
+        with open(self._path(key), "wb") as f:
+            f.write(data)
+        self.sizes[key] = len(data)
+
+    def __contains__(self, key) -> bool:
+        return key in self.sizes
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def keys(self):
+        return self.sizes.keys()
+
+    def get(self, key, default=None):
+        if key not in self.sizes:
+            return default
+        with open(self._path(key), "rb") as f:
+            return f.read()
+
+    def pop(self, key, default=None):
+        if self.sizes.pop(key, None) is None:
+            return default
+        os.remove(self._path(key))
+        return None
+
+
+class FakeS3(_FakeServer):
+    handler_class = _S3Handler
+
+    def __init__(self, latency: Latency = None, store_dir: str = None, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency or Latency()
+        self.lock = threading.Lock()
+        # store_dir: keep objects on disk (DiskObjects)
+        self.objects = DiskObjects(store_dir) if store_dir else {}
+        self.uploads = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
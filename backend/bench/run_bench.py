@@ -0,0 +1,443 @@
+# End-to-end benchmark of the API against local OpenAI and S3 stand-ins.
+# bench/run_bench.py
+#
+# Starts FakeOpenAI + FakeS3, runs uvicorn on a scratch database, drives each
+# scenario with concurrent clients and reports p50/p95/p99 latency, throughput
+# and the server's peak RSS. Compare against (or refresh) a stored baseline:
+#
+#   python bench/run_bench.py                      # compare with bench/baseline.json
+#   python bench/run_bench.py --save-baseline      # overwrite the baseline
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz
+import httpx
+
+from fakes import FakeOpenAI, FakeS3, Latency
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+
+WORDS = (
+    "gradient descent learning rate loss function neural network layer weight bias "
+    "activation backpropagation matrix vector derivative probability distribution "
+    "expectation variance estimator regression classification softmax entropy"
+).split()
+
+
+# ======================================================
+# Synthetic inputs
+# ======================================================
+
+def make_pdf(pages: int, seed: int = 0) -> bytes:
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for n in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 60), f"Lecture {seed} - page {n + 1}", fontsize=16)
+        text = "\n".join(
+            " ".join(rng.choice(WORDS) for _ in range(12))
+            for _ in range(40)
+        )
+        page.insert_textbox(fitz.Rect(72, 90, 523, 770), text, fontsize=9)
+        page.draw_rect(fitz.Rect(400, 600, 520, 700), color=(0, 0, 1), fill=(0.8, 0.8, 1))
+    data = doc.tobytes(garbage=3, deflate=True)
+    doc.close()
+    return data
+
+
+# ======================================================
+# Server process
+# ======================================================
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(workdir: str, openai_url: str, s3_url: str, port: int, workers: int):
+    env = {
+        **os.environ,
+        "AWS_REGION": "us-east-1",
+        "AWS_S3_BUCKET": "bench",
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "AWS_ENDPOINT_URL_S3": s3_url,
+        "AWS_REQUEST_CHECKSUM_CALCULATION": "when_required",
+        "AWS_RESPONSE_CHECKSUM_VALIDATION": "when_required",
+        "OPENAI_BASE_URL": openai_url,
+        "OPENAI_API_KEY": "bench",
+        "UPLOAD_DIR": os.path.join(workdir, "uploads"),
+        "SLOW_REQUEST_MS": "0",
+    }
+    cmd = [
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--app-dir", BACKEND_DIR,
+        "--host", "127.0.0.1",
+        "--port", str(port),
+        "--log-level", "warning",
+    ]
+    if workers > 1:
+        cmd += ["--workers", str(workers)]
+
+    # db.py opens data.db in the working directory
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env)
+
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("server exited during startup")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health", timeout=1).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            time.sleep(0.1)
+
+    proc.kill()
+    raise RuntimeError("server did not become healthy")
+
+
+def process_tree(pid: int):
+    # The server pid plus its children (uvicorn --workers forks)
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+    return pids
+
+
+def peak_rss_mb(pid: int):
+    """
+    Peak resident set size (VmHWM) of the server process tree, Linux only
+    """
+    total_kb = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total_kb += int(line.split()[1])
+        except OSError:
+            continue
+    return round(total_kb / 1024, 1) if total_kb else None
+
+
+# ======================================================
+# Load driver
+# ======================================================
+
+def percentile(samples, pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[idx]
+
+
+def run_scenario(name: str, fn, items, concurrency: int):
+    latencies = []
+    errors = 0
+
+    def one(item):
+        start = time.perf_counter()
+        try:
+            fn(item)
+            ok = True
+        except Exception as e:
+            print(f"  {name} error: {e}")
+            ok = False
+        return ok, (time.perf_counter() - start) * 1000
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for ok, ms in pool.map(one, items):
+            latencies.append(ms)
+            errors += 0 if ok else 1
+    wall = time.perf_counter() - wall_start
+
+    result = {
+        "count": len(latencies),
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else 0.0,
+    }
+    print(
+        f"{name:<16} n={result['count']:<5} err={errors:<3} "
+        f"p50={result['p50_ms']:>8.1f}ms p95={result['p95_ms']:>8.1f}ms "
+        f"p99={result['p99_ms']:>8.1f}ms  {result['throughput_rps']:>7.1f} req/s"
+    )
+    return result
+
+
+def check(resp: httpx.Response):
+    if resp.status_code >= 400:
+        raise RuntimeError(f"{resp.request.method} {resp.request.url.path} -> {resp.status_code}: {resp.text[:200]}")
+    return resp.json() if resp.content else None
+
+
+def run_all(base_url: str, args):
+    client = httpx.Client(base_url=base_url, timeout=120)
+    n = args.requests
+    conc = args.concurrency
+    results = {}
+
+    pdfs = [make_pdf(args.pages, seed=i) for i in range(min(n, 8))]
+    print(f"synthetic PDF: {args.pages} pages, {len(pdfs[0]) / 1024:.0f} KiB")
+
+    def upload(i, folder_id=None):
+        data = {"folder_id": str(folder_id)} if folder_id else {}
+        return check(client.post(
+            "/upload",
+            files={"file": (f"lecture_{i}.pdf", pdfs[i % len(pdfs)], "application/pdf")},
+            data=data,
+        ))["file_id"]
+
+    file_ids = []
+    results["upload"] = run_scenario(
+        "upload", lambda i: file_ids.append(upload(i)), range(n), conc
+    )
+
+    states = {}
+
+    def file_state(file_id):
+        states[file_id] = check(client.get(f"/files/{file_id}/state"))
+
+    results["file_state"] = run_scenario("file_state", file_state, file_ids, conc)
+
+    def ask(file_id, thread_id, annotation_id=None):
+        check(client.post("/ask", json={
+            "file_id": file_id,
+            "chat_thread_id": thread_id,
+            "annotation_id": annotation_id,
+            "question": "Can you explain the main idea on this page?",
+        }))
+
+    results["ask_document"] = run_scenario(
+        "ask_document",
+        lambda fid: ask(fid, states[fid]["active_thread_id"]),
+        file_ids,
+        conc,
+    )
+
+    text_annotations = {}
+    for fid in file_ids:
+        text_annotations[fid] = check(client.post("/annotations", json={
+            "file_id": fid,
+            "page_number": 1,
+            "type": "text",
+            "geometry": [{"x": 0.1, "y": 0.1, "width": 0.5, "height": 0.02}],
+            "text": "gradient descent learning rate",
+        }))["annotation_id"]
+
+    results["ask_annotation"] = run_scenario(
+        "ask_annotation",
+        lambda fid: ask(fid, states[fid]["active_thread_id"], text_annotations[fid]),
+        file_ids,
+        conc,
+    )
+
+    region_annotations = {}
+
+    def upload_region(fid):
+        region_annotations[fid] = check(client.post("/upload-region", data={
+            "file_id": str(fid),
+            "page_number": "1",
+            "geometry": json.dumps({"x": 0.6, "y": 0.65, "width": 0.3, "height": 0.2}),
+            "dpi": "150",
+        }))["annotation_id"]
+
+    results["upload_region"] = run_scenario("upload_region", upload_region, file_ids, conc)
+    results["ask_region"] = run_scenario(
+        "ask_region",
+        lambda fid: ask(fid, states[fid]["active_thread_id"], region_annotations[fid]),
+        file_ids,
+        conc,
+    )
+
+    def ask_standalone(i):
+        chat = check(client.post("/chat/standalone", json={}))
+        ask(chat["file_id"], chat["thread_id"])
+
+    results["ask_standalone"] = run_scenario("ask_standalone", ask_standalone, range(n), conc)
+
+    # A class clicking the same suggested question on one shared PDF, each
+    # in their own thread: identical in-flight prompts should coalesce
+    shared_file = file_ids[0]
+    class_threads = [
+        check(client.post("/chat/threads", json={"file_id": shared_file}))["id"]
+        for _ in range(n)
+    ]
+    calls_before = args.llm_calls()
+    results["ask_shared"] = run_scenario(
+        "ask_shared", lambda tid: ask(shared_file, tid), class_threads, conc
+    )
+    results["ask_shared"]["llm_calls"] = args.llm_calls() - calls_before
+    print(f"  ask_shared: {n} questions, {results['ask_shared']['llm_calls']} upstream LLM calls")
+
+    # Review sheets: several questions about one document per request
+    review = [f"Review question {q}: explain {w} on these slides." for q, w in enumerate(WORDS[:5])]
+
+    def ask_batch(fid):
+        out = check(client.post("/ask/batch", json={
+            "file_id": fid,
+            "chat_thread_id": states[fid]["active_thread_id"],
+            "questions": review,
+        }))
+        failed = [r for r in out["results"] if "error" in r]
+        if failed:
+            raise RuntimeError(f"{len(failed)} batch questions failed: {failed[0]['error']}")
+
+    results["ask_batch"] = run_scenario("ask_batch", ask_batch, file_ids[:max(1, n // 4)], conc)
+
+    results["list_files"] = run_scenario(
+        "list_files", lambda i: check(client.get("/files")), range(n), conc
+    )
+
+    results["delete_file"] = run_scenario(
+        "delete_file", lambda fid: check(client.delete(f"/files/{fid}")), file_ids, conc
+    )
+
+    # Folders with a few files each, two levels deep
+    folder_ids = []
+    for i in range(max(1, n // 4)):
+        top = check(client.post("/folders", json={"name": f"course {i}"}))["id"]
+        week = check(client.post("/folders", json={"name": "week 1", "parent_id": top}))["id"]
+        for j in range(args.files_per_folder):
+            upload(j, folder_id=top if j % 2 else week)
+        folder_ids.append(top)
+
+    results["delete_folder"] = run_scenario(
+        "delete_folder", lambda fid: check(client.delete(f"/folders/{fid}")), folder_ids, conc
+    )
+
+    client.close()
+    return results
+
+
+# ======================================================
+# Baseline
+# ======================================================
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    regressions = []
+    for name, current in results["scenarios"].items():
+        if current["errors"]:
+            regressions.append(f"{name}: {current['errors']} failed requests")
+
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        for metric in ("p50_ms", "p95_ms"):
+            if base[metric] and current[metric] > base[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{name} {metric}: {current[metric]:.1f} vs baseline {base[metric]:.1f}"
+                )
+
+    base_rss = baseline.get("peak_rss_mb")
+    if base_rss and results["peak_rss_mb"] and results["peak_rss_mb"] > base_rss * (1 + tolerance):
+        regressions.append(f"peak_rss_mb: {results['peak_rss_mb']} vs baseline {base_rss}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=30, help="pages per synthetic PDF")
+    parser.add_argument("--requests", type=int, default=24, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--files-per-folder", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn --workers")
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--llm-jitter-ms", type=float, default=100)
+    parser.add_argument("--s3-latency-ms", type=float, default=20)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown vs baseline")
+    parser.add_argument("--output", help="write results JSON here")
+    args = parser.parse_args()
+
+    openai = FakeOpenAI(latency=Latency(args.llm_latency_ms, args.llm_jitter_ms)).start()
+    s3 = FakeS3(latency=Latency(args.s3_latency_ms)).start()
+
+    workdir = tempfile.mkdtemp(prefix="engrave_bench_")
+    port = free_port()
+    server = start_server(workdir, openai.base_url, s3.url, port, args.workers)
+
+    args.llm_calls = lambda: openai.calls
+
+    try:
+        scenarios = run_all(f"http://127.0.0.1:{port}", args)
+        rss = peak_rss_mb(server.pid)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        openai.stop()
+        s3.stop()
+
+    if rss is None:
+        # Not Linux: fall back to the largest terminated child
+        rss = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+
+    results = {
+        "config": {
+            k: getattr(args, k)
+            for k in ("pages", "requests", "concurrency", "files_per_folder", "workers",
+                      "llm_latency_ms", "llm_jitter_ms", "s3_latency_ms")
+        },
+        "machine": {"python": platform.python_version(), "platform": platform.platform()},
+        "peak_rss_mb": rss,
+        "llm_calls": openai.calls,
+        "scenarios": scenarios,
+    }
+    print(f"peak RSS {rss} MiB, {openai.calls} LLM calls, workdir {workdir}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+        print(f"baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("no baseline to compare against (run with --save-baseline)")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    if baseline.get("config") != results["config"]:
+        print("warning: baseline was recorded with a different config")
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("REGRESSIONS:")
+        for r in regressions:
+            print(f"  {r}")
+        return 1
+
+    print(f"no regressions beyond {args.tolerance:.0%} of baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
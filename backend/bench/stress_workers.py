@@ -0,0 +1,158 @@
+# Multi-worker SQLite stress test: mixed /upload and /ask traffic against
+# uvicorn --workers N sharing one data.db.
+# bench/stress_workers.py
+#
+# Fails on any failed request (e.g. "database is locked") and checks the
+# database afterwards: integrity_check, and exactly two messages saved per
+# successful /ask.
+#
+#   python bench/stress_workers.py --workers 4 --clients 16 --requests 400
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from fakes import FakeOpenAI, FakeS3, Latency
+from run_bench import check, free_port, make_pdf, percentile, start_server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4, help="uvicorn --workers")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent HTTP clients")
+    parser.add_argument("--requests", type=int, default=400, help="total requests")
+    parser.add_argument("--upload-ratio", type=float, default=0.25)
+    parser.add_argument("--pages", type=int, default=10, help="pages per synthetic PDF")
+    parser.add_argument("--llm-latency-ms", type=float, default=200)
+    parser.add_argument("--llm-jitter-ms", type=float, default=100)
+    parser.add_argument("--s3-latency-ms", type=float, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    openai = FakeOpenAI(latency=Latency(args.llm_latency_ms, args.llm_jitter_ms)).start()
+    s3 = FakeS3(latency=Latency(args.s3_latency_ms)).start()
+
+    workdir = tempfile.mkdtemp(prefix="engrave_stress_")
+    port = free_port()
+    server = start_server(workdir, openai.base_url, s3.url, port, args.workers)
+    base_url = f"http://127.0.0.1:{port}"
+
+    pdfs = [make_pdf(args.pages, seed=i) for i in range(4)]
+    lock = threading.Lock()
+    threads = {}  # file_id -> chat thread id
+    latencies = {"upload": [], "ask": []}
+    errors = Counter()
+    asked = Counter()  # chat thread id -> successful /ask calls
+
+    def upload(client, i):
+        file_id = check(client.post(
+            "/upload",
+            files={"file": (f"stress_{i}.pdf", pdfs[i % len(pdfs)], "application/pdf")},
+        ))["file_id"]
+        thread_id = check(client.get(f"/files/{file_id}/state"))["active_thread_id"]
+        with lock:
+            threads[file_id] = thread_id
+
+    def ask(client, rng):
+        with lock:
+            file_id, thread_id = rng.choice(list(threads.items()))
+        check(client.post("/ask", json={
+            "file_id": file_id,
+            "chat_thread_id": thread_id,
+            "question": "What is the main idea of this lecture?",
+        }))
+        with lock:
+            asked[thread_id] += 1
+
+    # Seed a few documents so /ask has something to hit from the start
+    with httpx.Client(base_url=base_url, timeout=120) as client:
+        for i in range(args.clients // 4 + 1):
+            upload(client, i)
+
+    rng_seed = random.Random(args.seed)
+    plan = [
+        "upload" if rng_seed.random() < args.upload_ratio else "ask"
+        for _ in range(args.requests)
+    ]
+
+    def worker(client_idx):
+        rng = random.Random(args.seed * 1000 + client_idx)
+        with httpx.Client(base_url=base_url, timeout=120) as client:
+            for i in range(client_idx, len(plan), args.clients):
+                kind = plan[i]
+                start = time.perf_counter()
+                try:
+                    if kind == "upload":
+                        upload(client, 1000 + i)
+                    else:
+                        ask(client, rng)
+                except Exception as e:
+                    with lock:
+                        errors[str(e)[:160]] += 1
+                    continue
+                with lock:
+                    latencies[kind].append((time.perf_counter() - start) * 1000)
+
+    wall_start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.clients) as pool:
+            list(pool.map(worker, range(args.clients)))
+        wall = time.perf_counter() - wall_start
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        openai.stop()
+        s3.stop()
+
+    for kind, samples in latencies.items():
+        print(
+            f"{kind:<8} ok={len(samples):<5} p50={percentile(samples, 50):>8.1f}ms "
+            f"p95={percentile(samples, 95):>8.1f}ms p99={percentile(samples, 99):>8.1f}ms"
+        )
+    ok = sum(len(v) for v in latencies.values())
+    print(f"{args.workers} workers, {args.clients} clients: {ok / wall:.1f} req/s, workdir {workdir}")
+
+    failures = []
+    for message, count in errors.most_common():
+        failures.append(f"{count}x {message}")
+
+    db = sqlite3.connect(os.path.join(workdir, "data.db"))
+    integrity = db.execute("PRAGMA integrity_check").fetchone()[0]
+    if integrity != "ok":
+        failures.append(f"integrity_check: {integrity}")
+
+    saved = dict(db.execute(
+        "SELECT chat_thread_id, COUNT(*) FROM messages WHERE chat_thread_id IS NOT NULL GROUP BY chat_thread_id"
+    ).fetchall())
+    for thread_id, count in asked.items():
+        if saved.get(thread_id, 0) != 2 * count:
+            failures.append(f"thread {thread_id}: {saved.get(thread_id, 0)} messages for {count} asks")
+
+    missing_pages = db.execute(
+        "SELECT COUNT(*) FROM files f WHERE f.document_id IS NOT NULL "
+        "AND NOT EXISTS (SELECT 1 FROM pages p WHERE p.document_id = f.document_id)"
+    ).fetchone()[0]
+    if missing_pages:
+        failures.append(f"{missing_pages} uploaded files without pages")
+    db.close()
+
+    if failures:
+        print("FAILED:")
+        for f in failures:
+            print(f"  {f}")
+        return 1
+
+    print("OK: no failed requests, database consistent")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
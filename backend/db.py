@@ -3,18 +3,145 @@
 import sqlite3
 import json
 import os
+import base64
+import html
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
 from typing import Optional
 
+from geometry import geometry_bbox, pack_geometry, unpack_geometry
+from layout import PageLayout
+from metrics import span, inc, observe, sql_fingerprint, sql_operation, current_trace
+
 DB_PATH = "data.db"
 
+logger = logging.getLogger("engrave.db")
+
+# How long a statement waits on another connection's write lock
+BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# Extra attempts, with jittered exponential backoff, after the busy timeout
+LOCK_RETRIES = int(os.getenv("SQLITE_LOCK_RETRIES", "3"))
+LOCK_RETRY_BASE_MS = 50
+
+
+class TracedCursor(sqlite3.Cursor):
+    # Records every statement as an "sql" span of the current request (metrics.py)
+
+    def execute(self, sql, parameters=()):
+        began = not self.connection.in_transaction
+        with span("sql", sql_operation(sql), sql=sql_fingerprint(sql)) as record:
+            result = _retry_locked(self, super().execute, sql, parameters)
+            if self.rowcount > 0:
+                record["rows"] = self.rowcount
+        self._span = record
+        if began and self.connection.in_transaction:
+            _local.write_started = time.perf_counter()
+        return result
+
+    def executemany(self, sql, seq_of_parameters):
+        began = not self.connection.in_transaction
+        with span("sql", sql_operation(sql), sql=sql_fingerprint(sql)) as record:
+            result = _retry_locked(self, super().executemany, sql, seq_of_parameters)
+            if self.rowcount > 0:
+                record["rows"] = self.rowcount
+        self._span = record
+        if began and self.connection.in_transaction:
+            _local.write_started = time.perf_counter()
+        return result
+
+    def _add_rows(self, n):
+        record = getattr(self, "_span", None)
+        if record is None or n <= 0:
+            return
+        record["rows"] = record.get("rows", 0) + n
+        inc("span_rows_total", n, kind="sql", operation=record["operation"])
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self._add_rows(1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._add_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self._add_rows(len(rows))
+        return rows
+
+
+def _is_locked(e: sqlite3.OperationalError) -> bool:
+    message = str(e)
+    return "database is locked" in message or "database is busy" in message
+
+
+def _retry_locked(cursor, run, sql, parameters):
+    # Only a statement that would open a new transaction is safe to repeat on
+    # its own: nothing has been written yet, so a retry can't double-apply.
+    # Inside an open transaction the caller has to roll back instead.
+    if cursor.connection.in_transaction:
+        return run(sql, parameters)
+
+    for attempt in range(LOCK_RETRIES + 1):
+        try:
+            return run(sql, parameters)
+        except sqlite3.OperationalError as e:
+            if not _is_locked(e) or attempt == LOCK_RETRIES:
+                raise
+            inc("sqlite_lock_retries_total")
+            delay = LOCK_RETRY_BASE_MS * (2 ** attempt) / 1000
+            time.sleep(random.uniform(0, delay))
+
+
+# One connection per thread. Several uvicorn workers (processes) and the
+# threadpool share the file through WAL: readers never block the writer,
+# and writers queue on the write lock for up to BUSY_TIMEOUT_MS.
+_local = threading.local()
+
+
+def _connect():
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        # Implicit transactions (before the first INSERT/UPDATE/DELETE) take
+        # the write lock up front, so they wait in busy_timeout instead of
+        # failing when upgrading a stale read snapshot
+        isolation_level="IMMEDIATE",
+    )
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    # Safe with WAL: a crash can lose the last commits, never corrupt the file
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+
+def get_connection():
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _connect()
+        _local.conn = conn
 
-# One shared connection, many cursors (this is OK)
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    # Threadpool threads are reused across requests; never let one request's
+    # uncommitted writes (and the write lock) leak into the next
+    trace = current_trace()
+    if trace is not None and getattr(_local, "trace", None) is not trace:
+        if conn.in_transaction:
+            logger.warning("Rolling back transaction left open by an earlier request")
+            conn.rollback()
+            _end_write("leaked")
+        _local.trace = trace
+
+    return conn
 
-conn.execute("PRAGMA foreign_keys = ON")
 
 def get_cursor():
-    return conn.cursor()
+    return get_connection().cursor(TracedCursor)
 
 def cleanup_math_blocks(text: str) -> str:
     if not text:
@@ -49,26 +176,394 @@ def cleanup_math_blocks(text: str) -> str:
 
 def init_pages():
     cur = get_cursor()
+    # id is the search index's rowid; an explicit INTEGER PRIMARY KEY so
+    # VACUUM can't renumber it
     cur.execute("""
     CREATE TABLE IF NOT EXISTS pages (
+        id INTEGER PRIMARY KEY,
         document_id TEXT,
         page_number INTEGER,
         text TEXT,
-        PRIMARY KEY (document_id, page_number)
+        UNIQUE (document_id, page_number)
+    )
+    """)
+
+
+def migrate_add_content_hash_to_pages():
+    cur = get_cursor()
+
+    # ocr.page_content_hash of the page; a revised upload re-extracts only
+    # pages whose hash changed
+    cur.execute("PRAGMA table_info(pages)")
+    columns = [row[1] for row in cur.fetchall()]
+
+    if "content_hash" not in columns:
+        cur.execute(
+            "ALTER TABLE pages ADD COLUMN content_hash TEXT"
+        )
+
+
+def migrate_add_summary_to_pages():
+    cur = get_cursor()
+
+    # Page level of the summary tree (summaries.py); NULL until built
+    cur.execute("PRAGMA table_info(pages)")
+    columns = [row[1] for row in cur.fetchall()]
+
+    if "summary" not in columns:
+        cur.execute(
+            "ALTER TABLE pages ADD COLUMN summary TEXT"
+        )
+
+
+def migrate_add_id_to_pages():
+    cur = get_cursor()
+
+    # pages used to be keyed on (document_id, page_number) with pages_fts on
+    # its implicit rowid, which VACUUM may renumber. Rebuild it with an id
+    # column; the search index is rebuilt by init_search, and the old
+    # table's triggers go with it.
+    cur.execute("PRAGMA table_info(pages)")
+    columns = [row[1] for row in cur.fetchall()]
+
+    if "id" in columns:
+        return
+
+    cur.execute("""
+    CREATE TABLE pages_new (
+        id INTEGER PRIMARY KEY,
+        document_id TEXT,
+        page_number INTEGER,
+        text TEXT,
+        content_hash TEXT,
+        summary TEXT,
+        UNIQUE (document_id, page_number)
     )
     """)
+    cur.execute("""
+    INSERT INTO pages_new (document_id, page_number, text, content_hash, summary)
+    SELECT document_id, page_number, text, content_hash, summary
+    FROM pages
+    ORDER BY document_id, page_number
+    """)
+    cur.execute("DROP TABLE pages")
+    cur.execute("ALTER TABLE pages_new RENAME TO pages")
+    cur.execute("DROP TABLE IF EXISTS pages_fts")
 
 
 def save_pages(pages):
     cur = get_cursor()
-    for page in pages:
+    # Upsert (not INSERT OR REPLACE) so the search index triggers see an UPDATE.
+    # Text-only updates (OCR) keep the stored content hash; a page summary
+    # only survives if the text didn't change.
+    cur.executemany(
+        """
+        INSERT INTO pages (document_id, page_number, text, content_hash)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (document_id, page_number) DO UPDATE SET
+            text = excluded.text,
+            content_hash = COALESCE(excluded.content_hash, pages.content_hash),
+            summary = CASE WHEN excluded.text IS pages.text THEN pages.summary END
+        """,
+        [
+            (page["document_id"], page["page_number"], page["text"], page.get("content_hash"))
+            for page in pages
+        ]
+    )
+
+
+def save_ocr_texts(document_id: str, texts, hashes):
+    """
+    Write OCR text to pages still holding the content it was read from.
+    A replace can renumber or swap pages while OCR runs; those are skipped.
+    Returns the number of pages written.
+
+    texts: {page_number: text}; hashes: {page_number: content hash}
+    """
+    cur = get_cursor()
+    cur.executemany(
+        """
+        UPDATE pages
+        SET text = ?,
+            summary = CASE WHEN text IS ? THEN summary END
+        WHERE document_id = ? AND page_number = ? AND content_hash = ?
+        """,
+        [
+            (text, text, document_id, page_number, hashes[page_number])
+            for page_number, text in texts.items()
+        ],
+    )
+    return cur.rowcount
+
+
+def get_page_hashes(document_id: str):
+    """
+    {page_number: content_hash}; None for pages stored before hashes were
+    """
+    cur = get_cursor()
+    cur.execute(
+        "SELECT page_number, content_hash FROM pages WHERE document_id = ?",
+        (document_id,),
+    )
+    return dict(cur.fetchall())
+
+
+def remap_pages(document_id: str, moves, removed):
+    """
+    Apply a revision's page changes to stored pages and annotations.
+
+    moves: {old_page_number: new_page_number} for pages that moved; their
+           text, layout and annotations follow them
+    removed: old page numbers whose stored page and layout rows are deleted
+             (pages re-extracted or dropped) before anything moves; their
+             annotations are left to the caller
+    """
+    cur = get_cursor()
+
+    for table in ("pages", "page_layouts"):
+        cur.executemany(
+            f"DELETE FROM {table} WHERE document_id = ? AND page_number = ?",
+            [(document_id, page_number) for page_number in removed],
+        )
+        # Through negative numbers: (document_id, page_number) is unique and
+        # pages may swap places
+        cur.executemany(
+            f"UPDATE {table} SET page_number = ? WHERE document_id = ? AND page_number = ?",
+            [(-new, document_id, old) for old, new in moves.items()],
+        )
         cur.execute(
-            """
-            INSERT OR REPLACE INTO pages (document_id, page_number, text)
-            VALUES (?, ?, ?)
-            """,
-            (page["document_id"], page["page_number"], page["text"])
+            f"UPDATE {table} SET page_number = -page_number WHERE document_id = ? AND page_number < 0",
+            (document_id,),
+        )
+
+    if not moves:
+        return
+
+    # Annotations have no unique key on the page, so one pass is enough;
+    # chat_text annotations (page -1) are never in moves
+    cases = " ".join(["WHEN ? THEN ?"] * len(moves))
+    params = [n for move in moves.items() for n in move]
+    cur.execute(
+        f"""
+        UPDATE annotations
+        SET page_number = CASE page_number {cases} END
+        WHERE document_id = ? AND page_number IN ({", ".join("?" * len(moves))})
+        """,
+        (*params, document_id, *moves),
+    )
+    cur.execute(
+        f"""
+        UPDATE annotation_boxes
+        SET page_min = (SELECT page_number FROM annotations a WHERE a.id = annotation_boxes.id),
+            page_max = (SELECT page_number FROM annotations a WHERE a.id = annotation_boxes.id)
+        WHERE id IN (
+            SELECT id FROM annotations
+            WHERE document_id = ? AND page_number IN ({", ".join("?" * len(moves))})
+        )
+        """,
+        (document_id, *moves.values()),
+    )
+
+
+def get_annotation_ids_on_pages(document_id: str, page_numbers):
+    if not page_numbers:
+        return []
+
+    cur = get_cursor()
+    cur.execute(
+        f"""
+        SELECT id FROM annotations
+        WHERE document_id = ? AND page_number IN ({", ".join("?" * len(page_numbers))})
+        """,
+        (document_id, *page_numbers),
+    )
+    return [r[0] for r in cur.fetchall()]
+
+
+def init_page_layouts():
+    cur = get_cursor()
+    # One row per page: line text plus packed bounding-box arrays (layout.py)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS page_layouts (
+        document_id TEXT,
+        page_number INTEGER,
+        version INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        block_boxes BLOB NOT NULL,
+        line_boxes BLOB NOT NULL,
+        line_blocks BLOB NOT NULL,
+        line_offsets BLOB NOT NULL,
+        PRIMARY KEY (document_id, page_number)
+    )
+    """)
+
+
+def save_page_layouts(document_id: str, layouts):
+    """
+    layouts: [(page_number, PageLayout)]
+    """
+    cur = get_cursor()
+    cur.executemany(
+        """
+        INSERT OR REPLACE INTO page_layouts (
+            document_id, page_number, version, text,
+            block_boxes, line_boxes, line_blocks, line_offsets
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        [(document_id, page_number, *layout.to_row()) for page_number, layout in layouts],
+    )
+
+
+def get_page_layout(document_id: str, page_number: int):
+    cur = get_cursor()
+    cur.execute(
+        """
+        SELECT version, text, block_boxes, line_boxes, line_blocks, line_offsets
+        FROM page_layouts
+        WHERE document_id = ? AND page_number = ?
+        """,
+        (document_id, page_number),
+    )
+    row = cur.fetchone()
+    return PageLayout.from_row(row) if row else None
+
+
+def init_ocr_cache():
+    cur = get_cursor()
+    # OCR text keyed by ocr_cache_key (page content + OCR settings, ocr.py);
+    # shared by every document containing the same scanned page
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ocr_cache (
+        cache_key TEXT PRIMARY KEY,
+        text TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+
+def get_ocr_cache(keys):
+    if not keys:
+        return {}
+
+    cur = get_cursor()
+    keys = list(keys)
+    cached = {}
+    # Stay under SQLite's bound-parameter limit on long scans
+    for i in range(0, len(keys), 500):
+        chunk = keys[i:i + 500]
+        cur.execute(
+            f"SELECT cache_key, text FROM ocr_cache WHERE cache_key IN ({', '.join('?' * len(chunk))})",
+            chunk,
         )
+        cached.update(cur.fetchall())
+    return cached
+
+
+def save_ocr_cache(entries):
+    """
+    entries: {cache_key: text}
+    """
+    cur = get_cursor()
+    cur.executemany(
+        "INSERT OR REPLACE INTO ocr_cache (cache_key, text) VALUES (?, ?)",
+        list(entries.items()),
+    )
+
+
+def get_pages_for_summary(document_id: str):
+    cur = get_cursor()
+    cur.execute(
+        """
+        SELECT page_number, text, summary
+        FROM pages
+        WHERE document_id = ?
+        ORDER BY page_number ASC
+        """,
+        (document_id,)
+    )
+    return [{"page_number": r[0], "text": r[1], "summary": r[2]} for r in cur.fetchall()]
+
+
+def save_page_summaries(document_id: str, summaries):
+    """
+    summaries: [(page_number, text it was built from, summary)]; skipped for
+    pages whose text has changed since (e.g. OCR finished meanwhile)
+    """
+    cur = get_cursor()
+    cur.executemany(
+        """
+        UPDATE pages SET summary = ?
+        WHERE document_id = ? AND page_number = ? AND text IS ?
+        """,
+        [(summary, document_id, page_number, text) for page_number, text, summary in summaries],
+    )
+
+
+def init_document_summaries():
+    cur = get_cursor()
+    # Section and document levels of the summary tree; source_hash covers the
+    # summaries each row was built from, so unchanged sections are reused
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS document_summaries (
+        document_id TEXT NOT NULL,
+        level TEXT NOT NULL,
+        start_page INTEGER NOT NULL,
+        end_page INTEGER NOT NULL,
+        title TEXT,
+        summary TEXT,
+        source_hash TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (document_id, level, start_page)
+    )
+    """)
+
+
+def get_document_summaries(document_id: str):
+    """
+    Sections in page order, then the document row
+    """
+    cur = get_cursor()
+    cur.execute(
+        """
+        SELECT level, start_page, end_page, title, summary, source_hash
+        FROM document_summaries
+        WHERE document_id = ?
+        ORDER BY level = 'document', start_page
+        """,
+        (document_id,)
+    )
+    return [
+        {
+            "level": r[0],
+            "start_page": r[1],
+            "end_page": r[2],
+            "title": r[3],
+            "summary": r[4],
+            "source_hash": r[5],
+        }
+        for r in cur.fetchall()
+    ]
+
+
+def save_document_summaries(document_id: str, summaries):
+    """
+    Replace a document's section and document summaries with summaries
+    (dicts shaped like get_document_summaries rows)
+    """
+    cur = get_cursor()
+    cur.execute("DELETE FROM document_summaries WHERE document_id = ?", (document_id,))
+    cur.executemany(
+        """
+        INSERT INTO document_summaries
+            (document_id, level, start_page, end_page, title, summary, source_hash)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        [
+            (document_id, s["level"], s["start_page"], s["end_page"], s["title"], s["summary"], s["source_hash"])
+            for s in summaries
+        ],
+    )
 
 
 def get_pages(document_id):
@@ -194,6 +689,7 @@ def init_annotations():
 
 
 def create_annotation(document_id, page_number, type, geometry, text=None, region_id=None, region_s3_key=None,):
+    stored_geometry = pack_geometry(geometry)
     cur = get_cursor()
     cur.execute(
         """
@@ -206,13 +702,16 @@ def create_annotation(document_id, page_number, type, geometry, text=None, regio
             document_id,
             page_number,
             type,
-            json.dumps(geometry) if geometry else None,
+            stored_geometry,
             text,
             region_id,
             region_s3_key,
         )
     )
-    return cur.lastrowid
+    annotation_id = cur.lastrowid
+    # From the stored (float32) values, so the box matches a rebuilt index
+    index_annotation_box(annotation_id, document_id, page_number, unpack_geometry(stored_geometry))
+    return annotation_id
 
 
 def get_annotation(annotation_id):
@@ -234,37 +733,171 @@ def get_annotation(annotation_id):
         "document_id": row[1],
         "page_number": row[2],
         "type": row[3],
-        "geometry": json.loads(row[4]) if row[4] else None,
+        "geometry": unpack_geometry(row[4]),
         "text": row[5],
         "region_id": row[6],
         "region_s3_key": row[7],
     }
 
 
-def get_annotations_by_document(document_id):
+_ANNOTATION_LIST_COLUMNS = "id, page_number, type, text, region_id, created_at, region_s3_key, geometry"
+
+
+def _annotation_from_row(r, include_geometry: bool = True):
+    annotation = {
+        "id": r[0],
+        "page_number": r[1],
+        "type": r[2],
+        "text": r[3],
+        "region_id": r[4],
+        "created_at": r[5],
+        "region_s3_key": r[6],
+    }
+    if include_geometry:
+        annotation["geometry"] = unpack_geometry(r[7])
+    return annotation
+
+
+def get_annotations_by_document(document_id, include_geometry: bool = True):
+    """
+    Every annotation of a document; without geometry, the (packed) geometry
+    column isn't read or decoded at all
+    """
+    columns = _ANNOTATION_LIST_COLUMNS if include_geometry else _ANNOTATION_LIST_COLUMNS.replace(", geometry", "")
     cur = get_cursor()
     cur.execute(
-        """
-        SELECT id, page_number, type, geometry, text, region_id, created_at, region_s3_key
+        f"""
+        SELECT {columns}
         FROM annotations
         WHERE document_id = ?
         ORDER BY created_at ASC
         """,
         (document_id,)
     )
-    return [
-        {
-            "id": r[0],
-            "page_number": r[1],
-            "type": r[2],
-            "geometry": json.loads(r[3]) if r[3] else None,
-            "text": r[4],
-            "region_id": r[5],
-            "created_at": r[6],
-            "region_s3_key": r[7],
-        }
-        for r in cur.fetchall()
-    ]
+    return [_annotation_from_row(r, include_geometry) for r in cur.fetchall()]
+
+
+def migrate_pack_annotation_geometry():
+    cur = get_cursor()
+
+    # Geometry used to be stored as JSON text; rewrite it packed (geometry.py).
+    # Rows whose shape can't be packed stay JSON, which readers still accept.
+    cur.execute(
+        "SELECT id, geometry FROM annotations WHERE typeof(geometry) = 'text'"
+    )
+    updates = []
+    for annotation_id, stored in cur.fetchall():
+        try:
+            packed = pack_geometry(json.loads(stored))
+        except ValueError:
+            continue
+        if isinstance(packed, bytes):
+            updates.append((packed, annotation_id))
+
+    if updates:
+        cur.executemany("UPDATE annotations SET geometry = ? WHERE id = ?", updates)
+        logger.info("packed geometry of %d annotations", len(updates))
+
+
+def init_annotation_index():
+    cur = get_cursor()
+
+    cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'annotation_boxes'"
+    )
+    exists = cur.fetchone() is not None
+
+    # R-tree over each annotation's bounding box, keyed by file and page so a
+    # viewport query only touches one document's visible pages. Coordinates
+    # are the normalized page fractions the viewer sends (geometry.py).
+    cur.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS annotation_boxes USING rtree(
+        id,
+        file_min, file_max,
+        page_min, page_max,
+        x0, x1,
+        y0, y1
+    )
+    """)
+
+    # Boxes are added by create_annotation (packed geometry can't be read
+    # from SQL); deletes, including cascades, go through the trigger
+    cur.execute("DROP TRIGGER IF EXISTS annotation_boxes_ai")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS annotation_boxes_ad AFTER DELETE ON annotations BEGIN
+        DELETE FROM annotation_boxes WHERE id = old.id;
+    END
+    """)
+
+    # Index annotations that existed before the index did
+    if not exists:
+        cur.execute(
+            """
+            SELECT a.id, f.id, a.page_number, a.geometry
+            FROM annotations a
+            JOIN files f ON f.document_id = a.document_id
+            WHERE a.geometry IS NOT NULL
+            """
+        )
+        boxes = []
+        for annotation_id, file_id, page_number, stored in cur.fetchall():
+            bbox = geometry_bbox(unpack_geometry(stored))
+            if bbox:
+                boxes.append((annotation_id, file_id, file_id, page_number, page_number, bbox[0], bbox[2], bbox[1], bbox[3]))
+        cur.executemany("INSERT INTO annotation_boxes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", boxes)
+
+
+def index_annotation_box(annotation_id: int, document_id: str, page_number: int, geometry):
+    bbox = geometry_bbox(geometry)
+    if not bbox:
+        return
+
+    x0, y0, x1, y1 = bbox
+    cur = get_cursor()
+    cur.execute(
+        """
+        INSERT INTO annotation_boxes
+        SELECT ?, id, id, ?, ?, ?, ?, ?, ?
+        FROM files
+        WHERE document_id = ?
+        """,
+        (annotation_id, page_number, page_number, x0, x1, y0, y1, document_id),
+    )
+
+
+def get_annotations_in_viewport(file_id: int, document_id: str, rects):
+    """
+    Annotations whose bounding box intersects any of the visible rects.
+
+    rects: [(page_number, x0, y0, x1, y1)] in normalized page coordinates
+    """
+    if not rects:
+        return []
+
+    # One R-tree probe per rect; OR-ing them would defeat the index
+    probe = """
+        SELECT id FROM annotation_boxes
+        WHERE file_min <= ? AND file_max >= ?
+          AND page_min <= ? AND page_max >= ?
+          AND x0 <= ? AND x1 >= ?
+          AND y0 <= ? AND y1 >= ?
+    """
+    params = []
+    for page_number, x0, y0, x1, y1 in rects:
+        params += [file_id, file_id, page_number, page_number, x1, x0, y1, y0]
+
+    cur = get_cursor()
+    cur.execute(
+        f"""
+        SELECT {_ANNOTATION_LIST_COLUMNS}
+        FROM annotations
+        WHERE id IN ({" UNION ".join([probe] * len(rects))})
+          AND document_id = ?
+        ORDER BY created_at ASC
+        """,
+        (*params, document_id),
+    )
+    return [_annotation_from_row(r) for r in cur.fetchall()]
 
 
 # ======================================================
@@ -299,6 +932,12 @@ def init_folders():
         FOREIGN KEY (parent_id) REFERENCES folders(id)
     )
     """)
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_folders_user_parent ON folders (user_id, parent_id)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_folders_parent ON folders (parent_id)"
+    )
 
 
 def init_files():
@@ -315,6 +954,9 @@ def init_files():
         FOREIGN KEY (folder_id) REFERENCES folders(id)
     )
     """)
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_files_folder ON files (folder_id)"
+    )
 
 
 def create_folder(name: str, user_id: int, parent_id: Optional[int] = None):
@@ -361,15 +1003,93 @@ def list_folders(user_id: int, parent_id: Optional[int] = None):
     }
 
 
-
-def create_file(folder_id, document_id, title, user_id):
+def get_folder_tree(
+    user_id: int,
+    root_id: Optional[int] = None,
+    max_depth: Optional[int] = None,
+):
+    """
+    Return the user's folder hierarchy (or the subtree under root_id) as
+    nested dicts, with direct and recursive file counts, from one query.
+    Recursive counts only cover folders within max_depth.
+    """
+    cur = get_cursor()
+
+    # path (",1,4,9,") lists the folders above a row; a folder already on
+    # it closes a parent cycle and isn't followed again
+    columns = "id, name, parent_id, created_at, 0, ',' || id || ','"
+    if root_id is None:
+        anchor = f"SELECT {columns} FROM folders WHERE user_id = ? AND parent_id IS NULL"
+        params = [user_id]
+    else:
+        anchor = f"SELECT {columns} FROM folders WHERE user_id = ? AND id = ?"
+        params = [user_id, root_id]
+
+    depth_sql = ""
+    if max_depth is not None:
+        depth_sql = "AND t.depth < ?"
+        params.append(max_depth)
+
+    cur.execute(
+        f"""
+        WITH RECURSIVE tree(id, name, parent_id, created_at, depth, path) AS (
+            {anchor}
+            UNION ALL
+            SELECT f.id, f.name, f.parent_id, f.created_at, t.depth + 1, t.path || f.id || ','
+            FROM folders f
+            JOIN tree t ON f.parent_id = t.id
+            WHERE instr(t.path, ',' || f.id || ',') = 0 {depth_sql}
+        )
+        SELECT t.id, t.name, t.parent_id, t.depth, COALESCE(c.n, 0)
+        FROM tree t
+        LEFT JOIN (
+            SELECT folder_id, COUNT(*) AS n
+            FROM files
+            WHERE user_id = ? AND folder_id IS NOT NULL
+            GROUP BY folder_id
+        ) c ON c.folder_id = t.id
+        ORDER BY t.depth ASC, t.created_at ASC, t.id ASC
+        """,
+        (*params, user_id),
+    )
+    rows = cur.fetchall()
+
+    nodes = {}
+    roots = []
+    for folder_id, name, parent_id, depth, file_count in rows:
+        node = {
+            "id": folder_id,
+            "name": name,
+            "parent_id": parent_id,
+            "depth": depth,
+            "file_count": file_count,
+            "total_file_count": file_count,
+            "children": [],
+        }
+        nodes[folder_id] = node
+        # Rows are ordered by depth, so parents are always seen first
+        if depth == 0:
+            roots.append(node)
+        else:
+            nodes[parent_id]["children"].append(node)
+
+    # Deepest first, so each child's total is final before it is added up
+    for folder_id, _, parent_id, depth, _ in reversed(rows):
+        if depth > 0:
+            nodes[parent_id]["total_file_count"] += nodes[folder_id]["total_file_count"]
+
+    return roots
+
+
+def create_file(folder_id, document_id, title, user_id, content_hash=None, s3_key=None):
+    # No s3_key means a standalone chat; a PDF's row is created with its key
     cur = get_cursor()
     cur.execute(
         """
-        INSERT INTO files (folder_id, document_id, title, user_id)
-        VALUES (?, ?, ?, ?)
+        INSERT INTO files (folder_id, document_id, title, user_id, content_hash, s3_key)
+        VALUES (?, ?, ?, ?, ?, ?)
         """,
-        (folder_id, document_id, title, user_id)
+        (folder_id, document_id, title, user_id, content_hash, s3_key)
     )
     return cur.lastrowid
 
@@ -378,7 +1098,7 @@ def get_file(file_id):
     cur = get_cursor()
     cur.execute(
         """
-        SELECT id, folder_id, document_id, title, s3_key, created_at
+        SELECT id, folder_id, document_id, title, s3_key, created_at, content_hash
         FROM files
         WHERE id = ?
         """,
@@ -395,33 +1115,73 @@ def get_file(file_id):
         "title": row[3],
         "s3_key": row[4],
         "created_at": row[5],
+        "content_hash": row[6],
     }
 
 
-def list_files(user_id=1):
+def encode_file_cursor(created_at, file_id) -> str:
+    return base64.urlsafe_b64encode(f"{created_at}|{file_id}".encode("utf-8")).decode("ascii")
+
+
+def decode_file_cursor(cursor: str):
+    try:
+        created_at, file_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").rsplit("|", 1)
+        return created_at, int(file_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def list_files(
+    user_id=1,
+    folder_id: Optional[int] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+):
+    """
+    List a user's files newest first.
+
+    parent_file_id is stored on the file when a child chat is created, so
+    this is a single index range scan on (user_id, created_at, id). With a
+    limit, pages are keyset-paginated: pass back the returned next_cursor.
+    """
     cur = get_cursor()
+
+    where = ["user_id = ?"]
+    params = [user_id]
+
+    if folder_id is not None:
+        where.append("folder_id = ?")
+        params.append(folder_id)
+
+    if cursor:
+        created_at, last_id = decode_file_cursor(cursor)
+        where.append("(created_at, id) < (?, ?)")
+        params += [created_at, last_id]
+
+    limit_sql = ""
+    if limit is not None:
+        # Fetch one extra row to know whether another page exists
+        limit_sql = "LIMIT ?"
+        params.append(limit + 1)
+
     cur.execute(
-        """
-        SELECT
-            f.id,
-            f.folder_id,
-            f.title,
-            f.s3_key,
-            f.created_at,
-            pf.id AS parent_file_id
-        FROM files f
-        LEFT JOIN chat_threads ct
-            ON ct.file_id = f.id
-            AND ct.source_annotation_id IS NOT NULL
-            AND f.s3_key IS NULL
-        LEFT JOIN annotations a ON a.id = ct.source_annotation_id
-        LEFT JOIN files pf ON pf.document_id = a.document_id
-        WHERE f.user_id = ?
-        ORDER BY f.created_at DESC
+        f"""
+        SELECT id, folder_id, title, s3_key, created_at, parent_file_id
+        FROM files
+        WHERE {" AND ".join(where)}
+        ORDER BY created_at DESC, id DESC
+        {limit_sql}
         """,
-        (user_id,)
+        params,
     )
-    return [
+    rows = cur.fetchall()
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_file_cursor(rows[-1][4], rows[-1][0])
+
+    files = [
         {
             "id": r[0],
             "folder_id": r[1],
@@ -430,15 +1190,17 @@ def list_files(user_id=1):
             "created_at": r[4],
             "parent_file_id": r[5],
         }
-        for r in cur.fetchall()
+        for r in rows
     ]
+    return files, next_cursor
 
 
-def update_file_s3_key(file_id, s3_key):
+def update_file_pdf(file_id, s3_key, content_hash):
+    # A revised PDF: new object and hash (which also re-keys rendered images)
     cur = get_cursor()
     cur.execute(
-        "UPDATE files SET s3_key = ? WHERE id = ?",
-        (s3_key, file_id)
+        "UPDATE files SET s3_key = ?, content_hash = ? WHERE id = ?",
+        (s3_key, content_hash, file_id)
     )
 
 
@@ -448,6 +1210,11 @@ def get_document_id_by_file(file_id):
     row = cur.fetchone()
     return row[0] if row else None
 
+def document_exists(document_id: str) -> bool:
+    cur = get_cursor()
+    cur.execute("SELECT 1 FROM files WHERE document_id = ?", (document_id,))
+    return cur.fetchone() is not None
+
 def rename_file(file_id: int, new_title: str):
     cur = get_cursor()
     cur.execute(
@@ -481,93 +1248,139 @@ def rename_folder(folder_id: int, new_name: str):
     return True
 
 
-def delete_file_cascade(file_id: int):
-    cur = get_cursor()
+# Temp tables holding every id a cascade will remove
+CASCADE_TEMP_TABLES = {
+    "del_files": "id INTEGER PRIMARY KEY, document_id TEXT",
+    "del_folders": "id INTEGER PRIMARY KEY",
+    "del_annotations": "id INTEGER PRIMARY KEY",
+    "del_threads": "id INTEGER PRIMARY KEY",
+    "del_messages": "id INTEGER PRIMARY KEY",
+}
 
-    # Remove a file and all related chat threads, annotations, messages, and highlights.
-    document_id = get_document_id_by_file(file_id)
-    if not document_id:
-        raise Exception("File not found")
 
-    # 0. Delete child chats created from highlights in this file
+def _reset_cascade_tables(cur):
+    for name, columns in CASCADE_TEMP_TABLES.items():
+        cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS {name} ({columns})")
+        cur.execute(f"DELETE FROM temp.{name}")
+
+
+def _cascade_delete(cur):
+    """
+    Delete everything reachable from temp.del_files / temp.del_folders.
+
+    Child chats spawned from highlights in a doomed file are doomed too,
+    transitively. Each table is then cleared with a single statement.
+    Returns the S3 keys and document ids the caller should purge.
+    """
+    # 1. Close over child chat files spawned from annotations in doomed files
     cur.execute(
         """
-        SELECT id, file_id
-        FROM chat_threads
-        WHERE source_annotation_id IN (
-            SELECT id FROM annotations WHERE document_id = ?
+        WITH RECURSIVE doomed(id, document_id) AS (
+            SELECT id, document_id FROM temp.del_files
+            UNION
+            SELECT cf.id, cf.document_id
+            FROM doomed d
+            JOIN annotations a ON a.document_id = d.document_id
+            JOIN chat_threads ct ON ct.source_annotation_id = a.id
+            JOIN files cf ON cf.id = ct.file_id
         )
-        """,
-        (document_id,),
+        INSERT OR IGNORE INTO temp.del_files (id, document_id)
+        SELECT id, document_id FROM doomed
+        """
     )
-    child_threads = cur.fetchall()
-    for thread_id, child_file_id in child_threads:
-        if child_file_id and child_file_id != file_id:
-            delete_file_cascade(child_file_id)
-        else:
-            cur.execute(
-                """
-                DELETE FROM chat_highlights
-                WHERE message_id IN (
-                    SELECT id FROM messages WHERE chat_thread_id = ?
-                )
-                """,
-                (thread_id,),
-            )
-            cur.execute(
-                "DELETE FROM messages WHERE chat_thread_id = ?",
-                (thread_id,),
-            )
-            cur.execute(
-                "DELETE FROM chat_threads WHERE id = ?",
-                (thread_id,),
-            )
 
-    # 0. Delete chat highlights referencing messages from this document
+    # 2. Collect dependent ids
     cur.execute(
         """
-        DELETE FROM chat_highlights
-        WHERE message_id IN (
-            SELECT id FROM messages WHERE document_id = ?
-        )
-        """,
-        (document_id,),
+        INSERT INTO temp.del_annotations (id)
+        SELECT a.id
+        FROM annotations a
+        JOIN temp.del_files df ON df.document_id = a.document_id
+        """
     )
-
-    # 1. Delete messages
     cur.execute(
-        "DELETE FROM messages WHERE document_id = ?",
-        (document_id,)
+        """
+        INSERT INTO temp.del_threads (id)
+        SELECT id FROM chat_threads
+        WHERE file_id IN (SELECT id FROM temp.del_files)
+        UNION
+        SELECT id FROM chat_threads
+        WHERE source_annotation_id IN (SELECT id FROM temp.del_annotations)
+        """
+    )
+    cur.execute(
+        """
+        INSERT INTO temp.del_messages (id)
+        SELECT m.id
+        FROM messages m
+        JOIN temp.del_files df ON df.document_id = m.document_id
+        UNION
+        SELECT id FROM messages
+        WHERE chat_thread_id IN (SELECT id FROM temp.del_threads)
+        """
     )
 
-    # 2. Delete chat threads (IMPORTANT)
+    # 3. Gather S3 objects before their rows disappear
     cur.execute(
-        "DELETE FROM chat_threads WHERE file_id = ?",
-        (file_id,)
+        """
+        SELECT s3_key FROM files
+        WHERE id IN (SELECT id FROM temp.del_files) AND s3_key IS NOT NULL
+        UNION ALL
+        SELECT region_s3_key FROM annotations
+        WHERE id IN (SELECT id FROM temp.del_annotations) AND region_s3_key IS NOT NULL
+        """
     )
+    s3_keys = [r[0] for r in cur.fetchall()]
+
+    cur.execute("SELECT document_id FROM temp.del_files")
+    document_ids = [r[0] for r in cur.fetchall()]
 
-    # 3. Delete chat highlights
+    # 4. One DELETE per table, children before parents
     cur.execute(
         """
         DELETE FROM chat_highlights
-        WHERE annotation_id IN (
-            SELECT id FROM annotations WHERE document_id = ?
-        )
-        """,
-        (document_id,),
+        WHERE message_id IN (SELECT id FROM temp.del_messages)
+           OR annotation_id IN (SELECT id FROM temp.del_annotations)
+        """
     )
-
-    # 4. Delete annotations
+    cur.execute("DELETE FROM messages WHERE id IN (SELECT id FROM temp.del_messages)")
+    cur.execute("DELETE FROM chat_threads WHERE id IN (SELECT id FROM temp.del_threads)")
+    cur.execute("DELETE FROM annotations WHERE id IN (SELECT id FROM temp.del_annotations)")
     cur.execute(
-        "DELETE FROM annotations WHERE document_id = ?",
-        (document_id,)
+        "DELETE FROM pages WHERE document_id IN (SELECT document_id FROM temp.del_files)"
     )
+    cur.execute(
+        "DELETE FROM page_layouts WHERE document_id IN (SELECT document_id FROM temp.del_files)"
+    )
+    cur.execute(
+        "DELETE FROM document_summaries WHERE document_id IN (SELECT document_id FROM temp.del_files)"
+    )
+    cur.execute("DELETE FROM files WHERE id IN (SELECT id FROM temp.del_files)")
+    cur.execute("DELETE FROM folders WHERE id IN (SELECT id FROM temp.del_folders)")
+
+    for name in CASCADE_TEMP_TABLES:
+        cur.execute(f"DELETE FROM temp.{name}")
+
+    return {
+        "s3_keys": s3_keys,
+        "document_ids": document_ids,
+    }
+
+
+def delete_file_cascade(file_id: int):
+    cur = get_cursor()
+
+    # Remove a file and all related chat threads, annotations, messages, and highlights.
+    document_id = get_document_id_by_file(file_id)
+    if not document_id:
+        raise Exception("File not found")
 
-    # 5. Delete file
+    _reset_cascade_tables(cur)
     cur.execute(
-        "DELETE FROM files WHERE id = ?",
-        (file_id,)
+        "INSERT INTO temp.del_files (id, document_id) VALUES (?, ?)",
+        (file_id, document_id),
     )
+    return _cascade_delete(cur)
 
 
 def delete_annotation(annotation_id: int):
@@ -584,9 +1397,10 @@ def delete_annotation(annotation_id: int):
         (annotation_id,),
     )
     child_threads = cur.fetchall()
+    s3_keys = []
     for thread_id, file_id in child_threads:
         if file_id:
-            delete_file_cascade(file_id)
+            s3_keys += delete_file_cascade(file_id)["s3_keys"]
         else:
             cur.execute(
                 "DELETE FROM messages WHERE chat_thread_id = ?",
@@ -630,9 +1444,13 @@ def delete_annotation(annotation_id: int):
         (annotation_id,)
     )
 
+    if region_s3_key:
+        s3_keys.append(region_s3_key)
+
     return {
         "document_id": document_id,
         "region_s3_key": region_s3_key,
+        "s3_keys": s3_keys,
     }
 
 def set_folder_parent(folder_id: int, parent_id: Optional[int]):
@@ -658,6 +1476,83 @@ def migrate_add_chat_thread_id_to_messages():
             "ALTER TABLE messages ADD COLUMN chat_thread_id INTEGER"
         )
 
+def migrate_add_content_hash_to_files():
+    cur = get_cursor()
+
+    # sha256 of the uploaded PDF; keys the rendered page cache
+    cur.execute("PRAGMA table_info(files)")
+    columns = [row[1] for row in cur.fetchall()]
+
+    if "content_hash" not in columns:
+        cur.execute(
+            "ALTER TABLE files ADD COLUMN content_hash TEXT"
+        )
+
+def migrate_add_parent_file_id_to_files():
+    cur = get_cursor()
+
+    # Denormalized "chat spawned from a highlight in file X" link for list_files
+    cur.execute("PRAGMA table_info(files)")
+    columns = [row[1] for row in cur.fetchall()]
+
+    if "parent_file_id" not in columns:
+        cur.execute(
+            "ALTER TABLE files ADD COLUMN parent_file_id INTEGER"
+        )
+        cur.execute(
+            """
+            UPDATE files
+            SET parent_file_id = (
+                SELECT pf.id
+                FROM chat_threads ct
+                JOIN annotations a ON a.id = ct.source_annotation_id
+                JOIN files pf ON pf.document_id = a.document_id
+                WHERE ct.file_id = files.id
+                ORDER BY ct.id ASC
+                LIMIT 1
+            )
+            WHERE s3_key IS NULL
+            """
+        )
+
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_files_user_created
+        ON files (user_id, created_at DESC, id DESC)
+        """
+    )
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_files_user_folder_created
+        ON files (user_id, folder_id, created_at DESC, id DESC)
+        """
+    )
+
+def migrate_add_fork_to_chat_threads():
+    cur = get_cursor()
+
+    # A fork sees its parent thread's messages up to fork_message_id (and
+    # the parent's own parent's, and so on) without copying them
+    cur.execute("PRAGMA table_info(chat_threads)")
+    columns = [row[1] for row in cur.fetchall()]
+
+    if "parent_thread_id" not in columns:
+        cur.execute(
+            "ALTER TABLE chat_threads ADD COLUMN parent_thread_id INTEGER REFERENCES chat_threads(id)"
+        )
+    if "fork_message_id" not in columns:
+        cur.execute(
+            "ALTER TABLE chat_threads ADD COLUMN fork_message_id INTEGER"
+        )
+
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_chat_threads_parent ON chat_threads (parent_thread_id)"
+    )
+    # History reads take the last few messages of each thread in the chain
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_thread ON messages (chat_thread_id, id)"
+    )
+
 def init_chat_threads():
     cur = get_cursor()
     cur.execute("""
@@ -671,27 +1566,57 @@ def init_chat_threads():
         FOREIGN KEY (source_annotation_id) REFERENCES annotations(id)
     )
     """)
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_chat_threads_file ON chat_threads (file_id)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_chat_threads_source_annotation ON chat_threads (source_annotation_id)"
+    )
 
 def create_chat_thread(
     file_id: Optional[int] = None,
     source_annotation_id: Optional[int] = None,
     title: Optional[str] = None,
+    parent_thread_id: Optional[int] = None,
+    fork_message_id: Optional[int] = None,
 ):
     cur = get_cursor()
     cur.execute(
         """
-        INSERT INTO chat_threads (file_id, source_annotation_id, title)
-        VALUES (?, ?, ?)
+        INSERT INTO chat_threads (file_id, source_annotation_id, title, parent_thread_id, fork_message_id)
+        VALUES (?, ?, ?, ?, ?)
         """,
-        (file_id, source_annotation_id, title),
+        (file_id, source_annotation_id, title, parent_thread_id, fork_message_id),
+    )
+    thread_id = cur.lastrowid
+
+    if file_id is not None and source_annotation_id is not None:
+        set_parent_file_from_annotation(file_id, source_annotation_id)
+
+    return thread_id
+
+def set_parent_file_from_annotation(file_id: int, source_annotation_id: int):
+    # A chat file spawned from a highlight belongs under the highlighted file
+    cur = get_cursor()
+    cur.execute(
+        """
+        UPDATE files
+        SET parent_file_id = (
+            SELECT pf.id
+            FROM annotations a
+            JOIN files pf ON pf.document_id = a.document_id
+            WHERE a.id = ?
+        )
+        WHERE id = ? AND s3_key IS NULL AND parent_file_id IS NULL
+        """,
+        (source_annotation_id, file_id),
     )
-    return cur.lastrowid
 
 def get_chat_threads_by_file(file_id: int):
     cur = get_cursor()
     cur.execute(
         """
-        SELECT id, source_annotation_id, title
+        SELECT id, source_annotation_id, title, parent_thread_id, fork_message_id
         FROM chat_threads
         WHERE file_id = ?
         ORDER BY created_at ASC
@@ -703,10 +1628,156 @@ def get_chat_threads_by_file(file_id: int):
             "id": r[0],
             "source_annotation_id": r[1],
             "title": r[2],
+            "parent_thread_id": r[3],
+            "fork_message_id": r[4],
         }
         for r in cur.fetchall()
     ]
 
+def get_chat_thread(thread_id: int):
+    cur = get_cursor()
+    cur.execute(
+        """
+        SELECT id, file_id, source_annotation_id, title, parent_thread_id, fork_message_id
+        FROM chat_threads
+        WHERE id = ?
+        """,
+        (thread_id,),
+    )
+    row = cur.fetchone()
+    if not row:
+        return None
+
+    return {
+        "id": row[0],
+        "file_id": row[1],
+        "source_annotation_id": row[2],
+        "title": row[3],
+        "parent_thread_id": row[4],
+        "fork_message_id": row[5],
+    }
+
+# Longest chain of forks whose history a thread sees
+MAX_FORK_DEPTH = 32
+
+# The thread and its ancestors, each with the last message id it
+# contributes (NULL for the thread itself) and its distance from the thread
+_THREAD_CHAIN = f"""
+WITH RECURSIVE chain(thread_id, upto, depth) AS (
+    SELECT ?, NULL, 0
+    UNION ALL
+    SELECT ct.parent_thread_id, ct.fork_message_id, chain.depth + 1
+    FROM chain
+    JOIN chat_threads ct ON ct.id = chain.thread_id
+    WHERE ct.parent_thread_id IS NOT NULL AND chain.depth < {MAX_FORK_DEPTH}
+)
+"""
+
+def get_thread_history(
+    chat_thread_id: int,
+    limit: Optional[int] = None,
+    exclude_message_id: Optional[int] = None,
+):
+    """
+    Messages a thread sees, oldest first: its ancestors' up to each fork
+    point, then its own. With limit, only the last `limit` of them, and no
+    thread in the chain is read past that many messages.
+    """
+    cur = get_cursor()
+    cur.execute(
+        _THREAD_CHAIN + """
+        SELECT m.id, m.chat_thread_id, m.role, m.content, m.annotation_id, m.reference
+        FROM chain
+        JOIN messages m ON m.id IN (
+            SELECT id
+            FROM messages
+            WHERE chat_thread_id = chain.thread_id
+              AND (chain.upto IS NULL OR id <= chain.upto)
+              AND id IS NOT ?
+            ORDER BY id DESC
+            LIMIT ?
+        )
+        ORDER BY chain.depth ASC, m.id DESC
+        LIMIT ?
+        """,
+        (chat_thread_id, exclude_message_id, limit or -1, limit or -1),
+    )
+    return [
+        {
+            "id": r[0],
+            "chat_thread_id": r[1],
+            "role": r[2],
+            "content": cleanup_math_blocks(r[3]),
+            "annotation_id": r[4],
+            "reference": json.loads(r[5]) if r[5] else None,
+        }
+        for r in reversed(cur.fetchall())
+    ]
+
+def get_fork_point(parent_thread_id: int, message_id: Optional[int] = None):
+    """
+    Where a fork of parent_thread_id at message_id attaches:
+    (thread_id, message_id), the thread being the one that owns the message,
+    which may be an ancestor of parent_thread_id. Without message_id, the
+    parent's latest message. None if the message isn't in the parent's
+    history.
+    """
+    cur = get_cursor()
+    if message_id is None:
+        cur.execute(
+            "SELECT MAX(id) FROM messages WHERE chat_thread_id = ?",
+            (parent_thread_id,),
+        )
+        # An empty parent: the fork still inherits the parent's own history
+        return parent_thread_id, cur.fetchone()[0] or 0
+
+    cur.execute(
+        _THREAD_CHAIN + """
+        SELECT m.chat_thread_id
+        FROM chain
+        JOIN messages m ON m.chat_thread_id = chain.thread_id
+        WHERE m.id = ? AND (chain.upto IS NULL OR m.id <= chain.upto)
+        """,
+        (parent_thread_id, message_id),
+    )
+    row = cur.fetchone()
+    if not row:
+        return None
+    return row[0], message_id
+
+def save_messages_to_thread(chat_thread_id: int, document_id: str, messages):
+    """
+    Insert many messages in one statement; returns their ids in order.
+
+    messages: [{"role", "content", "annotation_id"?}]
+    """
+    if not messages:
+        return []
+
+    cur = get_cursor()
+    cur.executemany(
+        """
+        INSERT INTO messages (
+            chat_thread_id,
+            document_id,
+            role,
+            content,
+            annotation_id
+        )
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        [
+            (chat_thread_id, document_id, m["role"], m["content"], m.get("annotation_id"))
+            for m in messages
+        ],
+    )
+
+    # The write lock is held, so the AUTOINCREMENT ids are consecutive
+    cur.execute("SELECT last_insert_rowid()")
+    last_id = cur.fetchone()[0]
+    return list(range(last_id - len(messages) + 1, last_id + 1))
+
+
 def save_message_to_thread(
     chat_thread_id: int,
     document_id: str,
@@ -800,6 +1871,27 @@ def save_chat_highlight(
     )
 
 
+def get_highlighted_message(annotation_id: int):
+    """
+    The message a chat_text annotation highlights: (message_id,
+    chat_thread_id), or None
+    """
+    cur = get_cursor()
+    cur.execute(
+        """
+        SELECT m.id, m.chat_thread_id
+        FROM chat_highlights ch
+        JOIN messages m ON m.id = ch.message_id
+        WHERE ch.annotation_id = ?
+        ORDER BY ch.id ASC
+        LIMIT 1
+        """,
+        (annotation_id,),
+    )
+    row = cur.fetchone()
+    return (row[0], row[1]) if row else None
+
+
 def get_chat_highlights_by_document(document_id: str):
     cur = get_cursor()
     cur.execute(
@@ -929,42 +2021,31 @@ def migrate_backfill_child_chat_threads():
                 (annotation_id, thread_id),
             )
 
-def get_child_folders(folder_id: int):
+def delete_folder_cascade(folder_id: int):
     cur = get_cursor()
-    cur.execute(
-        "SELECT id FROM folders WHERE parent_id = ?",
-        (folder_id,)
-    )
-    return [r[0] for r in cur.fetchall()]
 
-def get_files_in_folder(folder_id: int):
-    cur = get_cursor()
+    # Resolve the whole folder subtree and every file in it up front
+    _reset_cascade_tables(cur)
     cur.execute(
-        "SELECT id FROM files WHERE folder_id = ?",
-        (folder_id,)
+        """
+        WITH RECURSIVE subtree(id) AS (
+            SELECT id FROM folders WHERE id = ?
+            UNION
+            SELECT f.id FROM folders f JOIN subtree s ON f.parent_id = s.id
+        )
+        INSERT INTO temp.del_folders (id)
+        SELECT id FROM subtree
+        """,
+        (folder_id,),
     )
-    return [r[0] for r in cur.fetchall()]
-
-def delete_folder_cascade(folder_id: int):
-    cur = get_cursor()
-
-    # 1. Delete files in this folder
-    file_ids = get_files_in_folder(folder_id)
-    for file_id in file_ids:
-        if not get_document_id_by_file(file_id):
-            continue
-        delete_file_cascade(file_id)
-
-    # 2. Delete child folders (recursive)
-    child_folders = get_child_folders(folder_id)
-    for child_id in child_folders:
-        delete_folder_cascade(child_id)
-
-    # 3. Delete the folder itself
     cur.execute(
-        "DELETE FROM folders WHERE id = ?",
-        (folder_id,)
+        """
+        INSERT INTO temp.del_files (id, document_id)
+        SELECT id, document_id FROM files
+        WHERE folder_id IN (SELECT id FROM temp.del_folders)
+        """
     )
+    return _cascade_delete(cur)
 
 def get_next_chat_title(user_id: int) -> str:
     cur = get_cursor()
@@ -985,11 +2066,13 @@ def create_standalone_chat(
     folder_id: Optional[int] = None,
     title: Optional[str] = None,
     source_annotation_id: Optional[int] = None,
+    parent_thread_id: Optional[int] = None,
+    fork_message_id: Optional[int] = None,
 ):
     """
     Creates:
     - a file entry representing the chat
-    - a document-level chat thread
+    - a document-level chat thread, forked from parent_thread_id if given
     Returns file + thread info
     """
 
@@ -1014,18 +2097,23 @@ def create_standalone_chat(
     # 2. Create document-level chat thread
     cur.execute(
         """
-        INSERT INTO chat_threads (file_id, source_annotation_id, title)
-        VALUES (?, ?, ?)
+        INSERT INTO chat_threads (file_id, source_annotation_id, title, parent_thread_id, fork_message_id)
+        VALUES (?, ?, ?, ?, ?)
         """,
-        (file_id, source_annotation_id, title),
+        (file_id, source_annotation_id, title, parent_thread_id, fork_message_id),
     )
     thread_id = cur.lastrowid
 
+    if source_annotation_id is not None:
+        set_parent_file_from_annotation(file_id, source_annotation_id)
+
     return {
         "file_id": file_id,
         "document_id": document_id,
         "thread_id": thread_id,
         "title": title,
+        "parent_thread_id": parent_thread_id,
+        "fork_message_id": fork_message_id,
     }
 
 def get_chat_thread_by_annotation(annotation_id: int):
@@ -1036,6 +2124,7 @@ def get_chat_thread_by_annotation(annotation_id: int):
         FROM chat_threads ct
         JOIN files f ON f.id = ct.file_id
         WHERE ct.source_annotation_id = ?
+        ORDER BY ct.id ASC
         LIMIT 1
         """,
         (annotation_id,),
@@ -1053,23 +2142,677 @@ def get_chat_thread_by_annotation(annotation_id: int):
     }
 
 
+# ======================================================
+# Full-text search
+# ======================================================
+
+# FTS5 indexes over pages.text, messages.content and annotations.text.
+# They are external-content tables: the text lives only in the source table
+# and triggers keep the index in sync.
+SEARCH_SOURCES = {
+    "pages": ("pages", "id", "text"),
+    "messages": ("messages", "id", "content"),
+    "annotations": ("annotations", "id", "text"),
+}
+
+
+def init_search():
+    cur = get_cursor()
+
+    for table, rowid_col, column in SEARCH_SOURCES.values():
+        fts = f"{table}_fts"
+
+        cur.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (fts,),
+        )
+        exists = cur.fetchone() is not None
+
+        cur.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+            {column},
+            content='{table}',
+            content_rowid='{rowid_col}',
+            prefix='2 3',
+            tokenize='porter unicode61 remove_diacritics 2'
+        )
+        """)
+
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts} (rowid, {column}) VALUES (new.{rowid_col}, new.{column});
+        END
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {column})
+            VALUES ('delete', old.{rowid_col}, old.{column});
+        END
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {column} ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {column})
+            VALUES ('delete', old.{rowid_col}, old.{column});
+            INSERT INTO {fts} (rowid, {column}) VALUES (new.{rowid_col}, new.{column});
+        END
+        """)
+
+        # Index rows that existed before the search index did
+        if not exists:
+            cur.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+
+
+def build_fts_query(query: str) -> Optional[str]:
+    # Quote each term so user input can't inject FTS5 syntax; prefix-match the
+    # last term (search-as-you-type) once it is long enough to be selective
+    terms = [t.replace('"', '""') for t in query.split()]
+    terms = [t for t in terms if t]
+    if not terms:
+        return None
+
+    quoted = [f'"{t}"' for t in terms]
+    if len(terms[-1]) >= 3:
+        quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+# snippet() marks matches with these control characters; the text is
+# HTML-escaped before they become <mark> tags, since it is user content
+_MATCH_START, _MATCH_END = "\x02", "\x03"
+
+
+def highlight_snippet(snippet: Optional[str]) -> Optional[str]:
+    if snippet is None:
+        return None
+    parts = []
+    for i, chunk in enumerate(snippet.split(_MATCH_START)):
+        if i == 0:
+            parts.append(html.escape(chunk))
+            continue
+        match, _, rest = chunk.partition(_MATCH_END)
+        parts.append(f"<mark>{html.escape(match)}</mark>{html.escape(rest)}")
+    return "".join(parts)
+
+
+def search_document_pages(document_id: str, query: str, limit: int = 3):
+    """
+    Page numbers of one document matching query, best first
+    """
+    match = build_fts_query(query)
+    if not match:
+        return []
+
+    cur = get_cursor()
+    cur.execute(
+        """
+        SELECT p.page_number
+        FROM pages_fts
+        JOIN pages p ON p.id = pages_fts.rowid
+        WHERE pages_fts MATCH ? AND p.document_id = ?
+        ORDER BY bm25(pages_fts)
+        LIMIT ?
+        """,
+        (match, document_id, limit),
+    )
+    return [r[0] for r in cur.fetchall()]
+
+
+def search(
+    user_id: int,
+    query: str,
+    folder_id: Optional[int] = None,
+    kinds=("pages", "messages", "annotations"),
+    limit: int = 20,
+):
+    match = build_fts_query(query)
+    if not match:
+        return []
+
+    cur = get_cursor()
+
+    # Restrict to files in the folder subtree when a folder is given
+    if folder_id is not None:
+        scope_cte = """
+        WITH RECURSIVE subtree(id) AS (
+            SELECT ?
+            UNION
+            SELECT fo.id FROM folders fo JOIN subtree s ON fo.parent_id = s.id
+        )
+        """
+        scope_sql = "AND f.folder_id IN (SELECT id FROM subtree)"
+        scope_params = (folder_id,)
+    else:
+        scope_cte = ""
+        scope_sql = ""
+        scope_params = ()
+
+    results = []
+
+    if "pages" in kinds:
+        cur.execute(
+            f"""
+            {scope_cte}
+            SELECT
+                f.id, f.title, p.page_number,
+                snippet(pages_fts, 0, char(2), char(3), '…', 16),
+                bm25(pages_fts)
+            FROM pages_fts
+            JOIN pages p ON p.id = pages_fts.rowid
+            JOIN files f ON f.document_id = p.document_id
+            WHERE pages_fts MATCH ? AND f.user_id = ? {scope_sql}
+            ORDER BY bm25(pages_fts)
+            LIMIT ?
+            """,
+            (*scope_params, match, user_id, limit),
+        )
+        results += [
+            {
+                "kind": "page",
+                "file_id": r[0],
+                "file_title": r[1],
+                "page_number": r[2],
+                "snippet": highlight_snippet(r[3]),
+                "score": r[4],
+            }
+            for r in cur.fetchall()
+        ]
+
+    if "messages" in kinds:
+        cur.execute(
+            f"""
+            {scope_cte}
+            SELECT
+                f.id, f.title, m.id, m.chat_thread_id, m.role,
+                snippet(messages_fts, 0, char(2), char(3), '…', 16),
+                bm25(messages_fts)
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            JOIN files f ON f.document_id = m.document_id
+            WHERE messages_fts MATCH ? AND f.user_id = ? {scope_sql}
+            ORDER BY bm25(messages_fts)
+            LIMIT ?
+            """,
+            (*scope_params, match, user_id, limit),
+        )
+        results += [
+            {
+                "kind": "message",
+                "file_id": r[0],
+                "file_title": r[1],
+                "message_id": r[2],
+                "chat_thread_id": r[3],
+                "role": r[4],
+                "snippet": highlight_snippet(r[5]),
+                "score": r[6],
+            }
+            for r in cur.fetchall()
+        ]
+
+    if "annotations" in kinds:
+        cur.execute(
+            f"""
+            {scope_cte}
+            SELECT
+                f.id, f.title, a.id, a.page_number, a.type,
+                snippet(annotations_fts, 0, char(2), char(3), '…', 16),
+                bm25(annotations_fts)
+            FROM annotations_fts
+            JOIN annotations a ON a.id = annotations_fts.rowid
+            JOIN files f ON f.document_id = a.document_id
+            WHERE annotations_fts MATCH ? AND f.user_id = ? {scope_sql}
+            ORDER BY bm25(annotations_fts)
+            LIMIT ?
+            """,
+            (*scope_params, match, user_id, limit),
+        )
+        results += [
+            {
+                "kind": "annotation",
+                "file_id": r[0],
+                "file_title": r[1],
+                "annotation_id": r[2],
+                "page_number": r[3] if r[3] > 0 else None,
+                "type": r[4],
+                "snippet": highlight_snippet(r[5]),
+                "score": r[6],
+            }
+            for r in cur.fetchall()
+        ]
+
+    # bm25() is lower-is-better
+    results.sort(key=lambda r: r["score"])
+    return results[:limit]
+
+
+# ======================================================
+# Usage and budgets
+# ======================================================
+
+def init_llm_usage():
+    cur = get_cursor()
+    # One row per answered question (message_id set) or batch of background
+    # calls (summaries); kept when files and messages are deleted so spend
+    # still counts against budgets. Cost in micro-USD, time in unix seconds.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS llm_usage (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        file_id INTEGER,
+        chat_thread_id INTEGER,
+        message_id INTEGER,
+        route TEXT NOT NULL,
+        model TEXT,
+        input_tokens INTEGER NOT NULL,
+        cached_tokens INTEGER NOT NULL,
+        output_tokens INTEGER NOT NULL,
+        cost_microusd INTEGER NOT NULL,
+        latency_ms INTEGER NOT NULL,
+        created_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+    )
+    """)
+    # Budget checks read one user's spend this period from the index alone;
+    # per-user rollups use it to find the period's rows
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_llm_usage_user_time ON llm_usage(user_id, created_at, cost_microusd)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_llm_usage_file ON llm_usage(file_id)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_llm_usage_thread ON llm_usage(chat_thread_id)"
+    )
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_budgets (
+        user_id INTEGER PRIMARY KEY,
+        period TEXT NOT NULL DEFAULT 'month',
+        downgrade_usd REAL,
+        limit_usd REAL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+
+def save_usage(rows):
+    """
+    rows: [{"user_id", "file_id", "chat_thread_id", "message_id", "route",
+    plus a usage.totals() record}]
+    """
+    cur = get_cursor()
+    cur.executemany(
+        """
+        INSERT INTO llm_usage (
+            user_id, file_id, chat_thread_id, message_id, route, model,
+            input_tokens, cached_tokens, output_tokens, cost_microusd, latency_ms
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        [
+            (
+                r["user_id"], r.get("file_id"), r.get("chat_thread_id"), r.get("message_id"),
+                r["route"], r["model"],
+                r["input_tokens"], r["cached_tokens"], r["output_tokens"],
+                round(r["cost_usd"] * 1_000_000), r["latency_ms"],
+            )
+            for r in rows
+        ],
+    )
+
+
+def get_spend_usd(user_id: int, since: int) -> float:
+    cur = get_cursor()
+    cur.execute(
+        """
+        SELECT COALESCE(SUM(cost_microusd), 0)
+        FROM llm_usage
+        WHERE user_id = ? AND created_at >= ?
+        """,
+        (user_id, since),
+    )
+    return cur.fetchone()[0] / 1_000_000
+
+
+USAGE_GROUPS = {
+    "thread": "chat_thread_id",
+    "file": "file_id",
+    "user": "user_id",
+    "model": "model",
+    "route": "route",
+    "day": "date(created_at, 'unixepoch')",
+}
+
+
+def get_usage_rollups(
+    user_id: int,
+    group_by: str,
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+    file_id: Optional[int] = None,
+    chat_thread_id: Optional[int] = None,
+    limit: int = 100,
+):
+    """
+    Usage summed per USAGE_GROUPS key, most expensive first
+    """
+    key = USAGE_GROUPS[group_by]
+    where = ["user_id = ?"]
+    params = [user_id]
+    for column, op, value in (
+        ("created_at", ">=", since),
+        ("created_at", "<", until),
+        ("file_id", "=", file_id),
+        ("chat_thread_id", "=", chat_thread_id),
+    ):
+        if value is not None:
+            where.append(f"{column} {op} ?")
+            params.append(value)
+
+    cur = get_cursor()
+    cur.execute(
+        f"""
+        SELECT
+            {key},
+            COUNT(message_id),
+            COUNT(*),
+            SUM(input_tokens),
+            SUM(cached_tokens),
+            SUM(output_tokens),
+            SUM(cost_microusd),
+            AVG(latency_ms),
+            MAX(created_at)
+        FROM llm_usage
+        WHERE {" AND ".join(where)}
+        GROUP BY 1
+        ORDER BY SUM(cost_microusd) DESC
+        LIMIT ?
+        """,
+        (*params, limit),
+    )
+    return [
+        {
+            group_by: r[0],
+            "messages": r[1],
+            "records": r[2],
+            "input_tokens": r[3],
+            "cached_tokens": r[4],
+            "output_tokens": r[5],
+            "cost_usd": r[6] / 1_000_000,
+            "avg_latency_ms": round(r[7]),
+            "last_used_at": r[8],
+        }
+        for r in cur.fetchall()
+    ]
+
+
+def get_user_budget(user_id: int):
+    cur = get_cursor()
+    cur.execute(
+        "SELECT period, downgrade_usd, limit_usd FROM user_budgets WHERE user_id = ?",
+        (user_id,),
+    )
+    row = cur.fetchone()
+    if not row:
+        return None
+    return {"user_id": user_id, "period": row[0], "downgrade_usd": row[1], "limit_usd": row[2]}
+
+
+def set_user_budget(user_id: int, period: str, downgrade_usd: Optional[float], limit_usd: Optional[float]):
+    cur = get_cursor()
+    cur.execute(
+        """
+        INSERT INTO user_budgets (user_id, period, downgrade_usd, limit_usd)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            period = excluded.period,
+            downgrade_usd = excluded.downgrade_usd,
+            limit_usd = excluded.limit_usd,
+            updated_at = CURRENT_TIMESTAMP
+        """,
+        (user_id, period, downgrade_usd, limit_usd),
+    )
+
+
+# ======================================================
+# Library export and import
+# ======================================================
+
+# One user's rows of each table a library archive carries, in the order an
+# import has to insert them. Ids are the exporting database's; an import
+# gives every row a new one. page_layouts, the OCR cache and usage rows are
+# left out: they are rebuilt or belong to this installation.
+EXPORT_QUERIES = {
+    "folders": """
+        SELECT id, name, parent_id, created_at
+        FROM folders
+        WHERE user_id = ?
+        ORDER BY id
+    """,
+    "files": """
+        SELECT id, folder_id, document_id, title, s3_key, content_hash, parent_file_id, created_at
+        FROM files
+        WHERE user_id = ?
+        ORDER BY id
+    """,
+    "pages": """
+        SELECT p.document_id, p.page_number, p.text, p.content_hash, p.summary
+        FROM files f
+        JOIN pages p ON p.document_id = f.document_id
+        WHERE f.user_id = ?
+        ORDER BY f.id, p.page_number
+    """,
+    "document_summaries": """
+        SELECT s.document_id, s.level, s.start_page, s.end_page, s.title, s.summary, s.source_hash, s.created_at
+        FROM files f
+        JOIN document_summaries s ON s.document_id = f.document_id
+        WHERE f.user_id = ?
+        ORDER BY f.id, s.level, s.start_page
+    """,
+    "annotations": """
+        SELECT a.id, a.document_id, a.page_number, a.type, a.geometry, a.text, a.region_s3_key, a.created_at
+        FROM files f
+        JOIN annotations a ON a.document_id = f.document_id
+        WHERE f.user_id = ?
+        ORDER BY a.id
+    """,
+    "chat_threads": """
+        SELECT ct.id, ct.file_id, ct.source_annotation_id, ct.title, ct.parent_thread_id, ct.fork_message_id, ct.created_at
+        FROM files f
+        JOIN chat_threads ct ON ct.file_id = f.id
+        WHERE f.user_id = ?
+        ORDER BY ct.id
+    """,
+    # In id order, so imported ids keep the order forked histories rely on
+    "messages": """
+        SELECT m.id, m.chat_thread_id, m.document_id, m.role, m.content, m.annotation_id, m.reference, m.created_at
+        FROM files f
+        JOIN chat_threads ct ON ct.file_id = f.id
+        JOIN messages m ON m.chat_thread_id = ct.id
+        WHERE f.user_id = ?
+        ORDER BY m.id
+    """,
+    "chat_highlights": """
+        SELECT ch.id, ch.annotation_id, ch.message_id, ch.start, ch.end, ch.created_at
+        FROM files f
+        JOIN annotations a ON a.document_id = f.document_id
+        JOIN chat_highlights ch ON ch.annotation_id = a.id
+        WHERE f.user_id = ?
+        ORDER BY ch.id
+    """,
+}
+
+# Columns an import writes (besides the new id)
+IMPORT_COLUMNS = {
+    "folders": ("name", "parent_id", "user_id", "created_at"),
+    "files": ("folder_id", "document_id", "title", "s3_key", "user_id", "content_hash", "created_at"),
+    "pages": ("document_id", "page_number", "text", "content_hash", "summary"),
+    "document_summaries": ("document_id", "level", "start_page", "end_page", "title", "summary", "source_hash", "created_at"),
+    "annotations": ("document_id", "page_number", "type", "geometry", "text", "region_id", "region_s3_key", "created_at"),
+    "chat_threads": ("file_id", "source_annotation_id", "title", "created_at"),
+    "messages": ("chat_thread_id", "document_id", "role", "content", "annotation_id", "reference", "created_at"),
+    "chat_highlights": ("annotation_id", "message_id", "start", "end", "created_at"),
+}
+
+
+@contextmanager
+def read_snapshot():
+    """
+    Run a long read (an export) against one consistent view of the
+    database: a read transaction on this thread's connection, ended on exit.
+    Writers aren't blocked, but the WAL can't be checkpointed past it.
+    """
+    conn = get_connection()
+    if conn.in_transaction:
+        raise RuntimeError("read_snapshot inside an open transaction")
+    conn.execute("BEGIN DEFERRED")
+    try:
+        yield
+    finally:
+        conn.rollback()
+
+
+def iter_export_rows(table: str, user_id: int, batch_size: int = 1000):
+    """
+    Yield one user's rows of an EXPORT_QUERIES table as lists of dicts, a
+    batch at a time. Annotation geometry comes back unpacked.
+    """
+    cur = get_cursor()
+    cur.execute(EXPORT_QUERIES[table], (user_id,))
+    columns = [d[0] for d in cur.description]
+
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            return
+        batch = [dict(zip(columns, r)) for r in rows]
+        if table == "annotations":
+            for row in batch:
+                row["geometry"] = unpack_geometry(row["geometry"])
+        yield batch
+
+
+def insert_rows(table: str, rows):
+    """
+    Insert many rows of an IMPORT_COLUMNS table in one statement. Returns
+    their new ids in order (tables with an id column).
+
+    rows: tuples in IMPORT_COLUMNS[table] order
+    """
+    if not rows:
+        return []
+
+    columns = IMPORT_COLUMNS[table]
+    cur = get_cursor()
+    cur.executemany(
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+        rows,
+    )
+    if table in ("pages", "document_summaries"):
+        return []
+
+    # The write lock is held, so the AUTOINCREMENT ids are consecutive
+    cur.execute("SELECT last_insert_rowid()")
+    last_id = cur.fetchone()[0]
+    return list(range(last_id - len(rows) + 1, last_id + 1))
+
+
+def set_imported_links(table: str, column: str, pairs):
+    """
+    pairs: [(value, id)]; links between imported rows of one table, set once
+    all of them have ids
+    """
+    if table not in ("folders", "files", "chat_threads") or column not in (
+        "parent_id", "parent_file_id", "parent_thread_id", "fork_message_id"
+    ):
+        raise ValueError(f"can't set {table}.{column}")
+
+    cur = get_cursor()
+    cur.executemany(f"UPDATE {table} SET {column} = ? WHERE id = ?", pairs)
+
+
+def index_annotation_boxes(boxes):
+    """
+    Add many annotations to the viewport index at once.
+
+    boxes: [(annotation_id, file_id, page_number, geometry)]
+    """
+    rows = []
+    for annotation_id, file_id, page_number, geometry in boxes:
+        bbox = geometry_bbox(geometry)
+        if bbox:
+            rows.append((annotation_id, file_id, file_id, page_number, page_number, bbox[0], bbox[2], bbox[1], bbox[3]))
+
+    if rows:
+        cur = get_cursor()
+        cur.executemany("INSERT INTO annotation_boxes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+def folder_exists(folder_id: int, user_id: int) -> bool:
+    cur = get_cursor()
+    cur.execute("SELECT 1 FROM folders WHERE id = ? AND user_id = ?", (folder_id, user_id))
+    return cur.fetchone() is not None
+
+
 # ======================================================
 # Init everything ONCE
 # ======================================================
 
-init_pages()
-init_messages()
-init_annotations()
-init_users()
-init_folders()
-init_files()
-migrate_add_chat_thread_id_to_messages()
-init_chat_threads()
-init_chat_highlights()
-migrate_backfill_child_chat_threads()
+def init_db():
+    """
+    Create tables and run migrations; called from the app's lifespan hook
+    """
+    cur = get_cursor()
+
+    # Persistent on the file; lets readers run alongside one writer
+    cur.execute("PRAGMA journal_mode = WAL")
+
+    # Every worker process runs this on startup; holding the write lock for
+    # the whole setup makes them take turns instead of racing on ALTER TABLE
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        _init_schema()
+        commit()
+    except Exception:
+        rollback()
+        raise
+
+
+def _init_schema():
+    init_pages()
+    migrate_add_content_hash_to_pages()
+    migrate_add_summary_to_pages()
+    migrate_add_id_to_pages()
+    init_page_layouts()
+    init_document_summaries()
+    init_ocr_cache()
+    init_messages()
+    init_annotations()
+    migrate_pack_annotation_geometry()
+    init_users()
+    init_folders()
+    init_files()
+    migrate_add_content_hash_to_files()
+    migrate_add_chat_thread_id_to_messages()
+    init_chat_threads()
+    migrate_add_fork_to_chat_threads()
+    migrate_add_parent_file_id_to_files()
+    init_chat_highlights()
+    migrate_backfill_child_chat_threads()
+    init_search()
+    init_annotation_index()
+    init_llm_usage()
+
+def _end_write(outcome: str):
+    # How long this thread held the write lock; long holds stall every
+    # other writer (and worker process) behind busy_timeout
+    started = getattr(_local, "write_started", None)
+    if started is not None:
+        _local.write_started = None
+        observe("sqlite_write_transaction_seconds", time.perf_counter() - started, outcome=outcome)
 
 def rollback():
-    conn.rollback()
+    get_connection().rollback()
+    _end_write("rollback")
 
 def commit():
-    conn.commit()
+    get_connection().commit()
+    _end_write("commit")
@@ -0,0 +1,130 @@
+# Helpers for normalized annotation geometry sent by the PDF viewer.
+# geometry.py
+#
+# The frontend stores rectangles as fractions of the rendered page:
+#   {"x": 0.1, "y": 0.2, "width": 0.3, "height": 0.05}
+# A geometry payload can be a single rect, a list of rects, or {"rects": [...]}.
+#
+# Stored packed (pack_geometry): a version byte, a shape byte, then x, y,
+# width, height per rect as little-endian float32. Payloads that don't fit
+# that layout are stored as JSON text instead.
+import json
+import struct
+
+GEOMETRY_VERSION = 1
+
+# How the rects were wrapped, so unpacking returns the same shape
+SHAPE_RECT = 0
+SHAPE_LIST = 1
+SHAPE_RECTS_KEY = 2
+
+RECT_KEYS = ("x", "y", "width", "height")
+
+_HEADER = struct.Struct("<BB")
+_rects_structs = {}
+
+
+def geometry_rects(geometry):
+    """
+    Return the list of rect dicts contained in a geometry payload
+    """
+    if not geometry:
+        return []
+
+    if isinstance(geometry, list):
+        rects = geometry
+    elif isinstance(geometry, dict) and isinstance(geometry.get("rects"), list):
+        rects = geometry["rects"]
+    else:
+        rects = [geometry]
+
+    return [
+        r for r in rects
+        if isinstance(r, dict) and all(k in r for k in ("x", "y", "width", "height"))
+    ]
+
+
+def geometry_bbox(geometry):
+    """
+    Return (x0, y0, x1, y1) enclosing every rect, clamped to the page, or None
+    """
+    rects = geometry_rects(geometry)
+    if not rects:
+        return None
+
+    x0 = min(float(r["x"]) for r in rects)
+    y0 = min(float(r["y"]) for r in rects)
+    x1 = max(float(r["x"]) + float(r["width"]) for r in rects)
+    y1 = max(float(r["y"]) + float(r["height"]) for r in rects)
+
+    x0, y0 = max(x0, 0.0), max(y0, 0.0)
+    x1, y1 = min(x1, 1.0), min(y1, 1.0)
+    if x1 <= x0 or y1 <= y0:
+        return None
+
+    return (x0, y0, x1, y1)
+
+
+def _rects_struct(n: int) -> struct.Struct:
+    packer = _rects_structs.get(n)
+    if packer is None:
+        packer = _rects_structs[n] = struct.Struct(f"<{4 * n}f")
+    return packer
+
+
+def _is_plain_rect(r) -> bool:
+    # Exactly the four numeric keys; anything else would be lost by packing
+    return (
+        isinstance(r, dict)
+        and len(r) == 4
+        and all(type(r.get(k)) in (int, float) for k in RECT_KEYS)
+    )
+
+
+def pack_geometry(geometry):
+    """
+    Encode a geometry payload for storage: packed bytes, JSON text for
+    shapes the packed layout can't represent, or None
+    """
+    if not geometry:
+        return None
+
+    if isinstance(geometry, list):
+        shape, rects = SHAPE_LIST, geometry
+    elif isinstance(geometry, dict) and list(geometry) == ["rects"] and isinstance(geometry["rects"], list):
+        shape, rects = SHAPE_RECTS_KEY, geometry["rects"]
+    else:
+        shape, rects = SHAPE_RECT, [geometry]
+
+    if not all(_is_plain_rect(r) for r in rects):
+        return json.dumps(geometry)
+
+    values = [r[k] for r in rects for k in RECT_KEYS]
+    return _HEADER.pack(GEOMETRY_VERSION, shape) + _rects_struct(len(rects)).pack(*values)
+
+
+def unpack_geometry(stored):
+    """
+    Decode a stored geometry (packed bytes or legacy JSON text)
+    """
+    if stored is None:
+        return None
+    if isinstance(stored, str):
+        return json.loads(stored)
+
+    version, shape = _HEADER.unpack_from(stored)
+    if version != GEOMETRY_VERSION:
+        raise ValueError(f"Unknown geometry encoding version {version}")
+
+    n = (len(stored) - _HEADER.size) // 16
+    v = _rects_struct(n).unpack_from(stored, _HEADER.size)
+    rects = [
+        {"x": v[i], "y": v[i + 1], "width": v[i + 2], "height": v[i + 3]}
+        for i in range(0, 4 * n, 4)
+    ]
+
+    if shape == SHAPE_RECT:
+        return rects[0]
+    if shape == SHAPE_RECTS_KEY:
+        return {"rects": rects}
+    return rects
@@ -0,0 +1,222 @@
+# Block- and line-level page layout extracted with PyMuPDF, packed into arrays.
+# layout.py
+#
+# One page's layout is stored as a single row: the text of every line, and
+# parallel float/int arrays for the bounding boxes, so loading a page is one
+# small read and lookups are plain array scans. Boxes are normalized to the
+# displayed (rotated) page, the same space as annotation geometry.
+from array import array
+
+from geometry import geometry_rects
+
+LAYOUT_VERSION = 1
+
+
+class PageLayout:
+    """
+    Text blocks (paragraphs) and their lines for one page.
+
+    block_boxes / line_boxes: array('f') of x0, y0, x1, y1 per block / line
+    line_blocks:  array('I'), the block each line belongs to
+    line_offsets: array('I'), len(lines) + 1 offsets into text; lines are
+                  newline-terminated and blocks are contiguous runs of lines
+    """
+
+    __slots__ = ("text", "block_boxes", "line_boxes", "line_blocks", "line_offsets")
+
+    def __init__(self, text, block_boxes, line_boxes, line_blocks, line_offsets):
+        self.text = text
+        self.block_boxes = block_boxes
+        self.line_boxes = line_boxes
+        self.line_blocks = line_blocks
+        self.line_offsets = line_offsets
+
+    @property
+    def block_count(self) -> int:
+        return len(self.block_boxes) // 4
+
+    @property
+    def line_count(self) -> int:
+        return len(self.line_blocks)
+
+    def line_text(self, i: int) -> str:
+        return self.text[self.line_offsets[i]:self.line_offsets[i + 1]].rstrip("\n")
+
+    def block_text(self, b: int) -> str:
+        lines = [i for i in range(self.line_count) if self.line_blocks[i] == b]
+        if not lines:
+            return ""
+        return self.text[self.line_offsets[lines[0]]:self.line_offsets[lines[-1] + 1]].rstrip("\n")
+
+    def block_box(self, b: int):
+        return tuple(self.block_boxes[4 * b:4 * b + 4])
+
+    def blocks_in(self, geometry, margin: float = 0.0):
+        """
+        Indices of blocks whose box intersects any rect of the geometry
+        """
+        return _hits(self.block_boxes, geometry, margin)
+
+    def lines_in(self, geometry, margin: float = 0.0):
+        """
+        Indices of lines whose box intersects any rect of the geometry
+        """
+        return _hits(self.line_boxes, geometry, margin)
+
+    def context_for(self, geometry, neighbours: int = 1, max_chars: int = 6000, margin: float = 0.0) -> str:
+        """
+        Text of the blocks under the geometry plus `neighbours` blocks on
+        either side, in reading order; "" if nothing on the page matches
+        """
+        hits = self.blocks_in(geometry, margin)
+        if not hits:
+            return ""
+
+        first = max(0, hits[0] - neighbours)
+        last = min(self.block_count - 1, hits[-1] + neighbours)
+
+        parts = []
+        size = 0
+        for b in range(first, last + 1):
+            text = self.block_text(b)
+            if not text:
+                continue
+            size += len(text)
+            if parts and size > max_chars:
+                break
+            parts.append(text)
+        return "\n\n".join(parts)
+
+    def to_row(self):
+        return (
+            LAYOUT_VERSION,
+            self.text,
+            self.block_boxes.tobytes(),
+            self.line_boxes.tobytes(),
+            self.line_blocks.tobytes(),
+            self.line_offsets.tobytes(),
+        )
+
+    @classmethod
+    def from_row(cls, row):
+        version, text, block_boxes, line_boxes, line_blocks, line_offsets = row
+        if version != LAYOUT_VERSION:
+            return None
+        return cls(
+            text,
+            _unpack("f", block_boxes),
+            _unpack("f", line_boxes),
+            _unpack("I", line_blocks),
+            _unpack("I", line_offsets),
+        )
+
+
+def _unpack(typecode: str, data: bytes) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    return values
+
+
+def _hits(boxes: array, geometry, margin: float):
+    rects = [
+        (
+            float(r["x"]) - margin,
+            float(r["y"]) - margin,
+            float(r["x"]) + float(r["width"]) + margin,
+            float(r["y"]) + float(r["height"]) + margin,
+        )
+        for r in geometry_rects(geometry)
+    ]
+    if not rects:
+        return []
+
+    hits = []
+    for i in range(len(boxes) // 4):
+        x0, y0, x1, y1 = boxes[4 * i:4 * i + 4]
+        for rx0, ry0, rx1, ry1 in rects:
+            if x0 < rx1 and rx0 < x1 and y0 < ry1 and ry0 < y1:
+                hits.append(i)
+                break
+    return hits
+
+
+def extract_page_layout(page, textpage=None) -> PageLayout:
+    """
+    Build the layout of one fitz.Page from get_text("dict"), text blocks only.
+
+    Pass the TextPage already used for get_text() to avoid parsing the page
+    a second time.
+    """
+    import fitz
+
+    page_rect = page.rect
+    width = page_rect.width or 1.0
+    height = page_rect.height or 1.0
+    # get_text() boxes are unrotated; annotation geometry is on the page as
+    # shown. Rotations are multiples of 90 degrees, so mapping two corners
+    # and sorting is exact.
+    a, b, c, d, e, f = page.rotation_matrix
+    ox, oy = page_rect.x0, page_rect.y0
+
+    def normalized(bbox):
+        x0, y0, x1, y1 = bbox
+        px0, px1 = a * x0 + c * y0 + e, a * x1 + c * y1 + e
+        py0, py1 = b * x0 + d * y0 + f, b * x1 + d * y1 + f
+        if px0 > px1:
+            px0, px1 = px1, px0
+        if py0 > py1:
+            py0, py1 = py1, py0
+        return (
+            (px0 - ox) / width,
+            (py0 - oy) / height,
+            (px1 - ox) / width,
+            (py1 - oy) / height,
+        )
+
+    block_boxes = array("f")
+    line_boxes = array("f")
+    line_blocks = array("I")
+    line_offsets = array("I")
+    chunks = []
+    offset = 0
+
+    if textpage is None:
+        textpage = page.get_textpage(flags=fitz.TEXTFLAGS_TEXT)
+    data = page.get_text("dict", textpage=textpage)
+    for block in data["blocks"]:
+        if block.get("type") != 0:
+            continue
+
+        lines = []
+        for line in block["lines"]:
+            text = "".join(span["text"] for span in line["spans"]).strip()
+            if text:
+                lines.append((text, line["bbox"]))
+        if not lines:
+            continue
+
+        block_index = len(block_boxes) // 4
+        block_boxes.extend(normalized(block["bbox"]))
+        for text, bbox in lines:
+            line_boxes.extend(normalized(bbox))
+            line_blocks.append(block_index)
+            line_offsets.append(offset)
+            chunks.append(text + "\n")
+            offset += len(text) + 1
+
+    line_offsets.append(offset)
+    return PageLayout("".join(chunks), block_boxes, line_boxes, line_blocks, line_offsets)
+
+
+def load_page_layout(document_id: str, s3_key: str, page_number: int) -> PageLayout:
+    """
+    Extract one page's layout from the cached PDF (for documents uploaded
+    before layouts were stored)
+    """
+    # Not at module level: db.py imports this module, pdf_cache needs S3 config
+    from pdf_cache import open_document
+
+    with open_document(document_id, s3_key) as doc:
+        if page_number < 1 or page_number > doc.page_count:
+            raise ValueError(f"Page {page_number} out of range")
+        return extract_page_layout(doc[page_number - 1])
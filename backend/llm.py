@@ -0,0 +1,388 @@
+# OpenAI Responses API gateway: limits, retries and a circuit breaker, with
+# each call recorded as an "llm" span.
+# llm.py
+#
+# Every call goes through, in order:
+#   single-flight   identical in-flight requests share one upstream call
+#   circuit breaker fail fast while the API keeps failing
+#   rate limits     token buckets for requests and tokens per minute
+#   concurrency     at most LLM_MAX_CONCURRENCY calls upstream at once
+#   retries         429 / 5xx / timeouts, jittered backoff, Retry-After
+# all bounded by one per-call deadline. Limits are per process.
+import contextvars
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from metrics import span, inc
+
+# Upstream calls in flight at once
+MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+# Requests and tokens per minute, set to the account's tier (0 = unlimited)
+RPM_LIMIT = int(os.getenv("LLM_RPM", "0"))
+TPM_LIMIT = int(os.getenv("LLM_TPM", "0"))
+# Retries after the first attempt, for retryable errors only
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+RETRY_BASE_S = float(os.getenv("LLM_RETRY_BASE_S", "0.5"))
+RETRY_MAX_S = float(os.getenv("LLM_RETRY_MAX_S", "8"))
+# Per attempt, and for the whole call including queueing and retries
+ATTEMPT_TIMEOUT_S = float(os.getenv("LLM_TIMEOUT_S", "60"))
+DEADLINE_S = float(os.getenv("LLM_DEADLINE_S", "120"))
+# Consecutive failed attempts that open the breaker, and how long it stays open
+BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+BREAKER_RESET_S = float(os.getenv("LLM_BREAKER_RESET_S", "30"))
+# Output tokens reserved per call when max_output_tokens isn't given
+DEFAULT_OUTPUT_TOKENS = 1000
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+# USD per million tokens: (input, cached input, output). Update with the
+# price list; unknown models cost 0.
+PRICES = {
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+}
+
+
+class LLMUnavailable(Exception):
+    """
+    The call was not (or could not be) completed: breaker open, deadline
+    passed, or retries exhausted. retry_after is a hint in seconds.
+    """
+
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Return the OpenAI client, creating it on first use.
+
+    The openai package takes most of a second to import, so it is not loaded
+    at startup.
+    """
+    global client
+    if client is None:
+        with _client_lock:
+            if client is None:
+                from openai import OpenAI
+
+                # Retries and timeouts are handled here, not by the SDK
+                client = OpenAI(max_retries=0, timeout=ATTEMPT_TIMEOUT_S)
+    return client
+
+
+# ======================================================
+# Limits
+# ======================================================
+
+class TokenBucket:
+    """
+    Refills rate_per_minute units per minute, up to one minute's worth
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(rate_per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount: float, deadline: float):
+        # A single request bigger than the bucket would never fit
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.level >= amount:
+                    self.level -= amount
+                    return
+                wait = (amount - self.level) / self.rate
+
+            if now + wait > deadline:
+                raise LLMUnavailable("LLM rate limit: deadline passed while queued", retry_after=wait)
+            time.sleep(min(wait, 1.0))
+
+    def adjust(self, amount: float):
+        # Settle an estimate against actual usage; may go negative
+        with self.lock:
+            self._refill(time.monotonic())
+            self.level -= amount
+
+
+class CircuitBreaker:
+    """
+    closed -> open after BREAKER_FAILURES consecutive failures (5xx, timeouts,
+    connection errors); open -> one trial call (half-open) after
+    BREAKER_RESET_S; success closes it again
+    """
+
+    def __init__(self, failures: int, reset_s: float):
+        self.failures_to_open = failures
+        self.reset_s = reset_s
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.reset_s - time.monotonic()
+            if remaining > 0 or self.trial_running:
+                raise LLMUnavailable("LLM circuit breaker is open", retry_after=max(remaining, 1.0))
+            self.trial_running = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def cancel_trial(self):
+        # The trial call never reached the API; let the next caller try
+        with self.lock:
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            reopen = self.trial_running
+            self.trial_running = False
+            if reopen or (self.opened_at is None and self.failures >= self.failures_to_open):
+                self.opened_at = time.monotonic()
+                inc("llm_breaker_opened_total")
+
+    def state(self) -> str:
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half_open" if self.trial_running else "open"
+
+
+_requests_bucket = TokenBucket(RPM_LIMIT) if RPM_LIMIT else None
+_tokens_bucket = TokenBucket(TPM_LIMIT) if TPM_LIMIT else None
+_slots = threading.BoundedSemaphore(MAX_CONCURRENCY)
+breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_RESET_S)
+
+
+def estimate_tokens(kwargs) -> int:
+    # ~4 characters per token, plus the output we may get back
+    prompt_chars = len(json.dumps(kwargs.get("input", ""), default=str))
+    return prompt_chars // 4 + int(kwargs.get("max_output_tokens") or DEFAULT_OUTPUT_TOKENS)
+
+
+def _retry_delay(error, attempt: int) -> float:
+    # Honour the server's hint, otherwise full-jitter exponential backoff
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        # A little jitter so callers told the same thing don't return in lockstep
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000 * random.uniform(1.0, 1.2)
+        if headers.get("retry-after"):
+            return float(headers["retry-after"]) * random.uniform(1.0, 1.2)
+    except ValueError:
+        pass
+    return random.uniform(0, min(RETRY_MAX_S, RETRY_BASE_S * (2 ** attempt)))
+
+
+def _is_retryable(error) -> bool:
+    import openai
+
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return getattr(error, "status_code", None) in RETRYABLE_STATUS
+
+
+def cost_usd(model: str, input_tokens: int, cached_tokens: int, output_tokens: int) -> float:
+    """
+    Price of one call; cached_tokens are the part of input_tokens served
+    from the prompt cache
+    """
+    input_price, cached_price, output_price = PRICES.get(model, (0.0, 0.0, 0.0))
+    return (
+        (input_tokens - cached_tokens) * input_price
+        + cached_tokens * cached_price
+        + output_tokens * output_price
+    ) / 1_000_000
+
+
+# Upstream calls made inside track_usage() blocks
+_usage = contextvars.ContextVar("llm_usage", default=None)
+
+
+@contextmanager
+def track_usage():
+    """
+    Collect the usage of every upstream call made inside the block (in this
+    context) as {"model", "input_tokens", "cached_tokens", "output_tokens",
+    "seconds"}. Calls answered by an identical in-flight request cost
+    nothing and add no entry.
+    """
+    calls = []
+    token = _usage.set(calls)
+    try:
+        yield calls
+    finally:
+        _usage.reset(token)
+
+
+# ======================================================
+# Calls
+# ======================================================
+
+# 0 = every caller makes its own upstream call
+COALESCE = os.getenv("LLM_COALESCE", "1") != "0"
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def request_key(*parts) -> str:
+    """
+    Hash whatever determines the answer (model, prompt, context) into a key
+    """
+    payload = json.dumps(parts, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def create_response(coalesce_key: str = None, deadline_s: float = None, **kwargs):
+    """
+    Call client.responses.create through the gateway and record latency and
+    token usage.
+
+    Concurrent calls with the same coalesce_key (default: a hash of kwargs)
+    share a single upstream request and all get its response. Raises
+    LLMUnavailable if the call can't complete within deadline_s.
+    """
+    deadline = time.monotonic() + (deadline_s or DEADLINE_S)
+
+    if not COALESCE:
+        return _call_with_retries(deadline, **kwargs)
+
+    model = kwargs.get("model", "unknown")
+    key = coalesce_key or request_key(kwargs)
+
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            _inflight[key] = future
+
+    if not leader:
+        inc("llm_coalesced_total", model=model)
+        with span("llm_coalesced", model):
+            return future.result()
+
+    try:
+        response = _call_with_retries(deadline, **kwargs)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(response)
+        return response
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+
+def _call_with_retries(deadline: float, **kwargs):
+    model = kwargs.get("model", "unknown")
+
+    for attempt in range(MAX_RETRIES + 1):
+        breaker.before_call()
+        try:
+            return _call_once(deadline, **kwargs)
+        except LLMUnavailable:
+            breaker.cancel_trial()
+            raise
+        except Exception as e:
+            if not _is_retryable(e):
+                # e.g. 400: the API is up, the request is wrong
+                breaker.record_success()
+                raise
+            status = getattr(e, "status_code", None)
+            if status == 429:
+                # Rate limited means the API is up: back off, don't trip the breaker
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+
+            reason = str(status or type(e).__name__)
+            delay = _retry_delay(e, attempt)
+            if attempt == MAX_RETRIES or time.monotonic() + delay > deadline:
+                inc("llm_failed_total", model=model, reason=reason)
+                raise LLMUnavailable(f"LLM request failed after {attempt + 1} attempts: {e}", retry_after=delay) from e
+
+            inc("llm_retries_total", model=model, reason=reason)
+            time.sleep(delay)
+
+
+def _call_once(deadline: float, **kwargs):
+    model = kwargs.get("model", "unknown")
+    estimate = estimate_tokens(kwargs)
+
+    with span("llm_queue", model):
+        if _requests_bucket:
+            _requests_bucket.acquire(1, deadline)
+        if _tokens_bucket:
+            _tokens_bucket.acquire(estimate, deadline)
+
+        if not _slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            raise LLMUnavailable("LLM concurrency limit: deadline passed while queued", retry_after=1.0)
+
+    try:
+        timeout = min(ATTEMPT_TIMEOUT_S, deadline - time.monotonic())
+        if timeout <= 0:
+            raise LLMUnavailable("LLM deadline passed before the call started")
+
+        with span("llm", model) as record:
+            response = get_client().responses.create(timeout=timeout, **kwargs)
+
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                record["input_tokens"] = getattr(usage, "input_tokens", 0) or 0
+                record["output_tokens"] = getattr(usage, "output_tokens", 0) or 0
+                details = getattr(usage, "input_tokens_details", None)
+                record["cached_tokens"] = getattr(details, "cached_tokens", 0) or 0
+                inc("llm_tokens_total", record["input_tokens"], model=model, direction="input")
+                inc("llm_tokens_total", record["output_tokens"], model=model, direction="output")
+
+                if _tokens_bucket:
+                    _tokens_bucket.adjust(record["input_tokens"] + record["output_tokens"] - estimate)
+
+        calls = _usage.get()
+        if calls is not None:
+            calls.append({
+                "model": model,
+                "input_tokens": record.get("input_tokens", 0),
+                "cached_tokens": record.get("cached_tokens", 0),
+                "output_tokens": record.get("output_tokens", 0),
+                "seconds": record["duration"],
+            })
+    finally:
+        _slots.release()
+
+    breaker.record_success()
+    return response
+
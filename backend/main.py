@@ -1,29 +1,60 @@
 # API routes for files, chats, annotations, and PDF region workflows.
-from fastapi import FastAPI, Form, UploadFile, File
+from fastapi import FastAPI, Form, UploadFile, File, Header, Response, BackgroundTasks
+from fastapi.responses import PlainTextResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import os
 import uuid
-import fitz
+import zipfile
 from pydantic import BaseModel
 from typing import Union
 from typing import Optional, Literal
 from fastapi import HTTPException
 from dotenv import load_dotenv
-from openai import OpenAI
 import re
 import json
-import boto3
+import time
+import hashlib
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from db import save_pages, get_pages, get_page_count
 from db import get_messages, save_message, get_annotation, get_messages_by_annotation, create_annotation, get_annotations_by_document
-from db import get_file, get_document_id_by_file
-from db import list_files, list_folders
-from s3 import upload_pdf, upload_region_to_s3, delete_s3_object
+from db import get_annotations_in_viewport, search_document_pages
+from db import get_file, get_document_id_by_file, document_exists
+from db import get_ocr_cache, save_ocr_cache, save_ocr_texts
+from db import get_pages_for_summary, save_page_summaries, get_document_summaries, save_document_summaries
+from db import folder_exists
+from db import USAGE_GROUPS, save_usage, get_spend_usd, get_usage_rollups, get_user_budget, set_user_budget
+from db import list_files, list_folders, get_folder_tree
+from s3 import upload_pdf, upload_region_to_s3, delete_s3_objects
 from s3 import generate_presigned_url
+from s3 import get_client as get_s3_client
+from llm import create_response, request_key, track_usage, LLMUnavailable
+from llm import get_client as get_llm_client
+from metrics import MetricsMiddleware, render_metrics, span, inc
+from router import ASK_MODEL, ASK_MODEL_SMALL, PAGE_NEIGHBOURS, DEFINITION_PAGES, classify, model_for, record_route
+from layout import extract_page_layout, load_page_layout
+from summaries import SUMMARIES_ENABLED, plan_sections, source_hash, run_all, schedule
+from summaries import summarize_page, summarize_section, summarize_document, summary_context
+from summaries import shutdown_pool as shutdown_summary_pool
+from archive import stream_export, read_manifest, upload_blobs, import_rows
+from usage import PERIODS, totals as usage_totals, period_start, default_budget, budget_state
+from ocr import OCR_ENABLED, OCRUnavailable, shutdown_pool as shutdown_ocr_pool, needs_ocr, page_content_hash, ocr_cache_key, run_ocr, throughput
+from render import render_region_png, render_thumbnail, render_tile, get_page_sizes
+from render import IMAGE_FORMATS, TILE_SIZE, clamp_zoom
+from tile_cache import tile_key, get_tile, put_tile
+from pdf_cache import store_local_copy, evict_document, open_document, read_pdf_bytes
 from io import BytesIO
+from contextlib import asynccontextmanager
 from db import (
+    init_db,
     rollback,
     create_file,
-    update_file_s3_key,
+    update_file_pdf,
+    get_page_hashes,
+    remap_pages,
+    get_annotation_ids_on_pages,
     rename_file,
     commit,
     delete_file_cascade,
@@ -32,30 +63,76 @@ from db import (
     create_folder,
     rename_folder,
     save_message_to_thread,
+    save_messages_to_thread,
+    save_page_layouts,
+    get_page_layout,
     get_chat_threads_by_file,
     get_messages_by_thread,
+    get_thread_history,
+    get_chat_thread,
+    get_fork_point,
+    get_highlighted_message,
     create_chat_thread,
     delete_folder_cascade,
     create_standalone_chat,
     save_chat_highlight,
     get_chat_highlights_by_document,
     get_chat_thread_by_annotation,
+    search,
 )
 
 
 load_dotenv()  # Load OpenAI API key from .env file
 
-import os
-print("AWS_ACCESS_KEY_ID:", os.getenv("AWS_ACCESS_KEY_ID"))
-print("AWS_S3_BUCKET:", os.getenv("AWS_S3_BUCKET"))
-
 # # Sanity check 
 # assert os.getenv("OPENAI_API_KEY") is not None, "OPENAI_API_KEY not found in environment variables."
 
-client = OpenAI()
+logger = logging.getLogger("engrave")
+
+# Load the OpenAI, S3 and PyMuPDF clients in the background once the server
+# is up (0 = leave them to the first request that needs them)
+WARM_CLIENTS = os.getenv("WARM_CLIENTS", "1") != "0"
+
+
+def warm_clients():
+    """
+    Import and build the heavy clients so the first requests don't pay for it
+    """
+    import fitz  # noqa: F401
+
+    for get_client in (get_s3_client, get_llm_client):
+        try:
+            get_client()
+        except Exception as e:
+            # e.g. no OPENAI_API_KEY yet; the first real call raises instead
+            logger.warning("Client warm-up failed: %s", e)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Schema setup runs here rather than at import time; the heavy clients
+    # are created lazily, so the server accepts requests before they load
+    init_db()
+    if WARM_CLIENTS:
+        threading.Thread(target=warm_clients, daemon=True).start()
+    yield
+    shutdown_ocr_pool()
+    shutdown_summary_pool()
+
 
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+# Per-request SQL / S3 / PDF / LLM spans, exported on /metrics
+app.add_middleware(MetricsMiddleware)
+
+@app.exception_handler(LLMUnavailable)
+def llm_unavailable_handler(request, exc: LLMUnavailable):
+    # Overloaded or failing upstream: tell the client when to come back
+    headers = {}
+    if exc.retry_after:
+        headers["Retry-After"] = str(max(1, round(exc.retry_after)))
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers=headers)
 
 # Configure CORS - allow requests from frontend
 app.add_middleware(
@@ -67,20 +144,416 @@ app.add_middleware(
 ) 
 
 
-def extract_pages_from_pdf_from_bytes(pdf_bytes: bytes, document_id: str):
-    pdf = fitz.open(stream=pdf_bytes, filetype="pdf")
+# Block/line boxes per page (layout.py) for annotation context. By default a
+# page's layout is extracted the first time an annotation on it is asked
+# about; with 1, uploads extract every page up front (about twice the
+# extraction time).
+EXTRACT_LAYOUT = os.getenv("EXTRACT_LAYOUT", "0") == "1"
 
-    pages = []
 
-    for idx, page in enumerate(pdf):
-        pages.append({
-            "document_id": document_id,
-            "page_number": idx + 1,
-            "text": page.get_text(),
-        })
+def extract_pages_from_pdf_from_bytes(pdf_bytes: bytes, document_id: str):
+    import fitz
+
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf:
+        return extract_pages(pdf, document_id)
+
+
+def extract_pages(pdf, document_id: str, page_numbers=None):
+    """
+    Text, layout and content hash of the given pages (default: all) of an
+    opened fitz.Document
+    """
+    import fitz
+
+    if page_numbers is None:
+        page_numbers = range(1, pdf.page_count + 1)
+
+    with span("pdf", "extract_text") as record:
+        pages = []
+
+        for page_number in page_numbers:
+            page = pdf[page_number - 1]
+            # One parse of the page serves both the plain text and the layout
+            textpage = page.get_textpage(flags=fitz.TEXTFLAGS_TEXT)
+            text = page.get_text(textpage=textpage)
+            pages.append({
+                "document_id": document_id,
+                "page_number": page_number,
+                "text": text,
+                "layout": extract_page_layout(page, textpage) if EXTRACT_LAYOUT else None,
+                # Lets a revised upload skip pages that didn't change
+                "content_hash": page_content_hash(page),
+                # Scanned pages are OCR'd after the upload (ocr_document)
+                "needs_ocr": OCR_ENABLED and needs_ocr(page, text),
+            })
+
+        record["pages"] = len(pages)
         
     return pages
 
+
+def diff_page_hashes(old_hashes, new_hashes):
+    """
+    Match a revised PDF's pages to the stored ones by content hash.
+
+    old_hashes: {page_number: hash} as stored; new_hashes: [hash] in page order.
+    Returns (moves, extract, replaced, dropped):
+      moves     {old: new} pages that moved; their annotations follow them
+      extract   new page numbers with new or changed content
+      replaced  old pages whose content changed (stored text is re-extracted;
+                annotations stay on the page, or follow it through moves)
+      dropped   old pages that are gone (their annotations go too)
+    Unchanged pages that kept their number appear in none of these.
+    """
+    in_place = {
+        number
+        for number, h in enumerate(new_hashes, start=1)
+        if h and old_hashes.get(number) == h
+    }
+
+    # Remaining old pages by hash; repeats (e.g. blank pages) match in order
+    by_hash = {}
+    for number in sorted(old_hashes):
+        h = old_hashes[number]
+        if h and number not in in_place:
+            by_hash.setdefault(h, []).append(number)
+
+    moves = {}
+    extract = []
+    for number, h in enumerate(new_hashes, start=1):
+        if number in in_place:
+            continue
+        candidates = by_hash.get(h)
+        if candidates:
+            moves[candidates.pop(0)] = number
+        else:
+            extract.append(number)
+
+    # Changed pages between the same two unchanged ones pair up in order
+    # when both sides have as many, so an edited page keeps its annotations
+    # even when a page inserted earlier shifted it
+    unmatched_old = [n for n in sorted(old_hashes) if n not in in_place and n not in moves]
+    anchors = sorted([(n, n) for n in in_place] + [(new, old) for old, new in moves.items()])
+    anchors = [(0, 0)] + anchors + [(len(new_hashes) + 1, max(old_hashes, default=0) + 1)]
+    edited = {}
+    for (new_lo, old_lo), (new_hi, old_hi) in zip(anchors, anchors[1:]):
+        if old_lo >= old_hi:
+            continue
+        olds = [n for n in unmatched_old if old_lo < n < old_hi]
+        news = [n for n in extract if new_lo < n < new_hi]
+        if olds and len(olds) == len(news):
+            edited.update(zip(olds, news))
+
+    targets = set(edited.values())
+    extracted = set(extract)
+    replaced = []
+    dropped = []
+    for number in unmatched_old:
+        if number in edited:
+            replaced.append(number)
+            if edited[number] != number:
+                moves[number] = edited[number]
+        elif number in extracted and number not in targets:
+            replaced.append(number)
+        else:
+            dropped.append(number)
+    return moves, extract, replaced, dropped
+
+
+def ocr_document(document_id: str, pdf_bytes: bytes, candidates):
+    """
+    OCR a document's text-less pages and write their text to the pages
+    that still have the same content. candidates: {page_number: content hash}
+    """
+    keys = [ocr_cache_key(h) for h in candidates.values()]
+    try:
+        texts, new_entries, stats = run_ocr(pdf_bytes, candidates, get_ocr_cache(keys))
+    except OCRUnavailable as e:
+        logger.warning("OCR skipped for %s: %s", document_id, e)
+        return None
+
+    try:
+        # The file may have been deleted while OCR ran
+        if document_exists(document_id):
+            save_ocr_cache(new_entries)
+            written = save_ocr_texts(document_id, texts, candidates)
+            if written < len(texts):
+                logger.info("OCR %s: %d pages changed while OCR ran", document_id, len(texts) - written)
+        commit()
+    except Exception:
+        rollback()
+        raise
+
+    logger.info("OCR %s: %s", document_id, throughput(stats))
+    return stats
+
+
+def ocr_document_in_background(document_id: str, pdf_bytes: bytes, candidates):
+    try:
+        ocr_document(document_id, pdf_bytes, candidates)
+    except Exception:
+        logger.exception("OCR failed for %s", document_id)
+
+def build_summaries(file_id: int):
+    """
+    Build or refresh a file's summary tree: page summaries that are missing,
+    sections whose pages changed, then the document summary if any section
+    did. Returns counts of what was built, or None if the file has no pages.
+    The calls made are stored as one usage record (route "summary").
+    """
+    start = time.perf_counter()
+    with track_usage() as calls:
+        try:
+            return _build_summary_tree(file_id)
+        finally:
+            if calls:
+                try:
+                    save_usage([{
+                        "user_id": 1,
+                        "file_id": file_id,
+                        "route": "summary",
+                        **usage_totals(calls, time.perf_counter() - start),
+                    }])
+                    commit()
+                except Exception:
+                    rollback()
+                    logger.exception("Could not save summary usage for file %d", file_id)
+
+
+def _build_summary_tree(file_id: int):
+    file = get_file(file_id)
+    if not file or not file["s3_key"]:
+        return None
+    document_id = file["document_id"]
+
+    pages = get_pages_for_summary(document_id)
+    if not pages:
+        return None
+    stats = {"pages": 0, "sections": 0, "document": 0, "failed": 0}
+
+    # 1. Pages
+    todo = [p for p in pages if p["summary"] is None]
+    done = []
+    errors = []
+    for page, result in zip(todo, run_all(summarize_page, [(p["text"] or "",) for p in todo])):
+        if isinstance(result, Exception):
+            errors.append(result)
+            continue
+        page["summary"] = result
+        done.append((page["page_number"], page["text"], result))
+
+    try:
+        save_page_summaries(document_id, done)
+        commit()
+    except Exception:
+        rollback()
+        raise
+    stats["pages"] = len(done)
+
+    # Deleted while its pages were summarized
+    if not document_exists(document_id):
+        return None
+
+    # Sections need all their pages; the next run retries the rest
+    if errors:
+        logger.warning("%d page summaries failed for %s: %s", len(errors), document_id, errors[0])
+        stats["failed"] = len(errors)
+        return stats
+
+    # 2. Sections, along the PDF outline when it has one
+    try:
+        with open_document(document_id, file["s3_key"]) as doc:
+            toc = doc.get_toc(simple=True)
+    except Exception as e:
+        logger.warning("No outline for %s: %s", document_id, e)
+        toc = []
+
+    existing = {(s["level"], s["start_page"]): s for s in get_document_summaries(document_id)}
+    page_summaries = {p["page_number"]: p["summary"] for p in pages}
+
+    sections = []
+    for title, start, end in plan_sections(pages[-1]["page_number"], toc):
+        section_pages = [(n, page_summaries.get(n) or "") for n in range(start, end + 1)]
+        h = source_hash(title, *(summary for _, summary in section_pages))
+        old = existing.get(("section", start))
+        sections.append({
+            "level": "section",
+            "start_page": start,
+            "end_page": end,
+            "title": title,
+            "summary": old["summary"] if old and old["source_hash"] == h else None,
+            "source_hash": h,
+            "pages": section_pages,
+        })
+
+    todo = [s for s in sections if s["summary"] is None]
+    for section, result in zip(todo, run_all(summarize_section, [(s["title"], s["pages"]) for s in todo])):
+        if isinstance(result, Exception):
+            errors.append(result)
+            continue
+        section["summary"] = result
+        stats["sections"] += 1
+
+    if errors:
+        logger.warning("%d section summaries failed for %s: %s", len(errors), document_id, errors[0])
+        stats["failed"] = len(errors)
+        return stats
+
+    # 3. Document
+    h = source_hash(file["title"], *(s["summary"] for s in sections))
+    old = existing.get(("document", 1))
+    if old and old["source_hash"] == h:
+        summary = old["summary"]
+    else:
+        summary = summarize_document(file["title"], sections)
+        stats["document"] = 1
+
+    try:
+        if not document_exists(document_id):
+            return None
+        save_document_summaries(document_id, sections + [{
+            "level": "document",
+            "start_page": 1,
+            "end_page": pages[-1]["page_number"],
+            "title": file["title"],
+            "summary": summary,
+            "source_hash": h,
+        }])
+        commit()
+    except Exception:
+        rollback()
+        raise
+    return stats
+
+
+# Files with a summary run in progress in this process -> whether another run
+# was asked for meanwhile (e.g. OCR or a revision changed pages)
+_summarizing = {}
+_summarizing_lock = threading.Lock()
+
+
+def build_summaries_in_background(file_id: int):
+    with _summarizing_lock:
+        if file_id in _summarizing:
+            _summarizing[file_id] = True
+            return
+        _summarizing[file_id] = False
+
+    try:
+        schedule(_summarize_until_current, file_id)
+    except Exception:
+        with _summarizing_lock:
+            del _summarizing[file_id]
+        logger.exception("Could not schedule summaries for file %d", file_id)
+
+
+def _summarize_until_current(file_id: int):
+    while True:
+        try:
+            build_summaries(file_id)
+        except Exception:
+            logger.exception("Summaries failed for file %d", file_id)
+
+        with _summarizing_lock:
+            if not _summarizing[file_id]:
+                del _summarizing[file_id]
+                return
+            _summarizing[file_id] = False
+
+
+def overview_context(document_id: str, document_text: str):
+    """
+    Summary-tree context for an overview question, or None to send the full
+    text (summaries not built yet, or the document is short anyway)
+    """
+    if not SUMMARIES_ENABLED:
+        return None
+    text = summary_context(get_document_summaries(document_id))
+    if text and len(text) < len(document_text):
+        return text
+    return None
+
+
+def route_context(route, document_id: str, pages, document_text: str):
+    """
+    Document text for a routed question (router.classify) and what it is:
+    "pages", "summary", or "full_text" when the route finds nothing better
+    """
+    name = route["route"]
+    if name == "page":
+        wanted = {
+            n + offset
+            for n in route["pages"]
+            for offset in range(-PAGE_NEIGHBOURS, PAGE_NEIGHBOURS + 1)
+        }
+        selected = [p for p in pages if p["page_number"] in wanted]
+        if any(p["page_number"] in route["pages"] for p in selected):
+            return reshape_pages(selected), "pages"
+
+    elif name == "definition":
+        numbers = set(search_document_pages(document_id, route["term"], DEFINITION_PAGES))
+        if numbers:
+            return reshape_pages([p for p in pages if p["page_number"] in numbers]), "pages"
+
+    elif name in ("overview", "followup"):
+        summary_text = overview_context(document_id, document_text)
+        if summary_text:
+            return summary_text, "summary"
+
+    return document_text, "full_text"
+
+
+def routed_answer(route: str, context: str, model: str, ask, **kwargs):
+    """
+    Answer with ask (ask_openai or ask_region) on the given model, recording
+    the route's latency, tokens and cost. Returns (answer, usage record).
+    """
+    start = time.perf_counter()
+    with track_usage() as calls:
+        answer = ask(model=model, **kwargs)
+    usage = usage_totals(calls, time.perf_counter() - start)
+    # Answered by an identical request in flight: no call of its own
+    usage["model"] = usage["model"] or model
+    record_route(route, context, model, usage)
+    return normalize_math(answer), usage
+
+
+def check_budget(user_id: int) -> bool:
+    """
+    Check the user's spend this period before any upstream call: raises 402
+    past the limit, returns True past the downgrade threshold (answer on
+    the small model)
+    """
+    budget = get_user_budget(user_id) or default_budget(user_id)
+    if budget["limit_usd"] is None and budget["downgrade_usd"] is None:
+        return False
+
+    spent = get_spend_usd(user_id, period_start(budget["period"]))
+    state = budget_state(budget, spent)
+    if state == "reject":
+        inc("budget_checks_total", outcome="rejected")
+        raise HTTPException(
+            status_code=402,
+            detail=f"Usage budget reached: ${spent:.2f} of ${budget['limit_usd']:.2f} this {budget['period']}",
+        )
+    inc("budget_checks_total", outcome="downgraded" if state == "downgrade" else "ok")
+    return state == "downgrade"
+
+
+def answer_model(route: str, downgrade: bool) -> str:
+    return ASK_MODEL_SMALL if downgrade else model_for(route)
+
+
+def save_answer_usage(user_id: int, req, message_id: int, route: str, usage):
+    save_usage([{
+        "user_id": user_id,
+        "file_id": req.file_id,
+        "chat_thread_id": req.chat_thread_id,
+        "message_id": message_id,
+        "route": route,
+        **usage,
+    }])
+
 # Change shape of context: from [{"page_number":..., "text":...}] to "[page_number] text..."
 def reshape_pages(pages):
     # Details of all text into a single string
@@ -93,6 +566,18 @@ def reshape_pages(pages):
 
     return details
 
+def document_prompt(document_text: str, question: str) -> str:
+    # Document first, question last: prompts for the same document share a
+    # long prefix, which the API can serve from its prompt cache
+    return f"""
+Answer the following question using the document below.
+
+{document_text}
+
+Question:
+{question}
+"""
+
 # Math normalization helper
 def normalize_math(text: str) -> str:
     lines = text.split("\n")
@@ -332,7 +817,7 @@ Your success is measured by whether the student could re-explain the idea in the
 """
 
 # Case 1: user asked about a text - call OpenAI 
-def ask_openai(prompt_text, system_prompt=system_prompt, history=None):
+def ask_openai(prompt_text, system_prompt=system_prompt, history=None, model=ASK_MODEL):
     input_messages = [
         {"role": "system", "content": system_prompt},
     ]
@@ -342,8 +827,8 @@ def ask_openai(prompt_text, system_prompt=system_prompt, history=None):
 
     input_messages.append({"role": "user", "content": prompt_text})
 
-    response = client.responses.create(
-        model="gpt-4.1-mini",
+    response = create_response(
+        model=model,
         input=input_messages,
         temperature=0.3
     )
@@ -355,6 +840,7 @@ def ask_region(
     region_s3_key: str,
     system_prompt=system_prompt,
     history=None,
+    model=ASK_MODEL,
 ):
     # 1. Generate temporary S3 URL
     image_url = generate_presigned_url(region_s3_key)
@@ -380,26 +866,62 @@ def ask_region(
         }
     )
 
-    response = client.responses.create(
-        model="gpt-4.1-mini",
+    response = create_response(
+        model=model,
         input=input_messages,
         temperature=0.3,
+        # The presigned URL changes per call; key on the image itself so
+        # identical region questions still coalesce
+        coalesce_key=request_key(
+            model, system_prompt, history, prompt_text, region_s3_key,
+        ),
     )
 
     return response.output_text
 
 
+def annotation_paragraphs(document_id: str, s3_key: str, annotation):
+    """
+    Text blocks under and next to a PDF annotation's geometry.
+
+    Returns (text, layout); layout is set when the page's layout had to be
+    extracted now and should be stored. ("", None) means fall back to
+    whole-page context.
+    """
+    if not annotation.get("geometry"):
+        return "", None
+
+    page_number = annotation["page_number"]
+    layout = get_page_layout(document_id, page_number)
+    new_layout = None
+
+    if layout is None and s3_key:
+        # Uploaded before layouts were stored: extract this page once
+        try:
+            layout = new_layout = load_page_layout(document_id, s3_key, page_number)
+        except Exception:
+            logger.exception("Could not extract the layout of %s page %d", document_id, page_number)
+            return "", None
+
+    if layout is None:
+        return "", None
+
+    # Regions are often figures with no text of their own; look a bit wider
+    margin = 0.02 if annotation["type"] == "region" else 0.0
+    return layout.context_for(annotation["geometry"], neighbours=1, margin=margin), new_layout
+
+
 def build_thread_history(
     chat_thread_id: int,
     exclude_message_id: Optional[int] = None,
     max_messages: int = 20,
 ):
-    messages = get_messages_by_thread(chat_thread_id)
-    if exclude_message_id is not None:
-        messages = [m for m in messages if m.get("id") != exclude_message_id]
-
-    if max_messages > 0:
-        messages = messages[-max_messages:]
+    # Includes what a forked thread inherits from its parents
+    messages = get_thread_history(
+        chat_thread_id,
+        limit=max_messages if max_messages > 0 else None,
+        exclude_message_id=exclude_message_id,
+    )
 
     return [
         {"role": m["role"], "content": m["content"]}
@@ -424,6 +946,24 @@ class AskQuestion(BaseModel):
     annotation_id: Optional[int] = None
     question: str
 
+# Many document-level questions about one file
+class AskBatch(BaseModel):
+    file_id: int
+    chat_thread_id: int
+    questions: list[str]
+
+# One visible part of a page, as fractions of the page (whole page by default)
+class ViewportRect(BaseModel):
+    page_number: int
+    x: float = 0.0
+    y: float = 0.0
+    width: float = 1.0
+    height: float = 1.0
+
+# The pages (or parts of pages) currently on screen
+class AnnotationViewport(BaseModel):
+    rects: list[ViewportRect]
+
 # Change file title object
 class RenameFileRequest(BaseModel):
     title: str
@@ -441,21 +981,62 @@ class CreateChatThread(BaseModel):
     file_id: Optional[int] = None
     source_annotation_id: Optional[int] = None
     title: Optional[str] = None
+    parent_thread_id: Optional[int] = None
+    fork_message_id: Optional[int] = None
 
 class CreateStandaloneChatRequest(BaseModel):
     folder_id: Optional[int] = None
     title: Optional[str] = None
     source_annotation_id: Optional[int] = None
+    # Start from this thread's history (a chat_text highlight's own thread
+    # by default); up to fork_message_id, else its latest message
+    parent_thread_id: Optional[int] = None
+    fork_message_id: Optional[int] = None
+
+# Fork a thread at one of its messages (default: the latest)
+class ForkThreadRequest(BaseModel):
+    message_id: Optional[int] = None
+    title: Optional[str] = None
+
+# Spend thresholds per period, in USD (None = no threshold)
+class BudgetRequest(BaseModel):
+    period: str = "month"
+    downgrade_usd: Optional[float] = None
+    limit_usd: Optional[float] = None
 
 
 # Get the pdf file from frontend then write it into S3
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...), folder_id: Optional[int] = Form(None),):
+def upload_file(background_tasks: BackgroundTasks, file: UploadFile = File(...), folder_id: Optional[int] = Form(None),):
+    # Sync on purpose: extraction and the S3 upload run in the threadpool
+    # instead of blocking the event loop
     document_id = str(uuid.uuid4())
     title = os.path.splitext(file.filename)[0]
     user_id = 1
 
-    pdf_bytes = await file.read()
+    pdf_bytes = file.file.read()
+
+    try:
+        pages = extract_pages_from_pdf_from_bytes(pdf_bytes, document_id)
+    except Exception as e:
+        logger.warning("Upload: could not read PDF %s: %s", file.filename, e)
+        raise HTTPException(status_code=400, detail=f"Could not read PDF: {e}")
+
+    content_hash = hashlib.sha256(pdf_bytes).hexdigest()
+
+    # The PDF goes to S3 first, keyed by document_id, so the file row is
+    # created with its s3_key: a row without one is a standalone chat. The
+    # upload happens outside the write transaction so other workers aren't
+    # queued behind the write lock
+    try:
+        s3_key = upload_pdf(
+            file_obj=BytesIO(pdf_bytes),
+            user_id=user_id,
+            document_id=document_id,
+        )
+    except Exception as e:
+        logger.exception("Upload: could not store PDF %s", document_id)
+        raise HTTPException(status_code=500, detail=str(e))
 
     try:
         file_id = create_file(
@@ -463,6 +1044,8 @@ async def upload_file(file: UploadFile = File(...), folder_id: Optional[int] = F
             document_id=document_id,
             title=title,
             user_id=user_id,
+            content_hash=content_hash,
+            s3_key=s3_key,
         )
 
         create_chat_thread(
@@ -471,29 +1054,138 @@ async def upload_file(file: UploadFile = File(...), folder_id: Optional[int] = F
             title=title or "Document chat",
         )
 
-
-        pages = extract_pages_from_pdf_from_bytes(pdf_bytes, document_id)
         save_pages(pages)
+        save_page_layouts(document_id, [
+            (page["page_number"], page["layout"]) for page in pages if page["layout"]
+        ])
+        commit()
+    except Exception as e:
+        rollback()
+        logger.exception("Upload: could not save file %s", document_id)
+
+        # Don't leave the PDF behind without a file row
+        try:
+            if delete_s3_objects([s3_key]):
+                logger.warning("Could not delete %s after a failed upload", s3_key)
+        except Exception:
+            logger.exception("Could not delete %s after a failed upload", s3_key)
+
+        raise HTTPException(status_code=500, detail=str(e))
+
+    # Seed the document cache so page-level work skips the S3 round trip
+    try:
+        store_local_copy(document_id, pdf_bytes)
+    except OSError as e:
+        logger.warning("Could not cache %s locally: %s", document_id, e)
+
+    # Scanned pages get their text after the response; OCR takes seconds
+    # per page
+    ocr_candidates = {p["page_number"]: p["content_hash"] for p in pages if p["needs_ocr"]}
+    if ocr_candidates:
+        background_tasks.add_task(ocr_document_in_background, document_id, pdf_bytes, ocr_candidates)
+    # After OCR (background tasks run in order), so scanned pages are
+    # summarized from their text
+    if SUMMARIES_ENABLED:
+        background_tasks.add_task(build_summaries_in_background, file_id)
+
+    return {
+        "file_id": file_id,
+        "title": title,
+        "ocr_pages": len(ocr_candidates),
+    }
+
+
+# Replace a PDF with a revised version (e.g. updated slides), keeping what
+# didn't change: only new or changed pages are extracted and re-indexed, and
+# annotations follow unchanged pages even if they moved
+@app.post("/files/{file_id}/replace")
+def replace_file(file_id: int, background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+    current = _get_pdf_file(file_id)
+    document_id = current["document_id"]
+    user_id = 1
+
+    pdf_bytes = file.file.read()
+    content_hash = hashlib.sha256(pdf_bytes).hexdigest()
+    if content_hash == current["content_hash"]:
+        return {"file_id": file_id, "changed": False}
+
+    import fitz
+
+    try:
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf:
+            with span("pdf", "hash_pages", bytes=len(pdf_bytes)) as record:
+                new_hashes = [page_content_hash(page) for page in pdf]
+                record["pages"] = len(new_hashes)
+
+            moves, extract, replaced, dropped = diff_page_hashes(get_page_hashes(document_id), new_hashes)
+            pages = extract_pages(pdf, document_id, extract)
+    except Exception as e:
+        logger.warning("Replace: could not read PDF for file %d: %s", file_id, e)
+        raise HTTPException(status_code=400, detail=f"Could not read PDF: {e}")
 
+    # New object first; the old one is deleted once nothing points at it
+    try:
         s3_key = upload_pdf(
             file_obj=BytesIO(pdf_bytes),
             user_id=user_id,
             file_id=file_id,
+            version=content_hash[:16],
         )
+    except Exception as e:
+        logger.exception("Replace: could not store PDF for file %d", file_id)
+        raise HTTPException(status_code=500, detail=str(e))
 
-        update_file_s3_key(file_id, s3_key)
-        commit()
-
-        return {
-            "file_id": file_id,
-            "title": title,
-        }
+    s3_keys = []
+    try:
+        dropped_annotations = get_annotation_ids_on_pages(document_id, dropped)
+        for annotation_id in dropped_annotations:
+            result = delete_annotation(annotation_id)
+            if result:
+                s3_keys += result["s3_keys"]
 
+        remap_pages(document_id, moves, replaced + dropped)
+        save_pages(pages)
+        save_page_layouts(document_id, [
+            (page["page_number"], page["layout"]) for page in pages if page["layout"]
+        ])
+        update_file_pdf(file_id, s3_key, content_hash)
+        commit()
     except Exception as e:
         rollback()
-        print("UPLOAD ERROR:", e)  
+        logger.exception("Replace: could not save file %d", file_id)
+        try:
+            if s3_key != current["s3_key"]:
+                delete_s3_objects([s3_key])
+        except Exception:
+            logger.exception("Could not delete %s after a failed replace", s3_key)
         raise HTTPException(status_code=500, detail=str(e))
 
+    evict_document(document_id, remove_local=True)
+    store_local_copy(document_id, pdf_bytes)
+
+    if s3_key != current["s3_key"]:
+        s3_keys.append(current["s3_key"])
+    purge_deleted({"document_ids": [], "s3_keys": s3_keys})
+
+    ocr_candidates = {p["page_number"]: p["content_hash"] for p in pages if p["needs_ocr"]}
+    if ocr_candidates:
+        background_tasks.add_task(ocr_document_in_background, document_id, pdf_bytes, ocr_candidates)
+    # Moved pages keep their summaries; only new pages and the sections
+    # around them are summarized again
+    if SUMMARIES_ENABLED:
+        background_tasks.add_task(build_summaries_in_background, file_id)
+
+    return {
+        "file_id": file_id,
+        "changed": True,
+        "pages": len(new_hashes),
+        "extracted": len(extract),
+        "moved": len(moves),
+        "removed_pages": len(dropped),
+        "removed_annotations": len(dropped_annotations),
+        "ocr_pages": len(ocr_candidates),
+    }
+
 
 @app.post("/annotations")
 def create_text_annotation(payload: CreateAnnotation):
@@ -611,6 +1303,7 @@ def get_file_state(file_id: int):
             "folder_id": file["folder_id"],
         },
         "pdf_url": pdf_url,
+        "image_version": image_version(file),
         "threads": threads,
         "active_thread_id": doc_thread["id"],
         "annotations": annotations,
@@ -620,43 +1313,252 @@ def get_file_state(file_id: int):
 
 
 
-# Get the image region from frontend
+def _get_pdf_file(file_id: int):
+    file = get_file(file_id)
+    if not file:
+        raise HTTPException(status_code=404, detail="File not found")
+    if not file["s3_key"]:
+        raise HTTPException(status_code=400, detail="File has no PDF")
+    return file
+
+
+def image_version(file):
+    """
+    The v= parameter of a file's page image URLs; changes when the PDF is
+    replaced. None for files stored before content hashes.
+    """
+    return file["content_hash"][:16] if file["content_hash"] else None
+
+
+def _cached_image_response(file, page_number, kind, image_format, if_none_match, version, render, **params):
+    if image_format not in IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format: {image_format}")
+
+    # Content-addressed by the PDF hash; older files fall back to document_id
+    content_id = file["content_hash"] or file["document_id"]
+    key = tile_key(content_id, page_number, kind, format=image_format, **params)
+
+    # A replace keeps the URL, so only a URL naming the current version can
+    # be cached for good; anything else revalidates against the ETag
+    etag = f'"{key}"'
+    if version is not None and version == image_version(file):
+        cache_control = "public, max-age=31536000, immutable"
+    else:
+        cache_control = "private, no-cache"
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+
+    if if_none_match and etag in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    data = get_tile(key)
+    if data is None:
+        try:
+            data = render()
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        put_tile(key, data)
+
+    return Response(
+        content=data,
+        media_type=IMAGE_FORMATS[image_format],
+        headers=headers,
+    )
+
+
+# Page sizes so the client can lay out pages before any image arrives
+@app.get("/files/{file_id}/pages")
+def get_file_pages(file_id: int):
+    file = _get_pdf_file(file_id)
+    return {
+        "tile_size": TILE_SIZE,
+        # Pass as ?v= on thumbnail and tile URLs to let browsers cache them
+        "image_version": image_version(file),
+        "pages": get_page_sizes(file["document_id"], file["s3_key"]),
+    }
+
+
+# OCR the scanned pages of a document uploaded before OCR (or while it was off)
+@app.post("/files/{file_id}/ocr")
+def ocr_file(file_id: int, background_tasks: BackgroundTasks):
+    file = _get_pdf_file(file_id)
+    document_id = file["document_id"]
+
+    texts = {p["page_number"]: p["text"] for p in get_pages(document_id)}
+    with open_document(document_id, file["s3_key"]) as doc:
+        candidates = {
+            page.number + 1: page_content_hash(page)
+            for page in doc
+            if needs_ocr(page, texts.get(page.number + 1, ""))
+        }
+
+    if not candidates:
+        return {"pages": 0}
+
+    stats = ocr_document(document_id, read_pdf_bytes(document_id, file["s3_key"]), candidates)
+    if stats is None:
+        raise HTTPException(status_code=503, detail="OCR is not available on this server")
+
+    # OCR'd pages lost their (empty) summaries
+    if SUMMARIES_ENABLED:
+        background_tasks.add_task(build_summaries_in_background, file_id)
+
+    return stats
+
+
+# Summary tree of a file (page summaries are left out; they can be many)
+@app.get("/files/{file_id}/summary")
+def get_file_summary(file_id: int):
+    file = _get_pdf_file(file_id)
+    summaries = get_document_summaries(file["document_id"])
+    document = next((s for s in summaries if s["level"] == "document"), None)
+
+    return {
+        "ready": document is not None,
+        "document": document["summary"] if document else None,
+        "sections": [
+            {
+                "title": s["title"],
+                "start_page": s["start_page"],
+                "end_page": s["end_page"],
+                "summary": s["summary"],
+            }
+            for s in summaries if s["level"] == "section"
+        ],
+    }
+
+
+# (Re)build a file's summaries, e.g. for files uploaded before summaries.
+# Queued like the build after an upload (one run per file at a time, off the
+# request threads); poll GET /files/{file_id}/summary for the result
+@app.post("/files/{file_id}/summarize")
+def summarize_file(file_id: int):
+    file = _get_pdf_file(file_id)
+    if not get_page_hashes(file["document_id"]):
+        raise HTTPException(status_code=404, detail="Document has no pages")
+
+    build_summaries_in_background(file_id)
+    return JSONResponse(status_code=202, content={"file_id": file_id, "scheduled": True})
+
+
+@app.get("/files/{file_id}/pages/{page_number}/thumbnail")
+def get_page_thumbnail(
+    file_id: int,
+    page_number: int,
+    width: int = 200,
+    format: str = "jpeg",
+    v: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+):
+    file = _get_pdf_file(file_id)
+    width = max(32, min(1024, width))
+
+    return _cached_image_response(
+        file,
+        page_number,
+        "thumbnail",
+        format,
+        if_none_match,
+        v,
+        lambda: render_thumbnail(
+            file["document_id"], file["s3_key"], page_number, width, format
+        ),
+        width=width,
+    )
+
+
+@app.get("/files/{file_id}/pages/{page_number}/tiles/{zoom}/{tile_x}/{tile_y}")
+def get_page_tile(
+    file_id: int,
+    page_number: int,
+    zoom: float,
+    tile_x: int,
+    tile_y: int,
+    format: str = "png",
+    v: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+):
+    file = _get_pdf_file(file_id)
+    zoom = round(clamp_zoom(zoom), 3)
+
+    return _cached_image_response(
+        file,
+        page_number,
+        "tile",
+        format,
+        if_none_match,
+        v,
+        lambda: render_tile(
+            file["document_id"], file["s3_key"], page_number, zoom, tile_x, tile_y, format
+        ),
+        zoom=zoom,
+        x=tile_x,
+        y=tile_y,
+    )
+
+
+# Get the image region from frontend, or crop it from the stored PDF
 @app.post("/upload-region")
 def upload_region_endpoint(
     file_id: str = Form(...),
     page_number: int = Form(...),
     geometry: Optional[str] = Form(None),          
-    region: UploadFile = File(...)
+    region: Optional[UploadFile] = File(None),
+    dpi: int = Form(150),
 ):
     region_id = str(uuid.uuid4())
 
-    document_id = get_document_id_by_file(file_id)
-    if not document_id:
+    file = get_file(file_id)
+    if not file:
         raise HTTPException(status_code=404, detail="File not found")
 
+    document_id = file["document_id"]
+
     # Parse geometry
     try:
         normalized_geometry = json.loads(geometry)
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid geometry payload")
 
-    allowed_img_type = {"image/jpeg", "image/png"}
+    # Server-side crop: no image uploaded, render the clip from the PDF
+    if region is None:
+        if not file["s3_key"]:
+            raise HTTPException(status_code=400, detail="File has no PDF to crop")
 
-    if region.content_type not in allowed_img_type:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Invalid file type: {region.content_type}."
-        )
+        try:
+            png_bytes = render_region_png(
+                document_id=document_id,
+                s3_key=file["s3_key"],
+                page_number=page_number,
+                geometry=normalized_geometry,
+                dpi=dpi,
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        region_file = BytesIO(png_bytes)
+        content_type = "image/png"
+
+    else:
+        allowed_img_type = {"image/jpeg", "image/png"}
+
+        if region.content_type not in allowed_img_type:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid file type: {region.content_type}."
+            )
+
+        region_file = region.file
+        content_type = region.content_type
 
     # Decide extension based on content type
-    ext = ".png" if region.content_type == "image/png" else ".jpeg"
+    ext = ".png" if content_type == "image/png" else ".jpeg"
 
 
     region_s3_key = upload_region_to_s3(
-        file_obj=region.file,
+        file_obj=region_file,
         user_id=1,
         region_id=region_id,
-        content_type=region.content_type,
+        content_type=content_type,
         ext=ext,
     )
 
@@ -670,6 +1572,7 @@ def upload_region_endpoint(
         region_id=region_id,
         region_s3_key=region_s3_key,
     )
+    commit()
 
     return {
         "annotation_id": annotation_id,
@@ -697,6 +1600,10 @@ def ask_document(req: AskQuestion):
     if not file:
         raise HTTPException(status_code=404, detail="File not found")
 
+    user_id = 1  # later from auth
+    # Before anything is written or sent upstream
+    downgrade = check_budget(user_id)
+
     # ==================================================
     # 1. STANDALONE CHAT (NO PDF)
     # ==================================================
@@ -713,6 +1620,8 @@ def ask_document(req: AskQuestion):
             content=req.question,
             annotation_id=req.annotation_id,
         )
+        # Own short transaction, released before the LLM call
+        commit()
 
         history = build_thread_history(
             req.chat_thread_id,
@@ -720,8 +1629,10 @@ def ask_document(req: AskQuestion):
         )
 
         # Ask LLM directly
-        answer = ask_openai(req.question, history=history)
-        answer = normalize_math(answer)
+        answer, usage = routed_answer(
+            "standalone", "history", answer_model("standalone", downgrade), ask_openai,
+            prompt_text=req.question, history=history,
+        )
 
         # Save assistant message
         assistant_message_id = save_message_to_thread(
@@ -731,6 +1642,7 @@ def ask_document(req: AskQuestion):
             content=answer,
             annotation_id=req.annotation_id,
         )
+        save_answer_usage(user_id, req, assistant_message_id, "standalone", usage)
 
         commit()
         return {
@@ -748,6 +1660,36 @@ def ask_document(req: AskQuestion):
 
     pages = get_pages(document_id)
 
+    # Validate before writing anything, so a rejected question leaves no
+    # orphaned user message behind
+    annotation = None
+    paragraphs, new_layout = "", None
+    if req.annotation_id:
+        annotation = get_annotation(req.annotation_id)
+        if not annotation:
+            raise HTTPException(status_code=404, detail="Annotation not found")
+
+        if annotation["document_id"] != document_id:
+            raise HTTPException(status_code=400, detail="Annotation mismatch")
+
+        if annotation["type"] != "chat_text" and not (0 < annotation["page_number"] <= len(pages)):
+            raise HTTPException(
+                status_code=400,
+                detail="Invalid page number for PDF annotation",
+            )
+
+        if annotation["type"] == "region" and not annotation.get("region_s3_key"):
+            raise HTTPException(
+                status_code=500,
+                detail="Region missing S3 key",
+            )
+
+        if annotation["type"] != "chat_text":
+            paragraphs, new_layout = annotation_paragraphs(document_id, file["s3_key"], annotation)
+
+    elif not pages:
+        return {"answer": "Document not found."}
+
     # --------------------------------------------------
     # Save user message (always)
     # --------------------------------------------------
@@ -758,6 +1700,11 @@ def ask_document(req: AskQuestion):
         content=req.question,
         annotation_id=req.annotation_id,
     )
+    if new_layout:
+        save_page_layouts(document_id, [(annotation["page_number"], new_layout)])
+    # Its own short transaction: the write lock is released before the LLM
+    # call, and the assistant message gets a second transaction afterwards
+    commit()
 
     history = build_thread_history(
         req.chat_thread_id,
@@ -767,14 +1714,7 @@ def ask_document(req: AskQuestion):
     # --------------------------------------------------
     # 3. ANNOTATION-BASED QUESTION
     # --------------------------------------------------
-    if req.annotation_id:
-        annotation = get_annotation(req.annotation_id)
-        if not annotation:
-            raise HTTPException(status_code=404, detail="Annotation not found")
-
-        if annotation["document_id"] != document_id:
-            raise HTTPException(status_code=400, detail="Annotation mismatch")
-
+    if annotation:
         # ---------- CHAT TEXT ANNOTATION ----------
         if annotation["type"] == "chat_text":
             prompt = f"""
@@ -785,8 +1725,10 @@ The student selected the following text from a previous explanation:
 Question:
 {req.question}
 """
-            answer = ask_openai(prompt_text=prompt, history=history)
-            answer = normalize_math(answer)
+            answer, usage = routed_answer(
+                "chat_text", "selection", answer_model("chat_text", downgrade), ask_openai,
+                prompt_text=prompt, history=history,
+            )
 
             assistant_message_id = save_message_to_thread(
                 chat_thread_id=req.chat_thread_id,
@@ -795,6 +1737,7 @@ Question:
                 content=answer,
                 annotation_id=req.annotation_id,
             )
+            save_answer_usage(user_id, req, assistant_message_id, "chat_text", usage)
 
             commit()
             return {
@@ -805,27 +1748,20 @@ Question:
 
         # ---------- PDF TEXT / REGION ANNOTATION ----------
         page_number = annotation["page_number"]
-        if page_number <= 0:
-            raise HTTPException(
-                status_code=400,
-                detail="Invalid page number for PDF annotation",
-            )
-
         page_idx = page_number - 1
 
-        prev_text = pages[page_idx - 1]["text"] if page_idx - 1 >= 0 else ""
-        curr_text = pages[page_idx]["text"]
-        next_text = pages[page_idx + 1]["text"] if page_idx + 1 < len(pages) else ""
-
-        prompt = f"""
-The student selected the following exact text from the document:
-
-\"\"\"{annotation.get("text", "")}\"\"\"
-
-This text appears on page {page_number}.
-
-Here is surrounding context (for reference only):
+        if paragraphs:
+            # Just the paragraphs under and around the selection
+            context = f"""
+--- Surrounding paragraphs on page {page_number} ---
+{paragraphs}
+"""
+        else:
+            prev_text = pages[page_idx - 1]["text"] if page_idx - 1 >= 0 else ""
+            curr_text = pages[page_idx]["text"]
+            next_text = pages[page_idx + 1]["text"] if page_idx + 1 < len(pages) else ""
 
+            context = f"""
 --- Previous context ---
 {prev_text}
 
@@ -834,6 +1770,17 @@ Here is surrounding context (for reference only):
 
 --- Next context ---
 {next_text}
+"""
+
+        prompt = f"""
+The student selected the following exact text from the document:
+
+\"\"\"{annotation.get("text", "")}\"\"\"
+
+This text appears on page {page_number}.
+
+Here is surrounding context (for reference only):
+{context}
 
 Answer the question by focusing primarily on the selected text.
 
@@ -841,22 +1788,20 @@ Question:
 {req.question}
 """
 
-        if annotation["type"] == "region":
-            if not annotation.get("region_s3_key"):
-                raise HTTPException(
-                    status_code=500,
-                    detail="Region missing S3 key",
-                )
-
-            answer = ask_region(
+        context_kind = "paragraphs" if paragraphs else "pages"
+        route_name = "region" if annotation["type"] == "region" else "selection"
+        if route_name == "region":
+            answer, usage = routed_answer(
+                "region", context_kind, answer_model("region", downgrade), ask_region,
                 prompt_text=prompt,
                 region_s3_key=annotation["region_s3_key"],
                 history=history,
             )
         else:
-            answer = ask_openai(prompt_text=prompt, history=history)
-
-        answer = normalize_math(answer)
+            answer, usage = routed_answer(
+                "selection", context_kind, answer_model("selection", downgrade), ask_openai,
+                prompt_text=prompt, history=history,
+            )
 
         assistant_message_id = save_message_to_thread(
             chat_thread_id=req.chat_thread_id,
@@ -865,6 +1810,7 @@ Question:
             content=answer,
             annotation_id=req.annotation_id,
         )
+        save_answer_usage(user_id, req, assistant_message_id, route_name, usage)
 
         commit()
         return {
@@ -876,21 +1822,17 @@ Question:
     # --------------------------------------------------
     # 4. DOCUMENT-LEVEL QUESTION (NO ANNOTATION)
     # --------------------------------------------------
-    if not pages:
-        commit()
-        return {"answer": "Document not found."}
-
-    prompt = f"""
-Answer the following question using the document below.
-
-{reshape_pages(pages)}
-
-Question:
-{req.question}
-"""
-
-    answer = ask_openai(prompt_text=prompt, history=history)
-    answer = normalize_math(answer)
+    # Page references, overviews and definitions get a narrower context
+    # than the whole document (router.py)
+    route = classify(req.question, has_history=bool(history))
+    document_text, context = route_context(route, document_id, pages, reshape_pages(pages))
+    # The small tier only ever sees a narrow context
+    model = answer_model(route["route"] if context != "full_text" else "document", downgrade)
+
+    answer, usage = routed_answer(
+        route["route"], context, model, ask_openai,
+        prompt_text=document_prompt(document_text, req.question), history=history,
+    )
 
     assistant_message_id = save_message_to_thread(
         chat_thread_id=req.chat_thread_id,
@@ -899,6 +1841,7 @@ Question:
         content=answer,
         annotation_id=None,
     )
+    save_answer_usage(user_id, req, assistant_message_id, route["route"], usage)
 
     commit()
     return {
@@ -910,6 +1853,119 @@ Question:
 
 
 
+# Upper bound on questions per /ask/batch, and how many run at once
+MAX_BATCH_QUESTIONS = int(os.getenv("ASK_BATCH_MAX_QUESTIONS", "20"))
+BATCH_CONCURRENCY = int(os.getenv("ASK_BATCH_CONCURRENCY", "4"))
+
+
+@app.post("/ask/batch")
+def ask_batch(req: AskBatch):
+    # Doc: Answer several document-level questions with one shared context.
+    questions = [q.strip() for q in req.questions if q.strip()]
+    if not questions:
+        raise HTTPException(status_code=400, detail="questions is empty")
+    if len(questions) > MAX_BATCH_QUESTIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_BATCH_QUESTIONS} questions per batch",
+        )
+
+    file = get_file(req.file_id)
+    if not file:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    user_id = 1  # later from auth
+    downgrade = check_budget(user_id)
+
+    document_id = file["document_id"]
+
+    # Every question sees the thread as it was before the batch
+    history = build_thread_history(req.chat_thread_id)
+
+    # Routed here rather than in the worker threads, which have no database
+    # connection; the full text is built once for the whole batch.
+    # Standalone chats have no document.
+    routed = []
+    if file["s3_key"] is not None:
+        pages = get_pages(document_id)
+        if not pages:
+            raise HTTPException(status_code=404, detail="Document not found")
+        document_text = reshape_pages(pages)
+
+        for question in questions:
+            route = classify(question, has_history=bool(history))
+            text, context = route_context(route, document_id, pages, document_text)
+            model = answer_model(route["route"] if context != "full_text" else "document", downgrade)
+            routed.append((route["route"], context, model, document_prompt(text, question)))
+    else:
+        routed = [("standalone", "history", answer_model("standalone", downgrade), q) for q in questions]
+
+    def answer(route, context, model, prompt):
+        return routed_answer(route, context, model, ask_openai, prompt_text=prompt, history=history)
+
+    # Each task gets its own copy of the request context so its spans land
+    # in this request's trace
+    with ThreadPoolExecutor(max_workers=min(BATCH_CONCURRENCY, len(questions))) as pool:
+        futures = [
+            pool.submit(contextvars.copy_context().run, answer, *r)
+            for r in routed
+        ]
+
+    # Any one question failing (upstream down, or e.g. a 400 on its prompt)
+    # is reported as its error; the others are already paid for, so they
+    # and their usage are still saved
+    results = []
+    usages = []
+    errors = []
+    for question, r, future in zip(questions, routed, futures):
+        try:
+            answer_text, usage = future.result()
+        except Exception as e:
+            if not isinstance(e, LLMUnavailable):
+                logger.warning("Batch question failed (%s route): %r", r[0], e)
+            results.append({"question": question, "error": str(e)})
+            errors.append(e)
+            continue
+        results.append({"question": question, "answer": answer_text})
+        usages.append((r[0], usage))
+
+    answered = [r for r in results if "answer" in r]
+    if not answered:
+        raise errors[0]
+
+    # One transaction for every answered question, in the order asked
+    message_ids = save_messages_to_thread(
+        chat_thread_id=req.chat_thread_id,
+        document_id=document_id,
+        messages=[
+            m
+            for r in answered
+            for m in (
+                {"role": "user", "content": r["question"]},
+                {"role": "assistant", "content": r["answer"]},
+            )
+        ],
+    )
+    save_usage([
+        {
+            "user_id": user_id,
+            "file_id": req.file_id,
+            "chat_thread_id": req.chat_thread_id,
+            "message_id": assistant_id,
+            "route": route,
+            **usage,
+        }
+        for (route, usage), assistant_id in zip(usages, message_ids[1::2])
+    ])
+    commit()
+
+    for r, user_message_id, assistant_id in zip(answered, message_ids[::2], message_ids[1::2]):
+        r["user_message_id"] = user_message_id
+        r["assistant_message_id"] = assistant_id
+
+    return {"results": results}
+
+
 @app.get("/chat/annotation/{annotation_id}")
 def get_annotation_chat(annotation_id: int):
     return {
@@ -926,20 +1982,67 @@ def fetch_annotation(annotation_id: int):
     return annotation
 
 @app.get("/annotations/file/{file_id}")
-def get_document_annotations(file_id: int):
+def get_document_annotations(file_id: int, geometry: bool = True):
+    # geometry=false lists annotations without reading or decoding their
+    # rects (e.g. a sidebar); the viewport endpoint fetches them per page
     document_id = get_document_id_by_file(file_id)
     if not document_id:
         raise HTTPException(status_code=404, detail="File not found")
 
     return {
-        "annotations": get_annotations_by_document(document_id)
+        "annotations": get_annotations_by_document(document_id, include_geometry=geometry)
+    }
+
+# Visible rects per request; a viewer shows a handful of pages at once
+MAX_VIEWPORT_RECTS = 50
+
+@app.post("/annotations/file/{file_id}/viewport")
+def get_viewport_annotations(file_id: int, payload: AnnotationViewport):
+    # Only the annotations intersecting what is on screen, via the R-tree
+    # (annotation_boxes) instead of every annotation in the document
+    document_id = get_document_id_by_file(file_id)
+    if not document_id:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    if len(payload.rects) > MAX_VIEWPORT_RECTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_VIEWPORT_RECTS} viewport rects per request",
+        )
+
+    rects = [
+        (r.page_number, r.x, r.y, r.x + r.width, r.y + r.height)
+        for r in payload.rects
+        if r.width > 0 and r.height > 0
+    ]
+
+    return {
+        "annotations": get_annotations_in_viewport(file_id, document_id, rects)
     }
 
 
 @app.get("/files")
-def get_files():
+def get_files(
+    folder_id: Optional[int] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+):
+    if limit is not None and not 1 <= limit <= 1000:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 1000")
+
+    try:
+        files, next_cursor = list_files(
+            user_id=1,
+            folder_id=folder_id,
+            limit=limit,
+            cursor=cursor,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
     return {
-        "files": list_files(user_id=1)
+        "files": files,
+        "next_cursor": next_cursor,
     }
 
 @app.patch("/files/{file_id}/rename")
@@ -962,10 +2065,32 @@ def reanme_folder_endpoint(folder_id: int, payload: RenameFolderRequest):
     commit()
     return {"ok": True}
 
+def purge_deleted(result):
+    # Runs after commit: a failed purge leaves orphaned blobs, never dangling rows
+    for document_id in result["document_ids"]:
+        evict_document(document_id, remove_local=True)
+
+    try:
+        failed = delete_s3_objects(result["s3_keys"])
+        if failed:
+            logger.warning("Could not delete %d S3 objects: %s", len(failed), failed)
+    except Exception:
+        logger.exception("S3 purge failed for %d objects", len(result["s3_keys"]))
+
+
 @app.delete("/files/{file_id}")
 def delete_file(file_id: int):
-    delete_file_cascade(file_id)
-    commit()
+    if not get_document_id_by_file(file_id):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    try:
+        result = delete_file_cascade(file_id)
+        commit()
+    except Exception as e:
+        rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+    purge_deleted(result)
     return {"ok": True}
 
 @app.delete("/annotations/{annotation_id}")
@@ -977,11 +2102,12 @@ def delete_annotation_endpoint(annotation_id: int):
             rollback()
             raise HTTPException(status_code=404, detail="Annotation not found")
         
-        # If it's a region annotation, then delete the image from S3
-        if result["region_s3_key"]:
-            delete_s3_object(result["region_s3_key"])
-
         commit()
+
+        # Region images of this annotation and of any child chats it spawned
+        if result["s3_keys"]:
+            delete_s3_objects(result["s3_keys"])
+
         return {"ok": True}
     
     except Exception as e:
@@ -995,6 +2121,165 @@ def list_folders_endpoint(
     user_id = 1  # later from auth
     return list_folders(user_id=user_id, parent_id=parent_id)
 
+@app.get("/folders/tree")
+def get_folder_tree_endpoint(
+    root_id: Optional[int] = None,
+    max_depth: Optional[int] = None,
+    if_none_match: Optional[str] = Header(None),
+):
+    user_id = 1  # later from auth
+
+    if max_depth is not None and max_depth < 0:
+        raise HTTPException(status_code=400, detail="max_depth must be >= 0")
+
+    tree = get_folder_tree(user_id=user_id, root_id=root_id, max_depth=max_depth)
+    body = json.dumps({"folders": tree}, separators=(",", ":"))
+
+    etag = f'"{hashlib.sha256(body.encode("utf-8")).hexdigest()[:32]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+    if if_none_match and etag in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@app.get("/search")
+def search_endpoint(
+    q: str,
+    folder_id: Optional[int] = None,
+    kinds: str = "pages,messages,annotations",
+    limit: int = 20,
+):
+    user_id = 1  # later from auth
+
+    kind_list = [k.strip() for k in kinds.split(",") if k.strip()]
+    invalid = [k for k in kind_list if k not in ("pages", "messages", "annotations")]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Invalid kinds: {invalid}")
+
+    return {
+        "results": search(
+            user_id=user_id,
+            query=q,
+            folder_id=folder_id,
+            kinds=kind_list,
+            limit=max(1, min(100, limit)),
+        )
+    }
+
+@app.get("/export")
+def export_library():
+    # Doc: The user's whole library (rows as NDJSON plus PDFs and region images) as a streamed zip.
+    user_id = 1  # later from auth
+
+    filename = f"library-{time.strftime('%Y-%m-%d')}.zip"
+    return StreamingResponse(
+        stream_export(user_id),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+@app.post("/import")
+def import_library(file: UploadFile = File(...), folder_id: Optional[int] = Form(None)):
+    # Doc: Add an exported library to this user's, under folder_id (top level by default).
+    user_id = 1  # later from auth
+
+    if folder_id is not None and not folder_exists(folder_id, user_id):
+        raise HTTPException(status_code=404, detail="Folder not found")
+
+    # The upload is spooled to disk, so the zip is read without loading it
+    try:
+        archive = zipfile.ZipFile(file.file)
+        manifest = read_manifest(archive)
+    except (zipfile.BadZipFile, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Could not read archive: {e}")
+
+    # Blobs first, outside the transaction: the write lock is only held
+    # for the row inserts
+    try:
+        keys = upload_blobs(archive, user_id)
+    except Exception:
+        logger.exception("Import: could not upload the archive's blobs")
+        raise HTTPException(status_code=502, detail="Could not store the archive's files")
+
+    try:
+        counts = import_rows(archive, user_id, keys, folder_id)
+        commit()
+    except Exception as e:
+        rollback()
+        logger.exception("Import: could not insert the archive's rows")
+        delete_s3_objects(list(keys.values()))
+        if isinstance(e, (KeyError, ValueError)):
+            raise HTTPException(status_code=400, detail=f"Invalid archive: {e}")
+        raise
+
+    return {
+        "imported": counts,
+        "blobs": len(keys),
+        "exported_at": manifest.get("exported_at"),
+    }
+
+@app.get("/usage")
+def usage_endpoint(
+    group_by: str = "thread",
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+    file_id: Optional[int] = None,
+    chat_thread_id: Optional[int] = None,
+    limit: int = 100,
+):
+    # Doc: Token usage and cost summed per thread, file, user, model, route or day.
+    user_id = 1  # later from auth
+
+    if group_by not in USAGE_GROUPS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of {list(USAGE_GROUPS)}")
+
+    return {
+        "group_by": group_by,
+        "usage": get_usage_rollups(
+            user_id,
+            group_by,
+            since=since,
+            until=until,
+            file_id=file_id,
+            chat_thread_id=chat_thread_id,
+            limit=max(1, min(1000, limit)),
+        ),
+    }
+
+def budget_status(user_id: int):
+    budget = get_user_budget(user_id) or default_budget(user_id)
+    since = period_start(budget["period"])
+    spent = get_spend_usd(user_id, since)
+    return {
+        **budget,
+        "period_start": since,
+        "spent_usd": spent,
+        "state": budget_state(budget, spent),
+    }
+
+@app.get("/budget")
+def get_budget():
+    user_id = 1  # later from auth
+    return budget_status(user_id)
+
+@app.put("/budget")
+def put_budget(req: BudgetRequest):
+    user_id = 1  # later from auth
+
+    if req.period not in PERIODS:
+        raise HTTPException(status_code=400, detail=f"period must be one of {list(PERIODS)}")
+    if any(v is not None and v < 0 for v in (req.downgrade_usd, req.limit_usd)):
+        raise HTTPException(status_code=400, detail="Budgets can't be negative")
+
+    try:
+        set_user_budget(user_id, req.period, req.downgrade_usd, req.limit_usd)
+        commit()
+    except Exception:
+        rollback()
+        raise
+    return budget_status(user_id)
+
 @app.get("/chat/threads")
 def get_threads(file_id: int):
     threads = get_chat_threads_by_file(file_id)
@@ -1023,28 +2308,83 @@ def get_threads(file_id: int):
 
 
 @app.get("/chat/thread/{thread_id}")
-def get_thread_messages(thread_id: int):
+def get_thread_messages(thread_id: int, inherited: bool = False):
+    # inherited: also the messages a fork sees from its parent threads
+    if inherited:
+        return {"messages": get_thread_history(thread_id)}
     return {"messages": get_messages_by_thread(thread_id)}
 
+def resolve_fork(parent_thread_id: int, message_id: Optional[int]):
+    """
+    (parent thread, thread owning the fork point, fork message id) for a
+    fork of parent_thread_id at message_id (default: its latest message)
+    """
+    parent = get_chat_thread(parent_thread_id)
+    if not parent:
+        raise HTTPException(status_code=404, detail="Parent thread not found")
+
+    point = get_fork_point(parent_thread_id, message_id)
+    if point is None:
+        raise HTTPException(status_code=400, detail="Message is not in the parent thread's history")
+    return parent, point[0], point[1]
+
 @app.post("/chat/threads")
 def create_thread(payload: CreateChatThread):
+    parent_thread_id, fork_message_id = None, None
+    if payload.parent_thread_id is not None:
+        parent, parent_thread_id, fork_message_id = resolve_fork(
+            payload.parent_thread_id, payload.fork_message_id
+        )
+        # Forks live with their parent, so deleting the file takes both
+        if parent["file_id"] is None or parent["file_id"] != payload.file_id:
+            raise HTTPException(status_code=400, detail="Parent thread belongs to another file")
+
     thread_id = create_chat_thread(
         file_id=payload.file_id,
         source_annotation_id=payload.source_annotation_id,
         title=payload.title,
+        parent_thread_id=parent_thread_id,
+        fork_message_id=fork_message_id,
     )
     commit()
     return {"id": thread_id}
 
+@app.post("/chat/thread/{thread_id}/fork")
+def fork_thread(thread_id: int, payload: Optional[ForkThreadRequest] = None):
+    # Doc: New thread in the same file that sees this one's history up to a message, without copying it.
+    if payload is None:
+        payload = ForkThreadRequest()
+
+    parent, parent_thread_id, fork_message_id = resolve_fork(thread_id, payload.message_id)
+    if parent["file_id"] is None:
+        raise HTTPException(status_code=400, detail="Thread has no file")
+
+    new_thread_id = create_chat_thread(
+        file_id=parent["file_id"],
+        source_annotation_id=parent["source_annotation_id"],
+        title=payload.title or parent["title"],
+        parent_thread_id=parent_thread_id,
+        fork_message_id=fork_message_id,
+    )
+    commit()
+    return {
+        "id": new_thread_id,
+        "file_id": parent["file_id"],
+        "parent_thread_id": parent_thread_id,
+        "fork_message_id": fork_message_id,
+    }
+
 @app.delete("/folders/{folder_id}")
 def delete_folder(folder_id: int):
     try:
-        delete_folder_cascade(folder_id)
+        result = delete_folder_cascade(folder_id)
         commit()
-        return {"ok": True}
     except Exception as e:
         rollback()
         raise HTTPException(status_code=500, detail=str(e))
+
+    purge_deleted(result)
+    return {"ok": True}
     
 
 # Debug route 
@@ -1056,6 +2396,11 @@ def debug_page_count():
 def create_folder_endpoint(payload: CreateFolderRequest):
     user_id = 1
 
+    # Only under an existing folder of this user's: folder queries walk
+    # parent_id, so it must never point anywhere else
+    if payload.parent_id is not None and not folder_exists(payload.parent_id, user_id):
+        raise HTTPException(status_code=404, detail="Parent folder not found")
+
     folder_id = create_folder(payload.name, user_id)
 
     if payload.parent_id is not None:
@@ -1078,11 +2423,37 @@ def create_standalone_chat_endpoint(
     if payload is None:
         payload = CreateStandaloneChatRequest()
 
+    # A chat spawned from a highlight starts from the conversation it came
+    # from: the highlighted message's thread, or the parent thread given
+    parent_thread_id, fork_message_id = payload.parent_thread_id, payload.fork_message_id
+    annotation = None
+    if payload.source_annotation_id is not None:
+        annotation = get_annotation(payload.source_annotation_id)
+        if not annotation:
+            raise HTTPException(status_code=404, detail="Annotation not found")
+
+        if parent_thread_id is None and annotation["type"] == "chat_text":
+            highlighted = get_highlighted_message(annotation["id"])
+            if highlighted:
+                fork_message_id, parent_thread_id = highlighted
+
+    if parent_thread_id is not None:
+        # The chat is deleted with the highlighted file, so it may only
+        # inherit from a thread of that file
+        if annotation is None:
+            raise HTTPException(status_code=400, detail="parent_thread_id needs a source_annotation_id")
+        parent, parent_thread_id, fork_message_id = resolve_fork(parent_thread_id, fork_message_id)
+        parent_file = get_file(parent["file_id"]) if parent["file_id"] is not None else None
+        if not parent_file or parent_file["document_id"] != annotation["document_id"]:
+            raise HTTPException(status_code=400, detail="Parent thread belongs to another file")
+
     result = create_standalone_chat(
         user_id=user_id,
         folder_id=payload.folder_id,
         title=payload.title,
         source_annotation_id=payload.source_annotation_id,
+        parent_thread_id=parent_thread_id,
+        fork_message_id=fork_message_id,
     )
 
     commit()
@@ -1098,12 +2469,20 @@ def get_thread_by_annotation(annotation_id: int):
 # Debug route - load OpenAI
 @app.get("/debug/responses")
 def debug_openai_responses():
-    resp = client.responses.create(
+    resp = create_response(
         model="gpt-4o-mini",
         input="Say hello in one sentence"
     )
     return {"text": resp.output_text}
 
+# Prometheus scrape endpoint
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics_endpoint():
+    return PlainTextResponse(
+        render_metrics(),
+        media_type="text/plain; version=0.0.4",
+    )
+
 # Check health of the backend
 @app.get("/health")
 def health_check():
@@ -0,0 +1,311 @@
+# Per-request spans (SQL, S3, PyMuPDF, OpenAI) and Prometheus-format metrics.
+# metrics.py
+#
+# Every HTTP request gets a RequestTrace stored in a contextvar; the context is
+# copied into FastAPI's threadpool, so sync endpoints record into the same
+# trace. Spans also feed process-wide counters and histograms for /metrics.
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
+
+logger = logging.getLogger("engrave.metrics")
+
+# Log requests slower than this (0 disables the slow-request log)
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "1000"))
+# Same SQL statement repeated this often in one request is flagged as N+1
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "10"))
+
+DURATION_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+# ======================================================
+# Registry
+# ======================================================
+
+class _Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+
+    def describe(self, name: str, kind: str, text: str):
+        self.help[name] = (kind, text)
+
+    def inc(self, name: str, labels: dict, value: float = 1.0):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0.0) + value
+
+    def observe(self, name: str, labels: dict, value: float, buckets=DURATION_BUCKETS):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+                self.histograms[key] = hist
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist["counts"][i] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+
+    def render(self) -> str:
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {
+                k: {**v, "counts": list(v["counts"])}
+                for k, v in self.histograms.items()
+            }
+
+        lines = []
+        described = set()
+
+        def header(name):
+            if name in described or name not in self.help:
+                return
+            kind, text = self.help[name]
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            described.add(name)
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name)
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        for (name, labels), hist in sorted(histograms.items()):
+            header(name)
+            for bound, count in zip(hist["buckets"], hist["counts"]):
+                le = (("le", _format_value(bound)),)
+                lines.append(f"{name}_bucket{_format_labels(labels + le)} {count}")
+            inf = (("le", "+Inf"),)
+            lines.append(f"{name}_bucket{_format_labels(labels + inf)} {hist['count']}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(hist['sum'])}")
+            lines.append(f"{name}_count{_format_labels(labels)} {hist['count']}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _format_value(value) -> str:
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+registry = _Registry()
+
+registry.describe("http_requests_total", "counter", "HTTP requests by route and status")
+registry.describe("http_request_duration_seconds", "histogram", "HTTP request latency")
+registry.describe("http_request_db_queries", "histogram", "SQL statements per HTTP request")
+registry.describe("span_duration_seconds", "histogram", "Duration of SQL, S3, PDF and LLM calls")
+registry.describe("span_rows_total", "counter", "Rows returned or changed by SQL statements")
+registry.describe("span_bytes_total", "counter", "Bytes moved by S3 and PDF operations")
+registry.describe("llm_tokens_total", "counter", "OpenAI tokens by model and direction")
+registry.describe("llm_retries_total", "counter", "OpenAI attempts retried, by model and status/error")
+registry.describe("llm_failed_total", "counter", "OpenAI calls that gave up after retries or at their deadline")
+registry.describe("llm_breaker_opened_total", "counter", "Times the OpenAI circuit breaker opened")
+registry.describe("llm_coalesced_total", "counter", "OpenAI calls answered by an identical in-flight request instead of upstream")
+registry.describe("ocr_pages_total", "counter", "Scanned pages given text, by source (cache or ocr)")
+registry.describe("ocr_page_seconds", "histogram", "CPU time to OCR one page in a worker process")
+registry.describe("summaries_total", "counter", "Summaries built, by level (page, section, document) and source (llm, or short page text used as is)")
+registry.describe("ask_route_total", "counter", "Answered questions by route (router.py), context sent and model")
+registry.describe("ask_route_seconds", "histogram", "Time to answer a question, by route")
+registry.describe("ask_route_tokens_total", "counter", "OpenAI tokens by route and direction (input, cached, output)")
+registry.describe("ask_route_cost_usd_total", "counter", "Estimated OpenAI cost in USD by route (llm.PRICES)")
+registry.describe("budget_checks_total", "counter", "Per-user budget checks before a question by outcome (ok, downgraded, rejected)")
+registry.describe("n_plus_one_requests_total", "counter", "Requests that repeated one SQL statement past the threshold")
+registry.describe("sqlite_write_transaction_seconds", "histogram", "Time from the first write to commit/rollback, i.e. how long the write lock was held")
+registry.describe("sqlite_lock_retries_total", "counter", "SQL statements retried after waiting out busy_timeout on the write lock")
+
+
+def inc(name: str, value: float = 1.0, **labels):
+    registry.inc(name, labels, value)
+
+
+def observe(name: str, value: float, buckets=DURATION_BUCKETS, **labels):
+    registry.observe(name, labels, value, buckets)
+
+
+def render_metrics() -> str:
+    return registry.render()
+
+
+# ======================================================
+# Request traces and spans
+# ======================================================
+
+class RequestTrace:
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.route = None
+        self.start = time.perf_counter()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, record: dict):
+        with self.lock:
+            self.spans.append(record)
+
+    def summary(self) -> dict:
+        with self.lock:
+            spans = list(self.spans)
+
+        by_kind = {}
+        for s in spans:
+            agg = by_kind.setdefault(s["kind"], {"count": 0, "ms": 0.0, "rows": 0, "bytes": 0})
+            agg["count"] += 1
+            agg["ms"] += s["duration"] * 1000
+            agg["rows"] += s.get("rows", 0)
+            agg["bytes"] += s.get("bytes", 0)
+        return by_kind
+
+
+_current_trace = contextvars.ContextVar("request_trace", default=None)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def span(kind: str, operation: str, **attrs):
+    """
+    Time a block as a span of the current request, if any, and in /metrics.
+
+    The yielded dict can be updated with rows/bytes/tokens inside the block.
+    """
+    record = {"kind": kind, "operation": operation, **attrs}
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["duration"] = time.perf_counter() - start
+        record_span(record)
+
+
+def record_span(record: dict):
+    kind = record["kind"]
+    operation = record["operation"]
+
+    observe("span_duration_seconds", record["duration"], kind=kind, operation=operation)
+    if record.get("rows"):
+        inc("span_rows_total", record["rows"], kind=kind, operation=operation)
+    if record.get("bytes"):
+        inc("span_bytes_total", record["bytes"], kind=kind, operation=operation)
+
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(record)
+
+
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+_SQL_SPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=1024)
+def sql_fingerprint(sql: str) -> str:
+    return _SQL_SPACE.sub(" ", _SQL_LITERALS.sub("?", sql)).strip()
+
+
+@lru_cache(maxsize=1024)
+def sql_operation(sql: str) -> str:
+    head = sql.lstrip().split(None, 1)
+    return head[0].upper() if head else "UNKNOWN"
+
+
+def find_n_plus_one(trace: RequestTrace):
+    with trace.lock:
+        statements = [s["sql"] for s in trace.spans if s["kind"] == "sql"]
+
+    return [
+        {"sql": sql, "count": count}
+        for sql, count in Counter(statements).most_common()
+        if count >= N_PLUS_ONE_THRESHOLD
+    ]
+
+
+def _finish(trace: RequestTrace, status: int):
+    elapsed = time.perf_counter() - trace.start
+    route = trace.route or "unmatched"
+
+    inc("http_requests_total", method=trace.method, route=route, status=str(status))
+    observe("http_request_duration_seconds", elapsed, method=trace.method, route=route)
+
+    summary = trace.summary()
+    sql_count = summary.get("sql", {}).get("count", 0)
+    observe("http_request_db_queries", sql_count, COUNT_BUCKETS, method=trace.method, route=route)
+
+    repeated = find_n_plus_one(trace)
+    if repeated:
+        inc("n_plus_one_requests_total", method=trace.method, route=route)
+
+    slow = bool(SLOW_REQUEST_MS) and elapsed * 1000 >= SLOW_REQUEST_MS
+    if slow or repeated:
+        parts = [
+            f"{kind}={agg['count']}x/{agg['ms']:.1f}ms"
+            + (f"/{agg['rows']}rows" if agg["rows"] else "")
+            + (f"/{agg['bytes']}B" if agg["bytes"] else "")
+            for kind, agg in sorted(summary.items())
+        ]
+        logger.warning(
+            "%s %s %s %.1fms %s",
+            "SLOW" if slow else "N+1",
+            trace.method,
+            trace.path,
+            elapsed * 1000,
+            " ".join(parts),
+        )
+        for item in repeated:
+            logger.warning("  N+1 candidate (%dx): %s", item["count"], item["sql"][:200])
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that opens a RequestTrace for every HTTP request
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = RequestTrace(scope["method"], scope["path"])
+        token = _current_trace.set(trace)
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The router stores the matched route on the shared scope
+            route = scope.get("route")
+            trace.route = getattr(route, "path", None)
+            _current_trace.reset(token)
+            _finish(trace, status["code"])
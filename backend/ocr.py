@@ -0,0 +1,219 @@
+# OCR for scanned pages (no text layer) with Tesseract via PyMuPDF, run in a
+# process pool and cached by page content.
+# ocr.py
+#
+# Extraction marks pages with (almost) no text but with images and records a
+# hash of their content. run_ocr() looks those hashes up in ocr_cache, OCRs
+# the misses in worker processes (OCR is CPU-bound and holds the GIL), and
+# returns the text for the caller to write through save_pages.
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from metrics import span, inc, observe
+
+logger = logging.getLogger("engrave.ocr")
+
+# 0 = never OCR; text-less pages stay empty
+OCR_ENABLED = os.getenv("OCR_ENABLED", "1") != "0"
+# Worker processes per app process; lower this when running several
+# uvicorn workers on one machine
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(os.cpu_count() or 1)))
+OCR_LANGUAGE = os.getenv("OCR_LANGUAGE", "eng")
+OCR_DPI = int(os.getenv("OCR_DPI", "300"))
+# Pages with fewer non-whitespace characters than this are OCR candidates
+OCR_MIN_CHARS = int(os.getenv("OCR_MIN_CHARS", "20"))
+
+# Bump when OCR settings or post-processing change so cached text stops matching
+OCR_VERSION = "1"
+
+
+class OCRUnavailable(Exception):
+    """
+    Tesseract (or its language data) isn't installed
+    """
+
+
+def needs_ocr(page, text: str) -> bool:
+    """
+    True for pages that look scanned: next to no text, but some images
+    """
+    if len("".join(text.split())) >= OCR_MIN_CHARS:
+        return False
+    return bool(page.get_images())
+
+
+def page_content_hash(page) -> str:
+    """
+    sha256 of what a page draws: its content stream, the raw bytes of the
+    images and form XObjects it uses, and its size and rotation.
+
+    Fonts are left out (they are shared by most pages and can be large), so
+    a change that only swaps a font's encoding goes unnoticed.
+    """
+    doc = page.parent
+    h = hashlib.sha256()
+    h.update(f"{tuple(page.rect)}|{page.rotation}|".encode("utf-8"))
+    h.update(page.read_contents())
+    for image in page.get_images(full=True):
+        h.update(doc.xref_stream_raw(image[0]) or b"")
+    for xobject in page.get_xobjects():
+        h.update(doc.xref_stream_raw(xobject[0]) or b"")
+    return h.hexdigest()
+
+
+def ocr_cache_key(content_hash: str) -> str:
+    parts = [OCR_VERSION, OCR_LANGUAGE, str(OCR_DPI), content_hash]
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+
+# ======================================================
+# Worker processes
+# ======================================================
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # spawn, not fork: the app process has threads and open
+                # SQLite connections that must not be copied into workers
+                _pool = ProcessPoolExecutor(
+                    max_workers=OCR_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def _ocr_worker(pdf_bytes: bytes, page_numbers, language: str, dpi: int):
+    """
+    Runs in a worker process: OCR the given pages, returning
+    [(page_number, text, cpu_seconds)]
+    """
+    import fitz
+
+    try:
+        tessdata = fitz.get_tessdata()
+    except RuntimeError as e:
+        raise OCRUnavailable(str(e)) from None
+
+    results = []
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        for page_number in page_numbers:
+            start = time.process_time()
+            page = doc[page_number - 1]
+            textpage = page.get_textpage_ocr(
+                flags=fitz.TEXTFLAGS_TEXT,
+                language=language,
+                dpi=dpi,
+                full=True,
+                tessdata=tessdata,
+            )
+            text = page.get_text(textpage=textpage)
+            results.append((page_number, text, time.process_time() - start))
+    return results
+
+
+# ======================================================
+# Ingestion
+# ======================================================
+
+def run_ocr(pdf_bytes: bytes, candidates, cached):
+    """
+    OCR the candidate pages that aren't cached.
+
+    candidates: {page_number: content_hash}
+    cached: {cache_key: text} already looked up in ocr_cache
+    Returns ({page_number: text}, {cache_key: text} new cache entries, stats).
+    Raises OCRUnavailable if Tesseract is missing.
+    """
+    texts = {}
+    # Identical pages (e.g. repeated blank scans) are OCR'd once
+    todo = {}
+    for page_number, content_hash in sorted(candidates.items()):
+        key = ocr_cache_key(content_hash)
+        if key in cached:
+            texts[page_number] = cached[key]
+        else:
+            todo.setdefault(key, []).append(page_number)
+
+    stats = {
+        "pages": len(candidates),
+        "cached": len(texts),
+        "ocr_pages": len(todo),
+        "workers": 0,
+        "seconds": 0.0,
+        "cpu_seconds": 0.0,
+    }
+    inc("ocr_pages_total", len(texts), source="cache")
+    if not todo:
+        return texts, {}, stats
+
+    # One task per worker, each opening the PDF once for its share of pages
+    firsts = sorted(pages[0] for pages in todo.values())
+    workers = min(OCR_WORKERS, len(firsts))
+    chunks = [firsts[i::workers] for i in range(workers)]
+
+    key_by_page = {pages[0]: key for key, pages in todo.items()}
+    new_entries = {}
+
+    with span("ocr", "pages", pages=len(firsts), workers=workers) as record:
+        start = time.perf_counter()
+        futures = [
+            get_pool().submit(_ocr_worker, pdf_bytes, chunk, OCR_LANGUAGE, OCR_DPI)
+            for chunk in chunks
+        ]
+        for future in futures:
+            try:
+                results = future.result()
+            except BrokenProcessPool:
+                # A worker died (e.g. out of memory); start fresh next time
+                shutdown_pool()
+                raise
+            for page_number, text, cpu_seconds in results:
+                key = key_by_page[page_number]
+                new_entries[key] = text
+                for same_page in todo[key]:
+                    texts[same_page] = text
+                stats["cpu_seconds"] += cpu_seconds
+                observe("ocr_page_seconds", cpu_seconds)
+
+        stats["workers"] = workers
+        stats["seconds"] = time.perf_counter() - start
+        record["cpu_seconds"] = stats["cpu_seconds"]
+
+    inc("ocr_pages_total", len(firsts), source="ocr")
+    return texts, new_entries, stats
+
+
+def throughput(stats) -> str:
+    """
+    One-line summary, including pages per second per core
+    """
+    if not stats["ocr_pages"]:
+        return f"{stats['pages']} pages, all cached"
+
+    per_core_wall = stats["ocr_pages"] / stats["seconds"] / stats["workers"]
+    per_cpu_second = stats["ocr_pages"] / stats["cpu_seconds"] if stats["cpu_seconds"] else 0.0
+    return (
+        f"{stats['pages']} pages ({stats['cached']} cached), OCR'd {stats['ocr_pages']} "
+        f"in {stats['seconds']:.1f}s on {stats['workers']} workers: "
+        f"{per_core_wall:.2f} pages/s per core, {per_cpu_second:.2f} pages per CPU second"
+    )
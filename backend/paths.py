@@ -2,7 +2,12 @@ import os
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
+# Overridable so benchmarks can keep caches out of the repo
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", os.path.join(BASE_DIR, "uploads"))
 REGION_DIR = os.path.join(UPLOAD_DIR, "regions")
+DOCUMENT_CACHE_DIR = os.path.join(UPLOAD_DIR, "documents")
+TILE_CACHE_DIR = os.path.join(UPLOAD_DIR, "tiles")
 
 os.makedirs(REGION_DIR, exist_ok=True)
+os.makedirs(DOCUMENT_CACHE_DIR, exist_ok=True)
+os.makedirs(TILE_CACHE_DIR, exist_ok=True)
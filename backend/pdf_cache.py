@@ -0,0 +1,225 @@
+# Process-wide LRU of opened PyMuPDF documents, backed by local PDF copies.
+# pdf_cache.py
+#
+# Open handles are evicted by count and by the total size of their PDFs.
+# Local copies live under DOCUMENT_CACHE_DIR and are trimmed by total size,
+# least recently used first, so a cold handle costs a file open, not an S3 GET.
+import os
+import re
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from metrics import span
+from paths import DOCUMENT_CACHE_DIR
+from s3 import download_pdf_to_path
+
+MAX_OPEN_DOCUMENTS = int(os.getenv("PDF_CACHE_MAX_OPEN", "16"))
+MAX_OPEN_BYTES = int(os.getenv("PDF_CACHE_MAX_OPEN_BYTES", str(512 * 1024 * 1024)))
+MAX_DISK_BYTES = int(os.getenv("PDF_CACHE_MAX_DISK_BYTES", str(4 * 1024 * 1024 * 1024)))
+
+
+class _Entry:
+    def __init__(self, doc, path: str, size: int):
+        self.doc = doc
+        self.path = path
+        self.size = size
+        # fitz.Document is not safe to use from several threads at once
+        self.lock = threading.Lock()
+        self.users = 0
+        self.evicted = False
+
+
+_entries = OrderedDict()
+_open_bytes = 0
+_lock = threading.Lock()
+
+_stats = {"hits": 0, "misses": 0, "downloads": 0, "evictions": 0}
+
+
+def local_pdf_path(document_id: str) -> str:
+    safe_id = re.sub(r"[^A-Za-z0-9_-]", "_", document_id)
+    return os.path.join(DOCUMENT_CACHE_DIR, f"{safe_id}.pdf")
+
+
+def store_local_copy(document_id: str, pdf_bytes: bytes) -> str:
+    """
+    Write PDF bytes we already hold (e.g. from /upload) into the disk cache
+    """
+    path = local_pdf_path(document_id)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(pdf_bytes)
+    os.replace(tmp_path, path)
+
+    _trim_disk(keep=path)
+    return path
+
+
+def _ensure_local_copy(document_id: str, s3_key: str) -> str:
+    path = local_pdf_path(document_id)
+    if os.path.exists(path):
+        # Touch so disk trimming treats it as recently used
+        os.utime(path)
+        return path
+
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        download_pdf_to_path(s3_key, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    with _lock:
+        _stats["downloads"] += 1
+
+    _trim_disk(keep=path)
+    return path
+
+
+def _trim_disk(keep: str = None):
+    files = []
+    total = 0
+    for name in os.listdir(DOCUMENT_CACHE_DIR):
+        if not name.endswith(".pdf"):
+            continue
+        path = os.path.join(DOCUMENT_CACHE_DIR, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+
+    if total <= MAX_DISK_BYTES:
+        return
+
+    with _lock:
+        open_paths = {e.path for e in _entries.values()}
+
+    # Oldest first; never remove a copy that backs an open handle
+    for _, size, path in sorted(files):
+        if total <= MAX_DISK_BYTES:
+            break
+        if path == keep or path in open_paths:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except FileNotFoundError:
+            pass
+
+
+def _close_if_unused(entry: _Entry):
+    # Caller holds _lock
+    if entry.evicted and entry.users == 0 and not entry.doc.is_closed:
+        entry.doc.close()
+
+
+def _evict_over_limits():
+    # Caller holds _lock
+    global _open_bytes
+    while _entries and (
+        len(_entries) > MAX_OPEN_DOCUMENTS or _open_bytes > MAX_OPEN_BYTES
+    ):
+        if len(_entries) == 1:
+            # Keep the document we just opened even if it alone is over budget
+            break
+        _, evicted = _entries.popitem(last=False)
+        _open_bytes -= evicted.size
+        evicted.evicted = True
+        _stats["evictions"] += 1
+        _close_if_unused(evicted)
+
+
+def _acquire(document_id: str, s3_key: str) -> _Entry:
+    global _open_bytes
+
+    with _lock:
+        entry = _entries.get(document_id)
+        if entry:
+            _entries.move_to_end(document_id)
+            entry.users += 1
+            _stats["hits"] += 1
+            return entry
+        _stats["misses"] += 1
+
+    # Imported here so the app starts without loading PyMuPDF
+    import fitz
+
+    path = _ensure_local_copy(document_id, s3_key)
+    with span("pdf", "open") as record:
+        size = os.path.getsize(path)
+        loaded = _Entry(fitz.open(path), path, size)
+        record["bytes"] = size
+
+    with _lock:
+        # Another request may have opened it while we were loading
+        entry = _entries.get(document_id)
+        if entry is None:
+            entry = loaded
+            _entries[document_id] = entry
+            _open_bytes += entry.size
+            _evict_over_limits()
+        else:
+            _entries.move_to_end(document_id)
+            loaded.doc.close()
+
+        entry.users += 1
+        return entry
+
+
+def _release(entry: _Entry):
+    with _lock:
+        entry.users -= 1
+        _close_if_unused(entry)
+
+
+def read_pdf_bytes(document_id: str, s3_key: str) -> bytes:
+    """
+    The PDF's bytes from the local copy (downloaded first if needed), e.g. to
+    hand to worker processes
+    """
+    with open(_ensure_local_copy(document_id, s3_key), "rb") as f:
+        return f.read()
+
+
+@contextmanager
+def open_document(document_id: str, s3_key: str):
+    """
+    Yield an opened fitz.Document for this document, reusing a cached handle
+    """
+    entry = _acquire(document_id, s3_key)
+    try:
+        with entry.lock:
+            yield entry.doc
+    finally:
+        _release(entry)
+
+
+def evict_document(document_id: str, remove_local: bool = False):
+    global _open_bytes
+
+    with _lock:
+        entry = _entries.pop(document_id, None)
+        if entry:
+            _open_bytes -= entry.size
+            entry.evicted = True
+            _close_if_unused(entry)
+
+    if remove_local:
+        try:
+            os.remove(local_pdf_path(document_id))
+        except FileNotFoundError:
+            pass
+
+
+def cache_stats():
+    with _lock:
+        return {
+            **_stats,
+            "open_documents": len(_entries),
+            "open_bytes": _open_bytes,
+        }
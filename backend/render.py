@@ -0,0 +1,160 @@
+# Server-side rendering of PDF pages and regions with PyMuPDF.
+# render.py
+#
+# fitz is imported inside each function so importing this module (and main)
+# stays cheap; PyMuPDF loads on the first render.
+from geometry import geometry_bbox
+from metrics import span
+from pdf_cache import open_document
+
+MIN_DPI = 36
+MAX_DPI = 600
+
+
+def clamp_dpi(dpi: int) -> int:
+    return max(MIN_DPI, min(MAX_DPI, int(dpi)))
+
+
+def render_region_png(
+    document_id: str,
+    s3_key: str,
+    page_number: int,
+    geometry,
+    dpi: int = 150,
+) -> bytes:
+    """
+    Render only the clip rectangle of one page and return PNG bytes
+    """
+    bbox = geometry_bbox(geometry)
+    if bbox is None:
+        raise ValueError("Geometry does not describe a region")
+
+    import fitz
+
+    with open_document(document_id, s3_key) as doc:
+        if page_number < 1 or page_number > doc.page_count:
+            raise ValueError(f"Page {page_number} out of range")
+
+        page = doc[page_number - 1]
+        page_rect = page.rect
+        x0, y0, x1, y1 = bbox
+
+        clip = fitz.Rect(
+            page_rect.x0 + x0 * page_rect.width,
+            page_rect.y0 + y0 * page_rect.height,
+            page_rect.x0 + x1 * page_rect.width,
+            page_rect.y0 + y1 * page_rect.height,
+        )
+
+        with span("pdf", "render_region") as record:
+            pix = page.get_pixmap(clip=clip, dpi=clamp_dpi(dpi))
+            data = pix.tobytes("png")
+            record["bytes"] = len(data)
+        return data
+
+
+# ======================================================
+# Page images, thumbnails and tiles
+# ======================================================
+
+TILE_SIZE = 512
+MIN_ZOOM = 0.1
+MAX_ZOOM = 8.0
+
+IMAGE_FORMATS = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+}
+
+
+def clamp_zoom(zoom: float) -> float:
+    return max(MIN_ZOOM, min(MAX_ZOOM, float(zoom)))
+
+
+def _encode(pix, image_format: str) -> bytes:
+    if image_format == "jpeg":
+        return pix.tobytes("jpeg", jpg_quality=85)
+    return pix.tobytes("png")
+
+
+def get_page_sizes(document_id: str, s3_key: str):
+    """
+    Return the size of every page in PDF points, for laying out placeholders
+    """
+    with open_document(document_id, s3_key) as doc:
+        return [
+            {
+                "page_number": idx + 1,
+                "width": page.rect.width,
+                "height": page.rect.height,
+            }
+            for idx, page in enumerate(doc)
+        ]
+
+
+def render_thumbnail(
+    document_id: str,
+    s3_key: str,
+    page_number: int,
+    width: int = 200,
+    image_format: str = "jpeg",
+) -> bytes:
+    import fitz
+
+    with open_document(document_id, s3_key) as doc:
+        if page_number < 1 or page_number > doc.page_count:
+            raise ValueError(f"Page {page_number} out of range")
+
+        page = doc[page_number - 1]
+        zoom = clamp_zoom(width / page.rect.width)
+
+        with span("pdf", "render_thumbnail") as record:
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            data = _encode(pix, image_format)
+            record["bytes"] = len(data)
+        return data
+
+
+def render_tile(
+    document_id: str,
+    s3_key: str,
+    page_number: int,
+    zoom: float,
+    tile_x: int,
+    tile_y: int,
+    image_format: str = "png",
+) -> bytes:
+    """
+    Render one TILE_SIZE x TILE_SIZE pixel tile of a page at the given zoom
+    """
+    import fitz
+
+    zoom = clamp_zoom(zoom)
+
+    with open_document(document_id, s3_key) as doc:
+        if page_number < 1 or page_number > doc.page_count:
+            raise ValueError(f"Page {page_number} out of range")
+
+        page = doc[page_number - 1]
+        page_rect = page.rect
+        step = TILE_SIZE / zoom
+
+        clip = fitz.Rect(
+            page_rect.x0 + tile_x * step,
+            page_rect.y0 + tile_y * step,
+            page_rect.x0 + (tile_x + 1) * step,
+            page_rect.y0 + (tile_y + 1) * step,
+        ) & page_rect
+
+        if tile_x < 0 or tile_y < 0 or clip.is_empty:
+            raise ValueError("Tile outside page")
+
+        with span("pdf", "render_tile") as record:
+            pix = page.get_pixmap(
+                matrix=fitz.Matrix(zoom, zoom),
+                clip=clip,
+                alpha=False,
+            )
+            data = _encode(pix, image_format)
+            record["bytes"] = len(data)
+        return data
@@ -0,0 +1,154 @@
+# Routes a question to a context strategy and model tier using cheap local
+# heuristics, and records latency, tokens and cost per route.
+# router.py
+#
+# Document-level questions (no selection) are classified as:
+#   page        mentions a page or slide number: those pages and their neighbours
+#   overview    asks for a summary or the main points: the summary tree
+#   definition  "what is X" / "define X": the pages where X appears
+#   followup    short continuation of the thread: the summary tree plus history
+#   document    anything else: the full text
+# Questions about a selection (text, region, chat_text) and standalone chats
+# keep their own context and are recorded as routes of their own.
+# main.py builds each route's context; anything a route can't find (no such
+# page, no summaries yet, term not in the document) falls back to full text.
+import os
+import re
+
+from metrics import inc, observe
+from summaries import is_overview_question
+
+ASK_MODEL = os.getenv("ASK_MODEL", "gpt-4.1-mini")
+ASK_MODEL_SMALL = os.getenv("ASK_MODEL_SMALL", "gpt-4.1-nano")
+
+# Model tier per route; override with e.g. ASK_ROUTE_TIERS="followup=small"
+ROUTE_TIERS = {
+    "page": "default",
+    "overview": "default",
+    "definition": "small",
+    "followup": "default",
+    "document": "default",
+    "selection": "default",
+    "region": "default",
+    "chat_text": "default",
+    "standalone": "default",
+}
+for _item in filter(None, os.getenv("ASK_ROUTE_TIERS", "").split(",")):
+    _route, _, _tier = _item.partition("=")
+    ROUTE_TIERS[_route.strip()] = _tier.strip()
+
+TIER_MODELS = {"default": ASK_MODEL, "small": ASK_MODEL_SMALL}
+
+# Pages on either side of a referenced page sent along with it
+PAGE_NEIGHBOURS = int(os.getenv("ASK_PAGE_NEIGHBOURS", "1"))
+# Pages sent for a definition lookup, best matches first
+DEFINITION_PAGES = int(os.getenv("ASK_DEFINITION_PAGES", "3"))
+
+# "page 12", "p. 12", "slides 3-5", "pages 3 and 4"
+_PAGE_REF = re.compile(
+    r"\b(?:pages?|slides?|pp?\.)\s*(\d{1,4})(?:\s*(?:-|–|to|and|&)\s*(\d{1,4}))?",
+    re.IGNORECASE,
+)
+
+_DEFINITION = re.compile(
+    r"^\s*(?:"
+    r"what(?:'s| is| are)\s+(?:an?\s+|the\s+)?(?P<a>.+?)"
+    r"|define\s+(?P<b>.+?)"
+    r"|(?:the\s+)?(?:definition|meaning)\s+of\s+(?P<c>.+?)"
+    r"|what\s+does\s+(?P<d>.+?)\s+(?:mean|stand for)"
+    r")\s*[?.!]*\s*$",
+    re.IGNORECASE,
+)
+
+# Words that point back at the conversation rather than name a term
+_ANAPHORA = {"it", "its", "this", "that", "these", "those", "they", "them", "he", "she", "there"}
+
+_FOLLOWUP_START = re.compile(
+    r"^\s*(?:why|how so|how come|and\b|but\b|so\b|what about|what if|then\b|ok\b|okay\b"
+    r"|elaborate|explain (?:more|further|again|it|that|this)|more\b|go on|continue"
+    r"|(?:can|could) you (?:elaborate|explain (?:more|further|again|it|that|this)|give|show|expand|simplify)"
+    r"|(?:give|show) me (?:an?|another) example|another example|example\b"
+    r"|i (?:still )?don'?t (?:get|understand))",
+    re.IGNORECASE,
+)
+
+# Longest term treated as a definition lookup, in words
+_MAX_TERM_WORDS = 6
+_FOLLOWUP_MAX_WORDS = 12
+
+
+def page_references(question: str):
+    """
+    Page numbers a question mentions, in order, ranges expanded (at most 20)
+    """
+    numbers = []
+    for match in _PAGE_REF.finditer(question):
+        first = int(match.group(1))
+        last = int(match.group(2)) if match.group(2) else first
+        if last < first or last - first > 20:
+            last = first
+        numbers += [n for n in range(first, last + 1) if n not in numbers]
+    return numbers[:20]
+
+
+def definition_term(question: str):
+    """
+    The term a "what is X" question asks about, or None
+    """
+    match = _DEFINITION.match(question)
+    if not match:
+        return None
+
+    term = next(g for g in match.groups() if g).strip(" \"'`")
+    words = term.lower().split()
+    if not words or len(words) > _MAX_TERM_WORDS or set(words) & _ANAPHORA:
+        return None
+    return term
+
+
+def is_followup(question: str, has_history: bool) -> bool:
+    if not has_history:
+        return False
+    words = re.findall(r"[\w']+", question.lower())
+    if len(words) > _FOLLOWUP_MAX_WORDS:
+        return False
+    return bool(_FOLLOWUP_START.match(question)) or (len(words) <= 6 and bool(set(words) & _ANAPHORA))
+
+
+def classify(question: str, has_history: bool = False):
+    """
+    Route for a document-level question:
+    {"route": name, "pages": [page numbers], "term": definition term or None}
+    """
+    pages = page_references(question)
+    if pages:
+        return {"route": "page", "pages": pages, "term": None}
+    if is_overview_question(question):
+        return {"route": "overview", "pages": [], "term": None}
+    if is_followup(question, has_history):
+        return {"route": "followup", "pages": [], "term": None}
+
+    term = definition_term(question)
+    if term:
+        return {"route": "definition", "pages": [], "term": term}
+    return {"route": "document", "pages": [], "term": None}
+
+
+def model_for(route: str) -> str:
+    return TIER_MODELS.get(ROUTE_TIERS.get(route, "default"), ASK_MODEL)
+
+
+def record_route(route: str, context: str, model: str, usage):
+    """
+    Record one answered question: latency, tokens and cost (a
+    usage.totals() record)
+    """
+    inc("ask_route_total", route=route, context=context, model=model)
+    observe("ask_route_seconds", usage["latency_ms"] / 1000, route=route)
+
+    for direction in ("input", "cached", "output"):
+        if usage[f"{direction}_tokens"]:
+            inc("ask_route_tokens_total", usage[f"{direction}_tokens"], route=route, direction=direction)
+
+    if usage["cost_usd"]:
+        inc("ask_route_cost_usd_total", usage["cost_usd"], route=route)
@@ -1,8 +1,10 @@
 # s3.py
 import os
-import boto3
+import threading
 from dotenv import load_dotenv
 
+from metrics import span
+
 # Load .env variables
 load_dotenv()
 
@@ -16,26 +18,61 @@ if not AWS_REGION:
 if not BUCKET:
     raise RuntimeError("AWS_S3_BUCKET is not set")
 
-# Create S3 client
-# Let boto3 automatically pick up credentials from env
-s3 = boto3.client(
-    "s3",
-    region_name=AWS_REGION,
-)
+_s3 = None
+_s3_lock = threading.Lock()
 
 
-def upload_pdf(file_obj, user_id: int, file_id: int) -> str:
+def get_client():
     """
-    Upload a PDF to S3 and return the object key
+    Return the S3 client, creating it on first use.
+
+    boto3 takes a few hundred ms to import, so it is not loaded at startup.
     """
-    key = f"users/user_{user_id}/files/{file_id}.pdf"
+    global _s3
+    if _s3 is None:
+        with _s3_lock:
+            if _s3 is None:
+                import boto3
 
-    s3.upload_fileobj(
-        Fileobj=file_obj,
-        Bucket=BUCKET,
-        Key=key,
-        ExtraArgs={"ContentType": "application/pdf"},
-    )
+                # Let boto3 automatically pick up credentials from env
+                _s3 = boto3.client(
+                    "s3",
+                    region_name=AWS_REGION,
+                )
+    return _s3
+
+
+def _bytes_read(file_obj) -> int:
+    # Uploads read the stream to the end, so its position is the size
+    try:
+        return file_obj.tell()
+    except Exception:
+        return 0
+
+
+def upload_pdf(file_obj, user_id: int, file_id: int = None, version: str = None, document_id: str = None) -> str:
+    """
+    Upload a PDF to S3 and return the object key.
+
+    A new upload is keyed by its document_id, so the object exists before
+    its file row does. A version gives a revised PDF its own key, so the old
+    one stays valid until the database points at the new one.
+    """
+    if document_id:
+        key = f"users/user_{user_id}/files/{document_id}.pdf"
+    elif version:
+        key = f"users/user_{user_id}/files/{file_id}-{version}.pdf"
+    else:
+        key = f"users/user_{user_id}/files/{file_id}.pdf"
+
+    with span("s3", "upload_pdf") as record:
+        get_client().upload_fileobj(
+            Fileobj=file_obj,
+            Bucket=BUCKET,
+            Key=key,
+            ExtraArgs={"ContentType": "application/pdf"},
+        )
+        record["bytes"] = _bytes_read(file_obj)
 
     return key
 
@@ -46,27 +83,95 @@ def upload_region_to_s3(file_obj, user_id: int, region_id: str, content_type: st
     """
     key = f"users/user_{user_id}/regions/{region_id}{ext}"
 
-    s3.upload_fileobj(
-        Fileobj=file_obj,
-        Bucket=BUCKET,
-        Key=key,
-        ExtraArgs={"ContentType": content_type},
-    )
+    with span("s3", "upload_region") as record:
+        get_client().upload_fileobj(
+            Fileobj=file_obj,
+            Bucket=BUCKET,
+            Key=key,
+            ExtraArgs={"ContentType": content_type},
+        )
+        record["bytes"] = _bytes_read(file_obj)
 
     return key
 
+
+def download_pdf_to_path(s3_key: str, path: str):
+    """
+    Stream a stored PDF from S3 into a local file
+    """
+    with span("s3", "download_file") as record:
+        get_client().download_file(
+            Bucket=BUCKET,
+            Key=s3_key,
+            Filename=path,
+        )
+        record["bytes"] = os.path.getsize(path)
+
+
+def upload_blob(file_obj, key: str, content_type: str) -> str:
+    """
+    Stream any object to S3 under the given key and return the key
+    """
+    with span("s3", "upload_blob") as record:
+        get_client().upload_fileobj(
+            Fileobj=file_obj,
+            Bucket=BUCKET,
+            Key=key,
+            ExtraArgs={"ContentType": content_type},
+        )
+        record["bytes"] = _bytes_read(file_obj)
+
+    return key
+
+
+def download_blob(s3_key: str, file_obj):
+    """
+    Stream a stored object into a writable file object
+    """
+    with span("s3", "download_blob") as record:
+        get_client().download_fileobj(
+            Bucket=BUCKET,
+            Key=s3_key,
+            Fileobj=file_obj,
+        )
+        record["bytes"] = _bytes_read(file_obj)
+
+
 def delete_s3_object(s3_key: str):
-    s3.delete_object(
-        Bucket=BUCKET,
-        Key=s3_key,
-    )
+    with span("s3", "delete_object"):
+        get_client().delete_object(
+            Bucket=BUCKET,
+            Key=s3_key,
+        )
+
+
+def delete_s3_objects(s3_keys):
+    """
+    Delete many objects with batched DeleteObjects calls (1000 keys per call)
+    """
+    keys = list(dict.fromkeys(k for k in s3_keys if k))
+    failed = []
+
+    for i in range(0, len(keys), 1000):
+        batch = keys[i:i + 1000]
+        with span("s3", "delete_objects", keys=len(batch)):
+            resp = get_client().delete_objects(
+                Bucket=BUCKET,
+                Delete={
+                    "Objects": [{"Key": k} for k in batch],
+                    "Quiet": True,
+                },
+            )
+        failed += [e["Key"] for e in resp.get("Errors", [])]
+
+    return failed
 
 
 def generate_presigned_url(s3_key: str, expires_in: int = 3600) -> str:
     """
     Generate a temporary download URL for a PDF
     """
-    return s3.generate_presigned_url(
+    return get_client().generate_presigned_url(
         ClientMethod="get_object",
         Params={
             "Bucket": BUCKET,
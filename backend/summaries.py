@@ -0,0 +1,240 @@
+# Hierarchical document summaries (page -> section -> document), built in the
+# background after upload so overview questions don't send the whole text.
+# summaries.py
+#
+# Page summaries are stored on the pages rows; section and document summaries
+# in document_summaries, each with a hash of what it was built from so a
+# rerun (after OCR or a revised upload) only redoes the parts that changed.
+# main.py reads and writes the database; this module plans sections, calls
+# the LLM and formats the context /ask uses.
+import contextvars
+import hashlib
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from llm import create_response
+from metrics import inc
+
+# 0 = don't build summaries; /ask always sends the full text
+SUMMARIES_ENABLED = os.getenv("SUMMARIES_ENABLED", "1") != "0"
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4.1-mini")
+# Summary calls in flight at once across all documents; kept below
+# LLM_MAX_CONCURRENCY so interactive questions still get slots
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "4"))
+# Sections are the PDF outline's top-level entries, or runs of this many
+# pages when there is no outline (longer outline sections are split too)
+SUMMARY_SECTION_PAGES = int(os.getenv("SUMMARY_SECTION_PAGES", "10"))
+# Pages with less text than this are used as their own summary
+SUMMARY_MIN_CHARS = int(os.getenv("SUMMARY_MIN_CHARS", "400"))
+
+# Bump when prompts change so stored section/document summaries are rebuilt
+SUMMARY_VERSION = "1"
+
+PAGE_PROMPT = """
+Summarize this page of a document in 2-4 sentences for someone who will
+answer questions about the whole document. Keep key terms, definitions,
+names of equations or methods, and numbers. Plain text, no headings.
+"""
+
+SECTION_PROMPT = """
+Summarize this section of a document from the page summaries below in one
+short paragraph. Keep the main ideas, key terms and how they connect.
+Plain text, no headings.
+"""
+
+DOCUMENT_PROMPT = """
+Summarize this document from the section summaries below: what it is about,
+its main ideas in order, and its conclusions, in at most 200 words.
+Plain text, no headings.
+"""
+
+# Questions about the document as a whole rather than a detail in it
+_OVERVIEW_PATTERN = re.compile(
+    r"\b(summar(y|ize|ise|ies)|overview|outline|tl;?dr|gist|recap"
+    r"|main (points?|ideas?|topics?|takeaways?)|key (points?|ideas?|takeaways?|concepts?)"
+    r"|what (is|are) (this|the) (document|pdf|paper|lecture|slides?|chapter|book) about"
+    r"|what does (this|the) (document|pdf|paper|lecture|chapter|book) (cover|say|discuss))\b",
+    re.IGNORECASE,
+)
+
+
+def is_overview_question(question: str) -> bool:
+    return bool(_OVERVIEW_PATTERN.search(question))
+
+
+def plan_sections(page_count: int, toc=None):
+    """
+    Split pages 1..page_count into sections: [(title, start_page, end_page)].
+
+    toc: fitz's get_toc() list of [level, title, page]; its top-level entries
+    become sections when there are at least two of them.
+    """
+    starts = []
+    for level, title, page in toc or []:
+        if level == 1 and 1 <= page <= page_count and (not starts or page > starts[-1][1]):
+            starts.append((title.strip(), page))
+
+    if len(starts) < 2:
+        starts = []
+    elif starts[0][1] > 1:
+        starts.insert(0, ("", 1))
+
+    if not starts:
+        starts = [("", 1)]
+
+    sections = []
+    for i, (title, start) in enumerate(starts):
+        end = starts[i + 1][1] - 1 if i + 1 < len(starts) else page_count
+        # Long sections are split so no single call sees too many pages
+        for chunk_start in range(start, end + 1, SUMMARY_SECTION_PAGES):
+            chunk_end = min(end, chunk_start + SUMMARY_SECTION_PAGES - 1)
+            sections.append((title, chunk_start, chunk_end))
+    return sections
+
+
+def source_hash(*parts) -> str:
+    h = hashlib.sha256(SUMMARY_VERSION.encode("utf-8"))
+    for part in parts:
+        h.update(b"\0" + (part or "").encode("utf-8"))
+    return h.hexdigest()
+
+
+# ======================================================
+# LLM calls
+# ======================================================
+
+_pool = None
+_documents = None
+_pool_lock = threading.Lock()
+_stopped = False
+
+
+def _get_pools():
+    global _pool, _documents
+    if _pool is None:
+        with _pool_lock:
+            if _stopped:
+                raise RuntimeError("summaries are shut down")
+            if _pool is None:
+                # Summary calls, shared by every document, so several uploads
+                # at once still make at most SUMMARY_CONCURRENCY calls
+                _pool = ThreadPoolExecutor(
+                    max_workers=SUMMARY_CONCURRENCY,
+                    thread_name_prefix="summary",
+                )
+                # Documents being summarized; they mostly wait on _pool
+                _documents = ThreadPoolExecutor(
+                    max_workers=2,
+                    thread_name_prefix="summary-document",
+                )
+    return _pool, _documents
+
+
+def schedule(fn, *args):
+    """
+    Run fn(*args) in the background on a summary thread rather than one of
+    the server's request threads, which a long document would hold for
+    minutes
+    """
+    _get_pools()[1].submit(fn, *args)
+
+
+def shutdown_pool():
+    global _pool, _documents, _stopped
+    with _pool_lock:
+        _stopped = True
+        for pool in (_pool, _documents):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+        _pool = _documents = None
+
+
+def _summarize(instructions: str, text: str, level: str) -> str:
+    response = create_response(
+        model=SUMMARY_MODEL,
+        input=[
+            {"role": "system", "content": instructions.strip()},
+            {"role": "user", "content": text},
+        ],
+        temperature=0.2,
+        max_output_tokens=400,
+    )
+    inc("summaries_total", level=level, source="llm")
+    return response.output_text.strip()
+
+
+def summarize_page(text: str) -> str:
+    text = text.strip()
+    if len(text) < SUMMARY_MIN_CHARS:
+        inc("summaries_total", level="page", source="text")
+        return text
+    return _summarize(PAGE_PROMPT, text, "page")
+
+
+def summarize_section(title: str, page_summaries) -> str:
+    """
+    page_summaries: [(page_number, summary)] in page order
+    """
+    lines = [f"[Page {n}] {s}" for n, s in page_summaries if s]
+    if not lines:
+        return ""
+    if title:
+        lines.insert(0, f"Section: {title}")
+    return _summarize(SECTION_PROMPT, "\n".join(lines), "section")
+
+
+def summarize_document(title: str, sections) -> str:
+    """
+    sections: [{"title", "start_page", "end_page", "summary"}] in order
+    """
+    lines = [f"Document: {title}"] if title else []
+    lines += [section_line(s) for s in sections if s["summary"]]
+    return _summarize(DOCUMENT_PROMPT, "\n".join(lines), "document")
+
+
+def run_all(fn, items):
+    """
+    Call fn(*item) for every item on the shared pool. Returns a list of
+    results in order, with the exception in place of any that failed.
+    Each call runs in a copy of the caller's context, so llm.track_usage()
+    sees the calls.
+    """
+    pool = _get_pools()[0]
+    futures = [pool.submit(contextvars.copy_context().run, fn, *item) for item in items]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+# ======================================================
+# Context for /ask
+# ======================================================
+
+def section_line(section) -> str:
+    pages = f"Pages {section['start_page']}-{section['end_page']}"
+    if section["start_page"] == section["end_page"]:
+        pages = f"Page {section['start_page']}"
+    heading = f"{section['title']} ({pages})" if section["title"] else pages
+    return f"[{heading}]\n{section['summary']}"
+
+
+def summary_context(summaries):
+    """
+    Document text for an overview question: the document summary followed
+    by every section's. None if the document summary isn't built yet.
+
+    summaries: get_document_summaries() rows
+    """
+    document = next((s for s in summaries if s["level"] == "document"), None)
+    if document is None or not document["summary"]:
+        return None
+
+    parts = [f"[Summary of the whole document]\n{document['summary']}"]
+    parts += [section_line(s) for s in summaries if s["level"] == "section" and s["summary"]]
+    return "\n\n".join(parts) + "\n"
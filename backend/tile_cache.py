@@ -0,0 +1,108 @@
+# Content-addressed disk cache for rendered page images.
+# tile_cache.py
+#
+# Keys are sha256 digests of everything that affects the rendered bytes, so a
+# cached image never needs invalidation; old entries are trimmed LRU by size.
+import hashlib
+import os
+import threading
+import uuid
+
+from paths import TILE_CACHE_DIR
+
+MAX_TILE_CACHE_BYTES = int(os.getenv("TILE_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# Bump when rendering changes so stale images stop matching
+RENDER_VERSION = "1"
+
+_lock = threading.Lock()
+_total_bytes = None
+
+
+def tile_key(content_id: str, page_number: int, kind: str, **params) -> str:
+    parts = [RENDER_VERSION, content_id, str(page_number), kind]
+    parts += [f"{k}={params[k]}" for k in sorted(params)]
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+
+def _path(key: str) -> str:
+    return os.path.join(TILE_CACHE_DIR, key[:2], key)
+
+
+def get_tile(key: str):
+    path = _path(key)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+
+    # Touch so trimming treats it as recently used
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    return data
+
+
+def put_tile(key: str, data: bytes):
+    global _total_bytes
+
+    path = _path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+    with _lock:
+        if _total_bytes is None:
+            _total_bytes = _scan_total()
+        else:
+            _total_bytes += len(data)
+        over_budget = _total_bytes > MAX_TILE_CACHE_BYTES
+
+    if over_budget:
+        trim()
+
+
+def _scan():
+    entries = []
+    for root, _, names in os.walk(TILE_CACHE_DIR):
+        for name in names:
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    return entries
+
+
+def _scan_total() -> int:
+    return sum(size for _, size, _ in _scan())
+
+
+def trim(target_ratio: float = 0.9):
+    """
+    Remove least recently used images until the cache is under budget
+    """
+    global _total_bytes
+
+    entries = _scan()
+    total = sum(size for _, size, _ in entries)
+    target = int(MAX_TILE_CACHE_BYTES * target_ratio)
+
+    for _, size, path in sorted(entries):
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except FileNotFoundError:
+            pass
+
+    with _lock:
+        _total_bytes = total
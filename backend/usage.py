@@ -0,0 +1,75 @@
+# Token accounting and per-user budgets.
+# usage.py
+#
+# Every answered question stores one llm_usage row (tokens, cost, latency,
+# model and route) next to its assistant message; background work such as
+# summaries stores rows without a message. Budgets are checked against the
+# current period's spend before any upstream call: past the downgrade
+# threshold questions go to the small model, past the limit they are refused.
+import os
+import time
+from datetime import datetime, timezone
+
+from llm import cost_usd
+
+# Defaults for users without a row in user_budgets (unset = no threshold)
+BUDGET_PERIOD = os.getenv("BUDGET_PERIOD", "month")
+BUDGET_DOWNGRADE_USD = float(os.getenv("BUDGET_DOWNGRADE_USD")) if os.getenv("BUDGET_DOWNGRADE_USD") else None
+BUDGET_LIMIT_USD = float(os.getenv("BUDGET_LIMIT_USD")) if os.getenv("BUDGET_LIMIT_USD") else None
+
+PERIODS = ("day", "month")
+
+
+def totals(calls, seconds: float = None):
+    """
+    Sum llm.track_usage() entries into one usage record: tokens, cost in
+    USD, the model of the last call and latency (seconds, if given, else
+    the calls' own time)
+    """
+    record = {
+        "model": calls[-1]["model"] if calls else None,
+        "calls": len(calls),
+        "input_tokens": sum(c["input_tokens"] for c in calls),
+        "cached_tokens": sum(c["cached_tokens"] for c in calls),
+        "output_tokens": sum(c["output_tokens"] for c in calls),
+        "cost_usd": sum(
+            cost_usd(c["model"], c["input_tokens"], c["cached_tokens"], c["output_tokens"])
+            for c in calls
+        ),
+    }
+    if seconds is None:
+        seconds = sum(c["seconds"] for c in calls)
+    record["latency_ms"] = round(seconds * 1000)
+    return record
+
+
+def period_start(period: str, now: float = None) -> int:
+    """
+    Unix time at which the current budget period (UTC day or month) began
+    """
+    t = datetime.fromtimestamp(now if now is not None else time.time(), tz=timezone.utc)
+    if period == "day":
+        t = t.replace(hour=0, minute=0, second=0, microsecond=0)
+    else:
+        t = t.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return int(t.timestamp())
+
+
+def default_budget(user_id: int):
+    return {
+        "user_id": user_id,
+        "period": BUDGET_PERIOD,
+        "downgrade_usd": BUDGET_DOWNGRADE_USD,
+        "limit_usd": BUDGET_LIMIT_USD,
+    }
+
+
+def budget_state(budget, spent_usd: float) -> str:
+    """
+    "ok", "downgrade" (answer on the small model) or "reject"
+    """
+    if budget["limit_usd"] is not None and spent_usd >= budget["limit_usd"]:
+        return "reject"
+    if budget["downgrade_usd"] is not None and spent_usd >= budget["downgrade_usd"]:
+        return "downgrade"
+    return "ok"